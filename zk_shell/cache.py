@@ -0,0 +1,346 @@
+"""
+Caches for children lists & existence
+
+Completing paths and checking that they exist before running a command
+cost a round trip each, which is noticeable over a slow link. PathCache
+(off by default) keeps the last children lists and exists() results (LRU,
+up to max_size of each) and sets a one-shot watch for every one of them,
+so a change drops the entry and the next lookup goes to the server again.
+
+Watches can't be removed, so an evicted entry's watch stays set until it
+fires: to keep their number bounded, no more than max_size paths (of each
+kind) are watched at a time and, past that, lookups aren't cached.
+
+Watch callbacks run on kazoo's callback thread, so before answering from
+the cache any notifications that were already received are flushed (this
+session sees the notification for its own write before the reply to it,
+so the shell never reads back stale entries after changing something).
+Everything is dropped when the connection is suspended or lost.
+
+ChildrenCache is for scans (off by default, see Traversal): it keeps big
+children lists (no watches) along with their parent's czxid, pzxid &
+cversion. The next time a list is asked for, a stat tells whether it
+changed and only then it's downloaded again. That costs an extra round
+trip for a list that did change, so lists that changed since they were
+last validated are fetched straight away until they're seen unchanged.
+
+  Example usage:
+    >>> from zk_shell.cache import ChildrenCache, PathCache
+    >>> cache = PathCache(zk, 1000)
+    >>> cache.get_children("/")
+    ['zookeeper', 'configs']
+    >>> cache.exists("/configs")   # answered from the children of /
+    True
+    >>> cache.hits, cache.misses
+    (1, 1)
+    >>> children = ChildrenCache(zk, zk.get_children_async, 1000000)
+    >>> len(children.get_children_async("/big").get())
+    250000
+    >>> len(children.get_children_async("/big").get())   # just a stat
+    250000
+
+"""
+
+from collections import OrderedDict
+import os
+import threading
+
+from kazoo.exceptions import KazooException, NoNodeError
+from kazoo.protocol.states import Callback, EventType, KazooState
+
+
+# max entries (and watches) per kind, 0 is off
+DEFAULT_PATH_CACHE_SIZE = 0
+
+# seconds to wait for pending watch callbacks
+FLUSH_TIMEOUT = 0.05
+
+
+class PathCache(object):
+    __slots__ = (
+        "zk", "max_size", "lock", "epoch", "nodes", "children", "watched_nodes",
+        "watched_children", "hits", "misses"
+    )
+
+    def __init__(self, zk, max_size=DEFAULT_PATH_CACHE_SIZE):
+        """
+        :param zk: the client
+        :param max_size: max number of children lists (and of exists() results)
+                         that are kept, 0 disables the cache
+        """
+        self.zk = zk
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.nodes = OrderedDict()
+        self.children = OrderedDict()
+        # the paths with a watch set (evicted or not)
+        self.watched_nodes = set()
+        self.watched_children = set()
+        self.hits = self.misses = 0
+
+        zk.add_listener(self._state_changed)
+
+    def __len__(self):
+        return len(self.nodes) + len(self.children)
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self._trim(self.nodes)
+            self._trim(self.children)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.nodes.clear()
+            self.children.clear()
+
+    def exists(self, path):
+        """ True if path exists """
+        if self.max_size <= 0:
+            return self.zk.exists(path) is not None
+
+        self._flush()
+        with self.lock:
+            found = self._lookup(self.nodes, path)
+            if found is None and path != "/":
+                parent = self._lookup(self.children, os.path.dirname(path))
+                found = None if parent is None else os.path.basename(path) in parent
+            self._count(found)
+        if found is not None:
+            return found
+
+        if not self._watch(self.watched_nodes, path):
+            return self.zk.exists(path) is not None
+
+        epoch = self.epoch
+        found = self.zk.exists(path, watch=self._node_changed) is not None
+        self._store(self.nodes, path, found, epoch)
+        return found
+
+    def get_children(self, path):
+        """ the children of path, raises NoNodeError if it doesn't exist """
+        if self.max_size <= 0:
+            return self.zk.get_children(path)
+
+        self._flush()
+        with self.lock:
+            children = self._lookup(self.children, path)
+            self._count(children)
+        if children is not None:
+            return list(children)
+
+        if not self._watch(self.watched_children, path):
+            return self.zk.get_children(path)
+
+        epoch = self.epoch
+        try:
+            children = self.zk.get_children(path, watch=self._children_changed)
+        except NoNodeError:
+            # no watch was set
+            with self.lock:
+                self.watched_children.discard(path)
+            raise
+        self._store(self.children, path, children, epoch)
+        return list(children)
+
+    def prefetch(self, path):
+        """ fetches the children of path in the background """
+        if self.max_size <= 0 or path in self.children:
+            return
+
+        if not self._watch(self.watched_children, path):
+            return
+
+        def fetched(result, epoch=self.epoch):
+            try:
+                self._store(self.children, path, result.get(), epoch)
+            except KazooException:
+                with self.lock:
+                    self.watched_children.discard(path)
+
+        self.zk.get_children_async(path, watch=self._children_changed).rawlink(fetched)
+
+    def _watch(self, watched, path):
+        """ True if path can be watched (it might be already) """
+        with self.lock:
+            if path in watched:
+                return True
+            if len(watched) >= self.max_size:
+                return False
+            watched.add(path)
+            return True
+
+    def _lookup(self, entries, path):
+        value = entries.get(path)
+        if value is not None:
+            # most recently used goes last
+            del entries[path]
+            entries[path] = value
+        return value
+
+    def _count(self, found):
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    def _store(self, entries, path, value, epoch):
+        with self.lock:
+            # a notification came in while fetching, the value might be stale
+            if epoch != self.epoch:
+                return
+            entries.pop(path, None)
+            entries[path] = value
+            self._trim(entries)
+
+    def _trim(self, entries):
+        while len(entries) > max(self.max_size, 0):
+            entries.popitem(last=False)
+
+    def _flush(self):
+        """ waits (briefly) for the watch callbacks that are already queued """
+        if not self.nodes and not self.children:
+            return
+
+        done = self.zk.handler.event_object()
+        self.zk.handler.dispatch_callback(Callback("cache", done.set, ()))
+        done.wait(FLUSH_TIMEOUT)
+
+    def _node_changed(self, event):
+        with self.lock:
+            self.epoch += 1
+            self.watched_nodes.discard(event.path)
+            self.nodes.pop(event.path, None)
+            if event.type == EventType.DELETED:
+                self.children.pop(event.path, None)
+
+    def _children_changed(self, event):
+        with self.lock:
+            self.epoch += 1
+            self.watched_children.discard(event.path)
+            self.children.pop(event.path, None)
+            if event.type == EventType.DELETED:
+                self.nodes.pop(event.path, None)
+
+    def _state_changed(self, state):
+        if state != KazooState.CONNECTED:
+            self.clear()
+
+        # kazoo sets the watches again after reconnecting, unless the session is gone
+        if state == KazooState.LOST:
+            with self.lock:
+                self.watched_nodes.clear()
+                self.watched_children.clear()
+
+
+# lists shorter than this are cheaper to fetch than to validate
+MIN_CACHED_CHILDREN = 100
+
+# max children names kept (all lists), 0 is off
+DEFAULT_CHILDREN_CACHE_SIZE = 0
+
+
+class ChildrenCache(object):
+    """
+    big children lists along with their parent's (czxid, pzxid, cversion),
+    validated with a stat instead of being fetched again (unless they changed
+    the last time)
+    """
+    __slots__ = ("zk", "fetch", "max_names", "lock", "entries", "names", "hits", "misses")
+
+    def __init__(self, zk, fetch, max_names=DEFAULT_CHILDREN_CACHE_SIZE):
+        """
+        :param zk: the client, for exists_async() & its handler
+        :param fetch: the uncached get_children_async()
+        :param max_names: max number of names kept, across lists (0 disables the cache)
+        """
+        self.zk, self.fetch = zk, fetch
+        self.max_names = max_names
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.names = 0
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def resize(self, max_names):
+        with self.lock:
+            self.max_names = max_names
+            self._trim()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.names = 0
+
+    def get_children_async(self, path, include_data=False):
+        """ like the client's, but big lists are validated via exists() first """
+        with self.lock:
+            entry = self.entries.get(path) if self.max_names > 0 else None
+            if entry is not None:
+                del self.entries[path]
+                self.entries[path] = entry
+
+        if self.max_names <= 0:
+            return self.fetch(path, include_data=include_data)
+
+        result = self.zk.handler.async_result()
+        if entry is None or entry[2]:
+            self._fetch(path, include_data, result, entry)
+            return result
+
+        def validated(request):
+            try:
+                stat = request.get()
+                if stat is None:
+                    raise NoNodeError()
+                if self._version(stat) != entry[0]:
+                    self._fetch(path, include_data, result, entry)
+                    return
+
+                with self.lock:
+                    self.hits += 1
+                children = list(entry[1])
+                result.set((children, stat) if include_data else children)
+            except Exception as ex:
+                result.set_exception(ex)
+
+        self.zk.exists_async(path).rawlink(validated)
+        return result
+
+    def _fetch(self, path, include_data, result, entry):
+        with self.lock:
+            self.misses += 1
+
+        def fetched(request):
+            try:
+                children, stat = request.get()
+                version = self._version(stat)
+                self._store(path, version, children, entry is not None and entry[0] != version)
+                result.set((children, stat) if include_data else children)
+            except Exception as ex:
+                result.set_exception(ex)
+
+        self.fetch(path, include_data=True).rawlink(fetched)
+
+    def _version(self, stat):
+        return (stat.czxid, stat.pzxid, stat.cversion)
+
+    def _store(self, path, version, children, changed):
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.names -= len(old[1])
+            if len(children) < MIN_CACHED_CHILDREN or len(children) > self.max_names:
+                return
+            self.entries[path] = (version, tuple(children), changed)
+            self.names += len(children)
+            self._trim()
+
+    def _trim(self):
+        while self.names > max(self.max_names, 0):
+            _, (_, children, _) = self.entries.popitem(last=False)
+            self.names -= len(children)
@@ -0,0 +1,83 @@
+"""
+Resumable traversal checkpoints
+
+A checkpoint is the frontier of a traversal (the znodes being fetched and,
+for each partially walked parent, the children that are left) plus some
+state kept by the caller (i.e.: counters). It's written to a JSON file
+every so often and when the traversal fails (i.e.: the session expired),
+so a new process can pick up from there instead of starting over.
+
+  Example usage:
+    >>> from zk_shell.checkpoint import Checkpoint
+    >>> from zk_shell.pathmap import PathMap
+    >>> checkpoint = Checkpoint("/tmp/scan.json", resume=True)
+    >>> checkpoint.resumed
+    True
+    >>> for path, value in PathMap(zk, "/", checkpoint=checkpoint).get():
+    ...     checkpoint.state["values"] = checkpoint.state.get("values", 0) + 1
+    >>> checkpoint.remove()
+
+"""
+
+import json
+import os
+import time
+
+
+# seconds between saves
+CHECKPOINT_INTERVAL = 10.0
+
+
+class Checkpoint(object):
+    __slots__ = ("filename", "interval", "saved", "frontier", "state", "walk")
+
+    def __init__(self, filename, resume=False, interval=CHECKPOINT_INTERVAL):
+        """
+        :param filename: where the checkpoint is kept
+        :param resume: load the frontier & state from filename (if it's there)
+        :param interval: seconds between saves
+        """
+        self.filename, self.interval = filename, interval
+        self.saved = time.time()
+        self.frontier = None
+        self.state = {}
+        # the frontier() of the walk in progress, set by its Traversal
+        self.walk = None
+
+        if resume:
+            self.load()
+
+    @property
+    def resumed(self):
+        """ whether the frontier was loaded from a previous run """
+        return self.frontier is not None
+
+    def load(self):
+        try:
+            with open(self.filename) as fh:
+                content = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return False
+
+        self.frontier, self.state = content["frontier"], content["state"]
+        return True
+
+    def due(self):
+        return time.time() - self.saved >= self.interval
+
+    def save(self, frontier=None):
+        """ writes the frontier (by default, the walk's in progress) & state, atomically """
+        if frontier is None:
+            frontier = self.walk()
+        tmp = "%s.tmp" % (self.filename)
+        with open(tmp, "w") as fh:
+            json.dump({"frontier": frontier, "state": self.state}, fh)
+        os.rename(tmp, self.filename)
+        self.saved = time.time()
+
+    def remove(self):
+        """ the traversal is over """
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
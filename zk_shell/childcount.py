@@ -0,0 +1,59 @@
+"""
+Single pass subtree child counts
+
+Every znode under path is stat'ed exactly once and its numChildren is
+added to each of its ancestors up to the requested depth, so the counts
+for all the reported paths are built bottom-up in one traversal.
+
+  Example usage:
+    >>> from kazoo.client import KazooClient
+    >>> from zk_shell.childcount import ChildCount
+    >>> zk = KazooClient(hosts)
+    >>> zk.start()
+    >>> gen = ChildCount(zk, "/", 1).get()
+    >>> str([pc for pc in gen])
+    [
+      ('/zookeeper', 2),
+      ('/configs', 3),
+    ]
+    >>> zk.stop()
+
+"""
+
+from .traversal import STAT, Traversal
+from .util import DEFAULT_MAX_INFLIGHT
+
+
+class ChildCount(object):
+    __slots__ = ("zk", "path", "max_depth", "max_inflight")
+
+    def __init__(self, zk, path, max_depth=1, max_inflight=DEFAULT_MAX_INFLIGHT):
+        """
+        :param max_depth: report paths up to this depth (0 means no limit)
+        """
+        self.zk, self.path, self.max_depth = zk, path, max_depth
+        self.max_inflight = max_inflight
+
+    def get(self):
+        """
+        yields (path, number of znodes under path) for each path up to
+        max_depth, in DFS order (once the whole subtree has been counted).
+        """
+        paths = {}
+        counts = {}
+        max_depth = self.max_depth
+        traversal = Traversal(self.zk, self.path, needs=STAT, max_inflight=self.max_inflight)
+
+        # nodes are identified by their keys, whose prefixes are their ancestors
+        for node in traversal.get():
+            if max_depth <= 0 or node.level < max_depth:
+                paths[node.key] = node.path
+                counts[node.key] = counts.get(node.key, 0)
+
+            last = node.level if max_depth <= 0 else min(node.level, max_depth - 1)
+            for level in range(0, last + 1):
+                ancestor = node.key[:level + 1]
+                counts[ancestor] = counts.get(ancestor, 0) + node.stat.numChildren
+
+        for key in sorted(paths):
+            yield paths[key], counts[key]
@@ -4,6 +4,8 @@ from __future__ import print_function
 
 from base64 import b64decode, b64encode
 from collections import defaultdict
+from functools import partial
+from itertools import islice
 import json
 import os
 import re
@@ -18,20 +20,29 @@ except ImportError:
 
 from kazoo.client import KazooClient
 from kazoo.exceptions import (
+    BadVersionError,
     NoAuthError,
     NodeExistsError,
     NoNodeError,
     NoChildrenForEphemeralsError,
+    NotEmptyError,
     ZookeeperError,
 )
 
 from .acl import ACLReader
+from .delete import RecursiveDelete
+from .pipeline import pipelined
+from .snapshot import Snapshot, SnapshotError
 from .statmap import StatMap
-from .util import Netloc, to_bytes
+from .traversal import ACLS, DATA, Traversal
+from .util import DEFAULT_MAX_INFLIGHT, DEFAULT_MAX_INFLIGHT_WRITES, Netloc, to_bytes
 
 
 DEFAULT_ZK_PORT = 2181
 
+# times a write is attempted when the znode changes between reading & writing it
+WRITE_RETRIES = 3
+
 
 def zk_client(host, scheme, credential):
     """ returns a connected (and possibly authenticated) ZK client """
@@ -48,6 +59,22 @@ def zk_client(host, scheme, credential):
     return client
 
 
+def until_due(values, checkpoint):
+    """ splits the iterable values into batches that end when checkpoint is due """
+    values = iter(values)
+
+    def batch(first):
+        yield first
+        while not checkpoint.due():
+            try:
+                yield next(values)
+            except StopIteration:
+                return
+
+    for first in values:
+        yield batch(first)
+
+
 class CopyError(Exception):
     """ base exception for Copy errors """
 
@@ -105,6 +132,7 @@ class ProxyType(type):
 
 class Proxy(ProxyType("ProxyBase", (object,), {})):
     SCHEME = ""
+    READ_ONLY = False
 
     def __init__(self, parse_result, exists, async, verbose):
         self.parse_result = parse_result
@@ -112,6 +140,9 @@ class Proxy(ProxyType("ProxyBase", (object,), {})):
         self.exists = exists
         self.async = async
         self.verbose = verbose
+        # outstanding reads & writes, for proxies that pipeline them when async
+        self.max_inflight = DEFAULT_MAX_INFLIGHT
+        self.max_inflight_writes = DEFAULT_MAX_INFLIGHT_WRITES
 
     @property
     def scheme(self):
@@ -176,13 +207,54 @@ class Proxy(ProxyType("ProxyBase", (object,), {})):
     def write_path(self, path_value):
         raise NotImplementedError("write_path must be implemented")
 
-    def children_of(self):
+    def children_of(self, checkpoint=None):
+        """
+        :param checkpoint: a Checkpoint to save the walk to (and resume it from),
+                           if the proxy supports it
+        """
         raise NotImplementedError("children_of must be implemented")
 
+    def values_of(self, checkpoint=None, autosave=True):
+        """
+        yields (child, PathValue) for each path under this one, see children_of().
+
+        :param autosave: if False and the walk is a Traversal, the checkpoint is only
+                         saved by the caller (see Checkpoint.save())
+        """
+        url = self.url
+        for child in self.children_of(checkpoint):
+            self.set_url(os.path.join(url, child))
+            value = self.read_path()
+            self.set_url(url)
+            yield child, value
+
+    def write_paths(self, values, existing=None):
+        """
+        writes an iterable of (child, PathValue) under this path, parents before
+        their children. Yields each child once it's written.
+
+        :param existing: the children known to exist already (i.e.: when mirroring),
+                         if any
+        """
+        url = self.url
+        for child, value in values:
+            self.set_url(os.path.join(url, child))
+            self.write_path(value)
+            self.set_url(url)
+            yield child
+
+    def delete_path(self):
+        """ deletes this path, unless it has children (it's fine if it's gone already) """
+        raise NotImplementedError("delete_path must be implemented")
+
     def delete_path_recursively(self):
         raise NotImplementedError("delete_path must be implemented")
 
-    def copy(self, dst, recursive, max_items, mirror):
+    def copy(self, dst, recursive, max_items, mirror, checkpoint=None):
+        """
+        :param checkpoint: a Checkpoint for walking the children, if it was loaded
+                           the copy resumes from it
+        """
         opname = "Copy" if not mirror else "Mirror"
 
         # basic sanity check
@@ -196,36 +268,60 @@ class Proxy(ProxyType("ProxyBase", (object,), {})):
         if mirror and not recursive:
             raise CopyError("Mirroring must be recursive", True)
 
+        if dst.READ_ONLY:
+            raise CopyError("Can't write to %s:// paths" % (dst.scheme), True)
+
         start = time.time()
 
         src_url = self.url
         dst_url = dst.url
 
+        # async zk:// writes read the znodes known to exist first, and create the rest
+        list_dst = mirror or (recursive and dst.exists is None and dst.scheme == "zk" and dst.async)
+
         with self:
             with dst:
-                if mirror:
+                if list_dst:
                     dst_children = set(c for c in dst.children_of())
 
-                self.do_copy(dst, opname)
+                resumed = checkpoint is not None and checkpoint.resumed
+                if not resumed:
+                    self.do_copy(dst, opname)
 
                 if recursive:
-                    for i, child in enumerate(self.children_of()):
-                        if mirror and child in dst_children:
-                            dst_children.remove(child)
-                        if max_items > 0 and i == max_items:
-                            break
-                        self.set_url(os.path.join(src_url, child))
-                        dst.set_url(os.path.join(dst_url, child))
-                        self.do_copy(dst, opname)
-
-                        # reset to base urls
-                        self.set_url(src_url)
-                        dst.set_url(dst_url)
+                    # pipelined writes are acknowledged later than the walk moves on, so
+                    # the checkpoint is saved between batches, once all of them are written
+                    batched = checkpoint is not None and self.scheme == "zk" and self.async and \
+                        dst.scheme == "zk" and dst.async
+                    copied = checkpoint.state.get("copied", 0) if resumed else 0
+                    values = self.values_of(checkpoint, autosave=not batched)
+                    if max_items > 0:
+                        values = islice(values, max(max_items - copied, 0))
+
+                    for batch in (until_due(values, checkpoint) if batched else [values]):
+                        for child in dst.write_paths(batch, dst_children if list_dst else None):
+                            if mirror:
+                                dst_children.discard(child)
+                            if self.verbose:
+                                self.report_copy(
+                                    opname, os.path.join(src_url, child), os.path.join(dst_url, child))
+
+                            copied += 1
+                            if checkpoint is not None:
+                                checkpoint.state["copied"] = copied
+
+                        if batched:
+                            checkpoint.save()
 
                 if mirror:
+                    # the children copied before resuming weren't walked this time
+                    if resumed:
+                        dst_children.difference_update(self.children_of())
+
                     for child in dst_children:
                         dst.set_url(os.path.join(dst_url, child))
                         dst.delete_path_recursively()
+                    dst.set_url(dst_url)
 
         end = time.time()
 
@@ -233,13 +329,16 @@ class Proxy(ProxyType("ProxyBase", (object,), {})):
 
     def do_copy(self, dst, opname):
         if self.verbose:
-            if self.async:
-                print("%sing (asynchronously) from %s to %s" % (opname, self.url, dst.url))
-            else:
-                print("%sing from %s to %s" % (opname, self.url, dst.url))
+            self.report_copy(opname, self.url, dst.url)
 
         dst.write_path(self.read_path())
 
+    def report_copy(self, opname, src_url, dst_url):
+        if self.async:
+            print("%sing (asynchronously) from %s to %s" % (opname, src_url, dst_url))
+        else:
+            print("%sing from %s to %s" % (opname, src_url, dst_url))
+
 
 class ZKProxy(Proxy):
     """ read/write ZooKeeper paths """
@@ -308,49 +407,71 @@ class ZKProxy(Proxy):
             raise AuthError("read", self.path)
 
     def write_path(self, path_value):
+        """
+        a get tells if the znode needs creating or setting (with its version, so
+        a concurrent change is noticed): 1 round trip if it's unchanged, 2 otherwise
+        """
         if isinstance(path_value, self.ZKPathValue):
             acl = path_value.acl
         else:
             acl = [ACLReader.from_dict(a) for a in path_value.acl]
 
-        if self.client.exists(self.path):
+        for _ in range(0, WRITE_RETRIES):
             try:
-                value = self.get_value(self.path)
-                if path_value.value != value:
-                    self.client.set(self.path, path_value.value)
-            except NoAuthError:
-                raise AuthError("write", self.path)
-        else:
+                value, stat = self.get_value_and_stat(self.path)
+            except NoNodeError:
+                stat = None
+
             try:
-                # Kazoo's create() doesn't handle acl=[] correctly
-                # See: https://github.com/python-zk/kazoo/pull/164
-                acl = acl or None
-                self.client.create(self.path, path_value.value, acl=acl, makepath=True)
+                if stat is None:
+                    # Kazoo's create() doesn't handle acl=[] correctly
+                    # See: https://github.com/python-zk/kazoo/pull/164
+                    self.client.create(self.path, path_value.value, acl=acl or None, makepath=True)
+                elif path_value.value != value:
+                    self.client.set(self.path, path_value.value, version=stat.version)
+                return
+            except (NodeExistsError, BadVersionError):
+                # changed since the get, look again
+                continue
             except NoAuthError:
-                raise AuthError("create", self.path)
-            except NodeExistsError:
-                raise CopyError("Node %s exists" % (self.path))
+                raise AuthError("create" if stat is None else "write", self.path)
             except NoNodeError:
-                raise CopyError("Parent node for %s is missing" % (self.path))
+                if stat is None:
+                    raise CopyError("Parent node for %s is missing" % (self.path))
+                continue
             except NoChildrenForEphemeralsError:
                 raise CopyError("Ephemeral znodes can't have children")
             except ZookeeperError:
                 raise CopyError("ZooKeeper server error")
 
+        raise CopyError("znode %s kept changing while being written" % (self.path))
+
     def get_value(self, path):
+        return self.get_value_and_stat(path)[0]
+
+    def get_value_and_stat(self, path):
         try:
             if hasattr(self.client, 'get_bytes'):
-                v, _ = self.client.get_bytes(path)
-            else:
-                v, _ = self.client.get(path)
+                return self.client.get_bytes(path)
+            return self.client.get(path)
         except NoAuthError:
             raise AuthError("read", path)
 
-        return v
+    def delete_path(self):
+        try:
+            self.client.delete(self.path)
+        except NoNodeError:
+            pass
+        except NotEmptyError:
+            raise CopyError("Path %s isn't empty" % (self.path))
+        except NoAuthError:
+            raise AuthError("delete", self.path)
+        except ZookeeperError:
+            raise CopyError("Zookeeper server error")
 
     def delete_path_recursively(self):
         try:
-            self.client.delete(self.path, recursive=True)
+            RecursiveDelete(self.client, self.path).run()
         except NoNodeError:
             pass
         except NoAuthError:
@@ -358,10 +479,150 @@ class ZKProxy(Proxy):
         except ZookeeperError:
             raise CopyError("Zookeeper server error")
 
-    def children_of(self):
+    def values_of(self, checkpoint=None, autosave=True):
+        """ when async, values & ACLs are read with a pipelined traversal """
+        if not self.async:
+            for child, value in super(ZKProxy, self).values_of(checkpoint, autosave):
+                yield child, value
+            return
+
+        offs = 1 if self.path == "/" else len(self.path) + 1
+        traversal = Traversal(self.client,
+                              self.path,
+                              needs=DATA | ACLS,
+                              max_inflight=self.max_inflight,
+                              checkpoint=checkpoint,
+                              strict=True,
+                              autosave=autosave)
+        try:
+            for node in traversal.get():
+                if node.stat.ephemeralOwner == 0:
+                    yield node.path[offs:], self.ZKPathValue(node.data, node.acls)
+        except NoAuthError:
+            raise AuthError("read", "under %s" % (self.path))
+
+    def write_paths(self, values, existing=None):
+        """
+        when async, writes are pipelined (up to max_inflight_writes outstanding).
+        A session's requests are applied in order, so parents are created
+        before their children. See write_path_async().
+        """
+        if not self.async:
+            for child in super(ZKProxy, self).write_paths(values, existing):
+                yield child
+            return
+
+        def send(path, value, exists):
+            return partial(self.write_path_async, path, value, exists)
+
+        requests = (
+            ((child, os.path.join(self.path, child)),
+             send(os.path.join(self.path, child), value, existing is not None and child in existing))
+            for child, value in values
+        )
+        for (child, path), _, ex in pipelined(requests, self.max_inflight_writes):
+            if ex is not None:
+                raise self.write_error(path, ex)
+            yield child
+
+    def write_path_async(self, path, path_value, exists=False):
+        """
+        an async result for writing path_value to path, True if it was written.
+
+        If path is known to exist it's read first, so it costs 1 round trip if
+        it's unchanged and 2 otherwise. If not, it's created first: 1 round trip
+        if it's new, 2 if it turns out to exist unchanged and 3 if changed. Sets are conditional on the version that was read, and
+        the znode is read again if it changed meanwhile. ACLs are left alone
+        for existing znodes, as with write_path().
+
+        Missing parents are created along (as with write_path()). If a znode
+        that was known to exist is gone, its create is sent after its
+        children's writes, which might create it first: its ACLs are set then.
+        """
+        if isinstance(path_value, self.ZKPathValue):
+            acl = path_value.acl
+        else:
+            acl = [ACLReader.from_dict(a) for a in path_value.acl]
+        value = to_bytes(path_value.value)
+        client = self.client
+        result = client.handler.async_result()
+        attempts = [0]
+        # it was found missing, so its ACLs are ours to set
+        missing = [False]
+
+        def again():
+            attempts[0] += 1
+            if attempts[0] > WRITE_RETRIES:
+                result.set_exception(BadVersionError())
+            else:
+                client.get_async(path).rawlink(fetched)
+
+        def fetched(pending):
+            try:
+                current, stat = pending.get()
+            except NoNodeError:
+                missing[0] = True
+                # Kazoo's create() doesn't handle acl=[] correctly
+                client.create_async(path, value, acl=acl or None, makepath=True).rawlink(created)
+                return
+            except Exception as ex:  # pylint: disable=W0703
+                result.set_exception(ex)
+                return
+
+            if current != value:
+                client.set_async(path, value, version=stat.version).rawlink(updated)
+            elif missing[0] and acl:
+                missing[0] = False
+                client.set_acls_async(path, acl).rawlink(updated)
+            else:
+                result.set(False)
+
+        def created(pending):
+            try:
+                pending.get()
+                result.set(True)
+            except NodeExistsError:
+                again()
+            except Exception as ex:  # pylint: disable=W0703
+                result.set_exception(ex)
+
+        def updated(pending):
+            try:
+                pending.get()
+                if missing[0] and acl:
+                    missing[0] = False
+                    client.set_acls_async(path, acl).rawlink(updated)
+                    return
+                result.set(True)
+            except (BadVersionError, NoNodeError):
+                again()
+            except Exception as ex:  # pylint: disable=W0703
+                result.set_exception(ex)
+
+        if exists:
+            client.get_async(path).rawlink(fetched)
+        else:
+            client.create_async(path, value, acl=acl or None, makepath=True).rawlink(created)
+
+        return result
+
+    def write_error(self, path, ex):
+        """ the CopyError for a failed write_path_async() """
+        if isinstance(ex, NoAuthError):
+            return AuthError("write", path)
+        if isinstance(ex, NoNodeError):
+            return CopyError("Parent node for %s is missing" % (path))
+        if isinstance(ex, NoChildrenForEphemeralsError):
+            return CopyError("Ephemeral znodes can't have children")
+        if isinstance(ex, BadVersionError):
+            return CopyError("znode %s kept changing while being written" % (path))
+        return CopyError("ZooKeeper server error")
+
+    def children_of(self, checkpoint=None):
         if self.async:
             offs = 1 if self.path == "/" else len(self.path) + 1
-            for path, stat in StatMap(self.client, self.path, recursive=True).get():
+            statmap = StatMap(self.client, self.path, recursive=True, checkpoint=checkpoint)
+            for path, stat in statmap.get():
                 if stat.ephemeralOwner == 0:
                     yield path[offs:]
         else:
@@ -429,7 +690,7 @@ class FileProxy(Proxy):
         with open(self.path, "w") as fph:
             fph.write(path_value.value)
 
-    def children_of(self):
+    def children_of(self, checkpoint=None):
         root_path = self.path[0:-1] if self.path.endswith("/") else self.path
         for path, _, files in os.walk(root_path):
             path = path.replace(root_path, "")
@@ -529,16 +790,75 @@ class JSONProxy(Proxy):
         self._tree[self.path]["acls"] = path_value.acl_as_dict
         self._dirty = True
 
-    def children_of(self):
+    def children_of(self, checkpoint=None):
+        """ sorted, so parents come before their children """
         offs = 1 if self.path == "/" else len(self.path) + 1
         good = lambda k: k != self.path and k.startswith(self.path)
-        for child in self._tree.keys():
+        for child in sorted(self._tree.keys()):
             if good(child):
                 yield child[offs:]
 
+    def delete_path(self):
+        if self.path not in self._tree:
+            return
+        prefix = self.path.rstrip("/") + "/"
+        if any(path.startswith(prefix) for path in self._tree):
+            raise CopyError("Path %s isn't empty" % (self.path))
+        self._tree.pop(self.path)
+        self._dirty = True
+
     def delete_path_recursively(self):
         if self.path in self._tree:
             # build a set from the iterable so we don't change the dictionary during iteration
             for c in set(self.children_of()):
                 self._tree.pop(os.path.join(self.path, c))
             self._tree.pop(self.path)
+
+
+class SnapshotProxy(Proxy):
+    """ read from ZooKeeper snapshot files discovered via:
+
+          snapshot://!var!lib!zookeeper!version-2!snapshot.1a2b/some/path
+
+        ephemeral znodes are skipped, like when reading from ZK.
+    """
+
+    SCHEME = "snapshot"
+    READ_ONLY = True
+
+    def __init__(self, *args, **kwargs):
+        super(SnapshotProxy, self).__init__(*args, **kwargs)
+        self._snapshot = None
+
+    def __enter__(self):
+        try:
+            self._snapshot = Snapshot(self.host)
+        except (IOError, OSError, SnapshotError) as ex:
+            raise CopyError("Can't read snapshot %s: %s" % (self.host, ex))
+
+        if self.exists is not None:
+            self.check_path()
+
+    def __exit__(self, etype, value, traceback):
+        self._snapshot.close()
+
+    @property
+    def host(self):
+        return super(SnapshotProxy, self).host.replace("!", "/")
+
+    def check_path(self):
+        if (self._snapshot.exists(self.path) is not None) != self.exists:
+            error = "Path %s " % (self.path)
+            error += "doesn't exist" if self.exists else "exists"
+            raise CopyError(error)
+
+    def read_path(self):
+        value, _ = self._snapshot.get(self.path)
+        acl, _ = self._snapshot.get_acls(self.path)
+        return ZKProxy.ZKPathValue(value, acl)
+
+    def children_of(self, checkpoint=None):
+        offs = 1 if self.path == "/" else len(self.path) + 1
+        for path in self._snapshot.walk(self.path):
+            if self._snapshot.exists(path).ephemeralOwner == 0:
+                yield path[offs:]
@@ -0,0 +1,168 @@
+"""
+Parallel bottom-up recursive delete
+
+The subtree is walked with a pipelined (ordered) traversal and each znode
+is deleted as soon as the walk has moved past its subtree, so children go
+before their parents and only the current branch (plus the requests in
+flight) is kept in memory. The deletes are sent in multi-op batches (kept
+well under the jute buffer limit) with many batches outstanding at a
+time: a session's requests are applied in order, so a batch's parents are
+deleted after the batches with their children.
+
+When a batch fails, its znodes are retried one by one: those which are
+gone already (NoNode) are skipped and those which got new children
+meanwhile (NotEmpty) are walked & deleted again. Znodes whose children
+can't be listed or which can't be deleted (NoAuth) stop the delete.
+
+  Example usage:
+    >>> from kazoo.client import KazooClient
+    >>> from zk_shell.delete import RecursiveDelete
+    >>> zk = KazooClient(hosts)
+    >>> zk.start()
+    >>> RecursiveDelete(zk, "/stale").run()
+    500001
+    >>> zk.stop()
+
+"""
+
+from functools import partial
+import time
+
+from kazoo.exceptions import NoAuthError, NoNodeError, NotEmptyError
+
+from .pipeline import pipelined
+from .traversal import Traversal
+from .util import DEFAULT_MAX_INFLIGHT, DEFAULT_MAX_INFLIGHT_WRITES
+
+
+# each multi stays well under jute.maxbuffer (1MB by default)
+BATCH_BYTES = 512 * 1024
+BATCH_OPS = 256
+
+# serialized size of a delete op within a multi, besides its path
+OP_OVERHEAD = 24
+
+# times a znode that keeps getting new children is walked again
+MAX_RETRIES = 3
+
+# seconds between progress reports
+PROGRESS_INTERVAL = 2.0
+
+
+class RecursiveDelete(object):
+    __slots__ = (
+        "zk", "path", "max_inflight", "max_inflight_writes", "progress",
+        "found", "deleted", "started", "reported"
+    )
+
+    def __init__(self, zk, path, max_inflight=DEFAULT_MAX_INFLIGHT,
+                 max_inflight_writes=DEFAULT_MAX_INFLIGHT_WRITES, progress=None):
+        """
+        :param max_inflight: max outstanding reads while discovering the subtree
+        :param max_inflight_writes: max outstanding delete requests (multis)
+        :param progress: called with (found, deleted, elapsed seconds) every
+                         PROGRESS_INTERVAL seconds while running
+        """
+        self.zk, self.path = zk, path.rstrip("/") or "/"
+        self.max_inflight = max_inflight
+        self.max_inflight_writes = max_inflight_writes
+        self.progress = progress
+        self.found = self.deleted = 0
+        self.started = self.reported = 0
+
+    def run(self):
+        """ deletes path and everything under it, returns the number of deleted znodes """
+        self.found = self.deleted = 0
+        self.started = self.reported = time.time()
+        self._delete_tree(self.path, MAX_RETRIES)
+        return self.deleted
+
+    def _report(self):
+        now = time.time()
+        if self.progress is not None and now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            self.progress(self.found, self.deleted, now - self.started)
+
+    def _delete_tree(self, path, retries):
+        """ deletes path's subtree (and path, unless it's /) """
+        not_empty = self._delete(self._post_order(path))
+
+        # the ancestors of a znode that got new children failed too, walk the topmost ones
+        walked = None
+        for cpath in sorted(not_empty):
+            if walked is not None and cpath.startswith(walked + "/"):
+                continue
+            if retries == 0:
+                raise NotEmptyError("%s keeps getting new children" % cpath)
+            self._delete_tree(cpath, retries - 1)
+            walked = cpath
+
+    def _post_order(self, path):
+        """
+        yields path's subtree (and path, unless it's /) children first: each znode
+        once the walk is past its subtree, so only the current branch is kept
+        """
+        branch = [(path, -1)] if path != "/" else []
+        traversal = Traversal(self.zk, path, max_inflight=self.max_inflight, unlisted=self._unlisted)
+        for node in traversal.get(ordered=True):
+            while branch and branch[-1][1] >= node.level:
+                yield branch.pop()[0]
+            branch.append((node.path, node.level))
+            self.found += 1
+            self._report()
+
+        while branch:
+            yield branch.pop()[0]
+
+    def _unlisted(self, path, ex):
+        # its children would keep it from being deleted, so don't retry it as NotEmpty
+        if isinstance(ex, NoAuthError):
+            raise NoAuthError("Not authorized to list the children of %s" % (path))
+
+    def _batches(self, paths):
+        """ yields (batch, send) for multis with the deletes for paths """
+        batch, size = [], 0
+        for path in paths:
+            psize = len(path) + OP_OVERHEAD
+            if batch and (len(batch) >= BATCH_OPS or size + psize > BATCH_BYTES):
+                yield batch, partial(self._commit, batch)
+                batch, size = [], 0
+            batch.append(path)
+            size += psize
+
+        if batch:
+            yield batch, partial(self._commit, batch)
+
+    def _commit(self, batch):
+        txn = self.zk.transaction()
+        for path in batch:
+            txn.delete(path)
+        return txn.commit_async()
+
+    def _delete(self, paths):
+        """ deletes paths (children first), returns those which got new children meanwhile """
+        failed = []
+        for batch, results, ex in pipelined(self._batches(paths), self.max_inflight_writes):
+            if ex is not None:
+                raise ex
+            if any(isinstance(result, Exception) for result in results):
+                failed.extend(batch)
+            else:
+                self.deleted += len(batch)
+            self._report()
+
+        # a multi is all or nothing, so go through the failed ones one by one (still in order)
+        not_empty = []
+        singles = ((path, partial(self.zk.delete_async, path)) for path in failed)
+        for path, _, ex in pipelined(singles, self.max_inflight_writes):
+            if ex is None:
+                self.deleted += 1
+            elif isinstance(ex, NotEmptyError):
+                not_empty.append(path)
+            elif isinstance(ex, NoAuthError):
+                raise NoAuthError("Not authorized to delete %s" % (path))
+            elif not isinstance(ex, NoNodeError):
+                raise ex
+            self._report()
+
+        return not_empty
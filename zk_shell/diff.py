@@ -0,0 +1,121 @@
+"""
+Streaming two-tree diff
+
+Both subtrees are walked at the same time, in DFS order with sorted
+children, so the two streams can be merged like sorted lists. Content is
+only fetched when the stats can't settle it (same non-zero dataLength),
+and those fetches are pipelined too: results wait in a bounded queue so
+the output keeps the DFS order. Memory is proportional to depth & fan-out
+(plus max_inflight), not to the size of the trees.
+
+  Example usage:
+    >>> from kazoo.client import KazooClient
+    >>> from zk_shell.diff import Diff
+    >>> zk = KazooClient(hosts)
+    >>> zk.start()
+    >>> gen = Diff(zk, "/configs", "/new-configs").get()
+    >>> str([rv_path for rv_path in gen])
+    [
+      (-1, 'service-x/hosts'),
+      (1, 'service-x/hosts.json'),
+      (0, 'service-x/params'),
+    ]
+    >>> zk.stop()
+
+"""
+
+from collections import deque
+
+from kazoo.exceptions import NoAuthError, NoNodeError
+
+from .traversal import STAT, Traversal
+from .util import DEFAULT_MAX_INFLIGHT
+
+
+class Diff(object):
+    __slots__ = ("zk", "path_a", "path_b", "max_inflight")
+
+    def __init__(self, zk, path_a, path_b, max_inflight=DEFAULT_MAX_INFLIGHT):
+        self.zk = zk
+        self.path_a = path_a.rstrip("/") or "/"
+        self.path_b = path_b.rstrip("/") or "/"
+        self.max_inflight = max(max_inflight, 1)
+
+    def walk(self, path):
+        """ yields (components, relative path, stat) in sorted DFS order """
+        offs = 1 if path == "/" else len(path) + 1
+        traversal = Traversal(self.zk, path, needs=STAT, max_inflight=self.max_inflight, sort=True)
+        for node in traversal.get(ordered=True):
+            rel = node.path[offs:]
+            yield tuple(rel.split("/")), rel, node.stat
+
+    def get(self):
+        """
+        For each child, it yields (rv, child) where rv:
+         -1 if doesn't exist in path_b (destination)
+          0 if they are different
+          1 if it doesn't exist in path_a (source)
+        """
+        zk = self.zk
+        path_a, path_b = self.path_a, self.path_b
+        queue = deque()
+
+        def join(path, rel):
+            if rel == "/":
+                return path
+            return path + rel if path == "/" else "%s/%s" % (path, rel)
+
+        def compare(rel, stat_a, stat_b):
+            if stat_a.dataLength != stat_b.dataLength:
+                queue.append((0, rel, None))
+            elif stat_a.dataLength > 0:
+                fetches = (zk.get_async(join(path_a, rel)), zk.get_async(join(path_b, rel)))
+                queue.append((0, rel, fetches))
+
+        def flush(block):
+            while queue:
+                rv, rel, fetches = queue[0]
+                if fetches is not None:
+                    ready = all(fetch.ready() for fetch in fetches)
+                    if not ready and not block and len(queue) < self.max_inflight:
+                        return
+                    try:
+                        (content_a, _), (content_b, _) = [fetch.get() for fetch in fetches]
+                    except (NoNodeError, NoAuthError):
+                        content_a = content_b = None
+                    queue.popleft()
+                    if content_a == content_b:
+                        continue
+                else:
+                    queue.popleft()
+                yield rv, rel
+
+        stat_a = zk.exists(path_a)
+        stat_b = zk.exists(path_b)
+        if not stat_a or not stat_b:
+            return
+
+        compare("/", stat_a, stat_b)
+
+        nodes_a = self.walk(path_a)
+        nodes_b = self.walk(path_b)
+        node_a = next(nodes_a, None)
+        node_b = next(nodes_b, None)
+
+        while node_a is not None or node_b is not None:
+            if node_b is None or (node_a is not None and node_a[0] < node_b[0]):
+                queue.append((-1, node_a[1], None))
+                node_a = next(nodes_a, None)
+            elif node_a is None or node_b[0] < node_a[0]:
+                queue.append((1, node_b[1], None))
+                node_b = next(nodes_b, None)
+            else:
+                compare(node_a[1], node_a[2], node_b[2])
+                node_a = next(nodes_a, None)
+                node_b = next(nodes_b, None)
+
+            for rv_rel in flush(False):
+                yield rv_rel
+
+        for rv_rel in flush(True):
+            yield rv_rel
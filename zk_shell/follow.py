@@ -0,0 +1,230 @@
+"""
+Continuous mirroring, driven by watches
+
+A Follower keeps dst in sync with a zk:// src after mirroring it: a
+SubtreeCache holds a data & a child watch on every src znode, and every
+path it's notified about (or discovers) is marked dirty. Every interval,
+the dirty paths whose refresh was applied are written to (or deleted
+from) dst in one batch, so a burst of changes to the same znodes costs
+one write each. The lag is the time from a change's notification to its
+write to dst.
+
+The watches are armed before the initial mirror, so whatever changes
+while it runs is applied afterwards. Connection losses only delay the
+paths whose reads failed (they're read again once reconnected), but if
+the src session is lost the cache is loaded again and everything is
+mirrored again.
+
+  Example usage:
+    >>> from zk_shell.copy import Proxy
+    >>> from zk_shell.follow import Follower
+    >>> src = Proxy.from_string("zk://10.0.0.1/configs", exists=True, async=True)
+    >>> dst = Proxy.from_string("zk://10.0.1.1/configs", exists=None, async=True)
+    >>> follower = Follower(src, dst)
+    >>> follower.start()
+    >>> for applied in follower.run():
+    ...     print(applied, follower.lag, follower.max_lag)
+    3 0.0121 0.0135
+
+"""
+
+from __future__ import print_function
+
+from functools import partial
+import os
+import time
+
+from kazoo.exceptions import NoAuthError
+from kazoo.protocol.states import KazooState
+
+from .copy import AuthError, ZKProxy
+from .pipeline import pipelined
+from .subtree import LAG_WEIGHT, SubtreeCache
+from .util import DEFAULT_MAX_INFLIGHT
+
+
+# seconds between batches
+DEFAULT_INTERVAL = 0.5
+
+
+class Follower(object):
+    """ mirrors src (a ZKProxy) to dst, then applies its changes as they come """
+    __slots__ = (
+        "src", "dst", "interval", "max_inflight", "verbose", "cache", "dirty", "new",
+        "clients", "batches", "applied", "resyncs", "lag", "max_lag"
+    )
+
+    def __init__(self, src, dst, interval=DEFAULT_INTERVAL, max_inflight=DEFAULT_MAX_INFLIGHT,
+                 verbose=False):
+        self.src, self.dst = src, dst
+        self.interval, self.max_inflight, self.verbose = interval, max_inflight, verbose
+        self.cache = None
+        self.dirty = {}
+        self.new = set()
+        self.clients = []
+        self.batches = self.applied = self.resyncs = 0
+        self.lag = self.max_lag = 0.0
+
+    def start(self):
+        """ connects (once, for the whole run), arms the watches & mirrors everything """
+        for proxy in (self.src, self.dst):
+            if getattr(proxy, "need_client", False):
+                proxy.connect()
+                proxy.need_client = False
+                self.clients.append(proxy.client)
+
+        self.src.client.add_listener(self._state_changed)
+        self.cache = SubtreeCache(self.src.client, self.src.path, self._changed)
+        self._sync()
+
+    def stop(self):
+        """ closes the clients built by start(), the other ones ignore the watches left """
+        self.cache.expired = True
+        self.src.client.remove_listener(self._state_changed)
+        for client in self.clients:
+            client.stop()
+        self.clients = []
+
+    def run(self, batches=0):
+        """
+        applies a batch every interval, yielding the number of paths applied.
+        Runs until interrupted, or for batches intervals if > 0
+        """
+        count = 0
+        while batches <= 0 or count < batches:
+            time.sleep(self.interval)
+            count += 1
+
+            if self.cache.expired:
+                if self.src.client.connected:
+                    self.resyncs += 1
+                    self._sync()
+                continue
+
+            yield self.apply()
+
+    @property
+    def pending(self):
+        """ dirty paths that weren't applied yet """
+        return len(self.dirty)
+
+    def apply(self):
+        """ writes (or deletes) the dirty paths whose refresh was applied """
+        cache = self.cache
+        writes, deletes, firsts = [], [], []
+        held = set()
+        with cache.lock:
+            # parents before their children, which wait while a parent isn't ready
+            for path in sorted(self.dirty, key=lambda p: (p.count("/"), p)):
+                znode = cache.znodes.get(path)
+                if path in cache.pending or (znode is not None and znode.value is None) or \
+                   self._parent_held(path, held):
+                    held.add(path)
+                    continue
+
+                firsts.append(self.dirty.pop(path))
+                new = path in self.new
+                self.new.discard(path)
+                if znode is None:
+                    deletes.append(path)
+                elif znode.value[1].ephemeralOwner == 0:
+                    writes.append((path, znode.value[0], new))
+
+        if not firsts:
+            return 0
+
+        with self.dst:
+            self._write(writes)
+            self._delete(deletes)
+
+        now = time.time()
+        for first in firsts:
+            lag = now - first
+            self.lag += LAG_WEIGHT * (lag - self.lag)
+            self.max_lag = max(self.max_lag, lag)
+
+        self.batches += 1
+        self.applied += len(firsts)
+        return len(firsts)
+
+    def _parent_held(self, path, held):
+        while path != self.src.path and path != "/":
+            path = os.path.dirname(path)
+            if path in held:
+                return True
+        return False
+
+    def _sync(self):
+        with self.cache.lock:
+            self.dirty.clear()
+            self.new.clear()
+        self.cache.load(self.max_inflight)
+        self.src.copy(self.dst, True, 0, True)
+
+    def _rel(self, path):
+        if path == self.src.path:
+            return ""
+        return path[1 if self.src.path == "/" else len(self.src.path) + 1:]
+
+    def _write(self, writes):
+        """ ACLs are read along (dsts other than zk:// store them as given) """
+        zk = self.src.client
+        requests = ((path, partial(zk.get_acls_async, path)) for path, _, _ in writes)
+        acls = {}
+        for path, value, ex in pipelined(requests, self.max_inflight):
+            if isinstance(ex, NoAuthError):
+                raise AuthError("read", path)
+            # if it's gone, it's dirty again
+            if ex is None:
+                acls[path] = value[0]
+
+        # znodes that were notified about (rather than discovered) are in dst already
+        existing = set()
+        values = []
+        for path, data, new in writes:
+            if path not in acls:
+                continue
+            rel = self._rel(path)
+            if not new:
+                existing.add(rel)
+            values.append((rel, ZKProxy.ZKPathValue(data, acls[path])))
+
+        if values and values[0][0] == "":
+            self.dst.write_path(values.pop(0)[1])
+            self._report("", "Wrote")
+
+        for rel in self.dst.write_paths(values, existing):
+            self._report(rel, "Wrote")
+
+    def _delete(self, deletes):
+        dst = self.dst
+        url = dst.url
+        deleted = None
+        for path in sorted(deletes):
+            if deleted is not None and path.startswith(deleted + "/"):
+                continue
+            rel = self._rel(path)
+            dst.set_url(os.path.join(url, rel) if rel else url)
+            try:
+                dst.delete_path_recursively()
+            finally:
+                dst.set_url(url)
+            self._report(rel, "Deleted")
+            deleted = path
+
+    def _report(self, rel, action):
+        if self.verbose:
+            print("%s %s" % (action, os.path.join(self.dst.url, rel) if rel else self.dst.url))
+
+    def _changed(self, path, new):
+        """ called by the cache, with its lock held """
+        self.dirty.setdefault(path, time.time())
+        if new:
+            self.new.add(path)
+
+    def _state_changed(self, state):
+        # the watches are gone along with the session
+        if state == KazooState.LOST:
+            self.cache.expired = True
+        elif state == KazooState.CONNECTED:
+            self.cache.reconnected()
@@ -0,0 +1,153 @@
+"""
+Parallel grep over a subtree's values
+
+Values are fetched with pipelined requests (like PathMap) and matched
+line by line. Small greps are matched inline; once values are large or
+numerous enough to fill a batch, matching is handed to a pool of worker
+processes so the regexp work runs on all cores.
+
+  Example usage:
+    >>> from kazoo.client import KazooClient
+    >>> from zk_shell.grep import Grep
+    >>> zk = KazooClient(hosts)
+    >>> zk.start()
+    >>> gen = Grep(zk, "/configs", "10000").get()
+    >>> str([pm for pm in gen])
+    [
+      ('/configs/ports', ['10000, 11000']),
+    ]
+    >>> zk.stop()
+
+"""
+
+from collections import deque
+import multiprocessing
+import re
+
+from kazoo.exceptions import KazooException
+
+from .traversal import DATA, Traversal
+from .util import DEFAULT_MAX_INFLIGHT
+
+
+# a batch is handed to a worker once it has this many values or bytes
+BATCH_VALUES = 256
+BATCH_BYTES = 1 << 20
+
+
+def matching_lines(match, data):
+    """ the lines in data (bytes) which match """
+    value = data.decode("utf-8", "replace")
+    return [line for line in value.split("\n") if match.search(line)]
+
+
+def match_batch(match, batch):
+    """ returns [(path, matching lines), ...] for the paths in batch that match """
+    results = []
+    for path, data in batch:
+        matches = matching_lines(match, data)
+        if len(matches) > 0:
+            results.append((path, matches))
+    return results
+
+
+_worker_match = None
+
+
+def _init_worker(pattern, flags):
+    global _worker_match
+    _worker_match = re.compile(pattern, flags)
+
+
+def _worker_match_batch(batch):
+    return match_batch(_worker_match, batch)
+
+
+class Grep(object):
+    __slots__ = ("zk", "path", "match", "workers", "max_inflight", "checkpoint")
+
+    def __init__(self, zk, path, match, workers=0, max_inflight=DEFAULT_MAX_INFLIGHT,
+                 checkpoint=None):
+        """
+        :param match: a compiled regexp (or a pattern)
+        :param workers: max number of matching processes (0 is one per CPU, 1 means inline)
+        :param checkpoint: a Checkpoint for the traversal (unordered only)
+        """
+        self.zk, self.path = zk, path
+        self.match = re.compile(match) if not hasattr(match, "search") else match
+        self.workers = workers if workers > 0 else multiprocessing.cpu_count()
+        self.max_inflight = max_inflight
+        self.checkpoint = checkpoint
+
+    def get(self, ordered=False):
+        """
+        yields (path, matching lines) as matches are found. If ordered is True,
+        results follow the DFS order (like XClient.tree()).
+        """
+        results = deque()
+        batch, batch_bytes = [], 0
+        checkpoint = self.checkpoint if not ordered else None
+        # values are batched, so the checkpoint is saved here once they've been matched
+        traversal = Traversal(self.zk, self.path, needs=DATA, max_inflight=self.max_inflight,
+                              checkpoint=checkpoint, autosave=False)
+
+        pool = None
+        failure = None
+        try:
+            try:
+                for node in traversal.get(ordered):
+                    if node.data is None:
+                        continue
+
+                    batch.append((node.path, node.data))
+                    batch_bytes += len(node.data)
+
+                    # the checkpoint can only be saved once every pending value's been matched
+                    flush = checkpoint is not None and checkpoint.due()
+                    if len(batch) < BATCH_VALUES and batch_bytes < BATCH_BYTES and not flush:
+                        continue
+
+                    if pool is None and self.workers > 1:
+                        pool = multiprocessing.Pool(
+                            self.workers, _init_worker, (self.match.pattern, self.match.flags))
+
+                    if pool is None:
+                        for result in match_batch(self.match, batch):
+                            yield result
+                    else:
+                        results.append(pool.apply_async(_worker_match_batch, (batch,)))
+
+                        # stream whatever is ready, but don't let pending batches pile up
+                        while results and (results[0].ready() or len(results) > 2 * self.workers):
+                            for result in results.popleft().get():
+                                yield result
+
+                        if not ordered:
+                            for pending in [r for r in results if r.ready()]:
+                                results.remove(pending)
+                                for result in pending.get():
+                                    yield result
+
+                        while flush and results:
+                            for result in results.popleft().get():
+                                yield result
+
+                    batch, batch_bytes = [], 0
+                    if flush:
+                        traversal.save()
+            except KazooException as ex:
+                # the checkpoint saved by the traversal counts on these being handled
+                failure = ex
+
+            while results:
+                for result in results.popleft().get():
+                    yield result
+
+            for result in match_batch(self.match, batch):
+                yield result
+
+            if failure is not None:
+                raise failure
+        finally:
+            if pool is not None:
+                pool.terminate()
@@ -0,0 +1,48 @@
+"""
+Pipelined async requests with a bounded window
+
+  Example usage:
+    >>> from functools import partial
+    >>> from kazoo.client import KazooClient
+    >>> from zk_shell.pipeline import pipelined
+    >>> zk = KazooClient(hosts)
+    >>> zk.start()
+    >>> paths = ["/a", "/b", "/c"]
+    >>> reqs = ((path, partial(zk.delete_async, path)) for path in paths)
+    >>> str([(path, ex) for path, _, ex in pipelined(reqs, 100) if ex])
+    [
+      ('/b', NoNodeError()),
+    ]
+    >>> zk.stop()
+
+"""
+
+from collections import deque
+
+from kazoo.exceptions import ZookeeperError
+
+
+def collect(key, result):
+    """ waits for result and returns (key, value, exception) """
+    try:
+        return key, result.get(), None
+    except ZookeeperError as ex:
+        return key, None, ex
+
+
+def pipelined(requests, max_inflight):
+    """
+    sends the requests given by requests, an iterable of (key, send) where
+    send() returns an async result, keeping up to max_inflight of them
+    outstanding. Yields (key, value, exception) in the order they were sent.
+    """
+    pending = deque()
+    max_inflight = max(max_inflight, 1)
+
+    for key, send in requests:
+        if len(pending) >= max_inflight:
+            yield collect(*pending.popleft())
+        pending.append((key, send()))
+
+    while pending:
+        yield collect(*pending.popleft())
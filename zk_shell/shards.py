@@ -0,0 +1,132 @@
+"""
+Sharded reads over extra sessions
+
+A scan through a single session is limited by one server's request queue
+and one TCP stream. ReadSessions opens extra read-only sessions, each one
+preferring a different member of the ensemble, and ShardedReader splits
+the top-level subtrees (relative to where the scan starts) among them.
+ShardedReader quacks like a client, so it can be handed to any of the
+async builders and their results come out as a single stream.
+
+  Example usage:
+    >>> from zk_shell.shards import ReadSessions
+    >>> from zk_shell.usage import Usage
+    >>> from zk_shell.xclient import XClient
+    >>> zk = XClient(hosts)
+    >>> zk.start()
+    >>> sessions = ReadSessions(zk)
+    >>> sessions.resize(4)
+    4
+    >>> Usage(sessions.reader("/"), "/").value
+    1073741824
+    >>> sessions.resize(0)
+    0
+    >>> zk.stop()
+
+"""
+
+import zlib
+
+from .util import to_bytes
+
+
+class ShardedReader(object):
+    """ routes reads under path to a session per top-level subtree """
+    __slots__ = ("zk", "sessions", "path", "offs")
+
+    def __init__(self, zk, sessions, path):
+        """
+        :param zk: the main client, used for path itself & anything else
+        :param sessions: the clients the subtrees are split among
+        """
+        self.zk, self.sessions = zk, sessions
+        self.path = path.rstrip("/") or "/"
+        self.offs = 1 if self.path == "/" else len(self.path) + 1
+
+    def session(self, path):
+        """ the client for path """
+        if len(path) <= self.offs or not path.startswith(self.path):
+            return self.zk
+        top = path[self.offs:].split("/", 1)[0]
+        return self.sessions[(zlib.crc32(to_bytes(top)) & 0xffffffff) % len(self.sessions)]
+
+    def exists_async(self, path, *args, **kwargs):
+        return self.session(path).exists_async(path, *args, **kwargs)
+
+    def get_async(self, path, *args, **kwargs):
+        return self.session(path).get_async(path, *args, **kwargs)
+
+    def get_children_async(self, path, *args, **kwargs):
+        return self.session(path).get_children_async(path, *args, **kwargs)
+
+    def scan_children_async(self, path, *args, **kwargs):
+        session = self.session(path)
+        scan = getattr(session, "scan_children_async", session.get_children_async)
+        return scan(path, *args, **kwargs)
+
+    def get_acls_async(self, path, *args, **kwargs):
+        return self.session(path).get_acls_async(path, *args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.zk, attr)
+
+
+class ReadSessions(object):
+    """ extra read-only sessions, spread across the ensemble's members """
+    __slots__ = ("zk", "count", "clients")
+
+    def __init__(self, zk):
+        self.zk = zk
+        self.count = 0
+        self.clients = []
+
+    def __len__(self):
+        return len(self.clients)
+
+    def hosts(self, i):
+        """ a connect string for the i-th session, with its own preferred member """
+        members = sorted(set(self.zk.hosts))
+        first = i % len(members)
+        hosts = ",".join("%s:%s" % hp for hp in members[first:] + members[:first])
+        return hosts + (self.zk.chroot or "")
+
+    def resize(self, count, timeout=10.0):
+        """ (re)opens count sessions (0 closes them all), returns how many are connected """
+        if count == self.count:
+            return len(self.clients)
+
+        self.close()
+        self.count = count
+        for i in range(0, count):
+            client = self.zk.__class__(
+                self.hosts(i),
+                timeout=self.zk.session_timeout / 1000.0,
+                read_only=True,
+                randomize_hosts=False,
+                auth_data=set(self.zk.auth_data))
+            try:
+                client.start(timeout=timeout)
+            except client.handler.timeout_exception:
+                client.close()
+                continue
+            self.clients.append(client)
+
+        return len(self.clients)
+
+    def close(self):
+        for client in self.clients:
+            client.stop()
+            client.close()
+        self.count = 0
+        self.clients = []
+
+    def reader(self, path):
+        """ a client-like object for scanning path, or the main client if there are no sessions """
+        if len(self.clients) == 0:
+            return self.zk
+
+        # make the other members catch up with what the main session has seen
+        for sync in [client.sync_async(path) for client in self.clients]:
+            sync.get()
+
+        return ShardedReader(self.zk, [self.zk] + self.clients, path)
@@ -10,6 +10,7 @@ from functools import partial, wraps
 from threading import Thread
 
 import bisect
+import hashlib
 import json
 import os
 import re
@@ -68,12 +69,22 @@ from xcmd.xcmd import (
 )
 
 from .acl import ACLReader
+from .cache import DEFAULT_CHILDREN_CACHE_SIZE, DEFAULT_PATH_CACHE_SIZE
+from .checkpoint import Checkpoint
 from .copy import CopyError, Proxy
+from .follow import DEFAULT_INTERVAL, Follower
 from .keys import Keys
 from .pathmap import PathMap
+from .snapshot import SnapshotClient, SnapshotError
+from .sorting import DEFAULT_SORT_BUFFER_SIZE, external_sort, top
+from .txnlog import read_txns, replay, TxnLogError, TxnStats
 from .watcher import get_child_watcher
+from .watermark import IncrementalMirror, Watermarks
 from .watch_manager import get_watch_manager
+from .window import AdaptiveWindow, DEFAULT_RETRIES, Window
 from .util import (
+    DEFAULT_MAX_INFLIGHT,
+    DEFAULT_MAX_INFLIGHT_WRITES,
     decoded,
     find_outliers,
     get_ips,
@@ -84,12 +95,38 @@ from .util import (
     pretty_bytes,
     split,
     to_bool,
+    to_bytes,
     to_int,
     which
 )
 from .xclient import XClient
 
 
+# retried paths listed after a scan
+MAX_REPORTED_RETRIES = 10
+
+# summary's sort keys, for (path, stat) results
+SUMMARY_KEYS = {
+    "name": lambda item: item[0],
+    "ctime": lambda item: (item[1].ctime, item[0]),
+    "mtime": lambda item: (item[1].mtime, item[0]),
+    "dataLength": lambda item: (item[1].dataLength, item[0]),
+    "numChildren": lambda item: (item[1].numChildren, item[0]),
+    "owner": lambda item: (item[1].ephemeralOwner, item[0]),
+}
+
+# approximate bytes used by a ZnodeStat (11 ints)
+STAT_SIZE = 256
+
+# between the batches applied by mirror with follow
+DEFAULT_FOLLOW_INTERVAL_MS = int(DEFAULT_INTERVAL * 1000)
+
+
+def summary_entry_size(item):
+    """ approximate bytes used by a (path, stat) result """
+    return sys.getsizeof(item[0]) + STAT_SIZE
+
+
 def connected(func):
     """ check connected, fails otherwise """
     @wraps(func)
@@ -99,6 +136,7 @@ def connected(func):
             self.show_output("Not connected.")
         else:
             try:
+                self.client.subtrees.mark_stale()
                 return func(*args, **kwargs)
             except APIError:
                 self.show_output("ZooKeeper internal error.")
@@ -138,7 +176,7 @@ def check_path_exists_foreach(path_params, func):
                 resolved = []
                 for path in paths:
                     path = self.resolve_path(path)
-                    if not self.client.exists(path):
+                    if not self.path_cache.exists(path):
                         self.show_output("Path %s doesn't exist", path)
                         return False
                     resolved.append(path)
@@ -175,7 +213,7 @@ def check_path_absent(func):
         orig_path = params.path
         sequence = getattr(params, 'sequence', False)
         params.path = self.resolve_path(params.path)
-        if self.in_transaction or sequence or not self.client.exists(params.path):
+        if self.in_transaction or sequence or not self.path_cache.exists(params.path):
             if sequence and orig_path.endswith("/") and params.path != "/":
                 params.path += "/"
             return func(self, params)
@@ -202,6 +240,7 @@ def json_deserialize(data):
 # pylint: disable=R0904
 class Shell(XCmd):
     CONF_PATH = os.path.join(os.environ["HOME"], ".zk_shell")
+    CHECKPOINTS_PATH = os.path.join(os.environ["HOME"], ".zk_shell_checkpoints")
     DEFAULT_CONF = Conf(
         ConfVar(
             "chkzk_stat_retries",
@@ -232,6 +271,61 @@ class Shell(XCmd):
             "chkzk_zxid_delta",
             "Difference in zxids to claim inconsistency between servers",
             200
+        ),
+        ConfVar(
+            "traversal_max_inflight",
+            "Max outstanding requests when walking a tree (du, find, summary, json_*)",
+            DEFAULT_MAX_INFLIGHT
+        ),
+        ConfVar(
+            "traversal_target_latency",
+            "Adapt the outstanding requests of scans to this latency, in ms (0 is off)",
+            0
+        ),
+        ConfVar(
+            "traversal_verbose",
+            "Report the concurrency & latency of scans every few seconds (0 or 1)",
+            0
+        ),
+        ConfVar(
+            "traversal_retries",
+            "Times a scan can re-send the request for a znode after connection losses",
+            DEFAULT_RETRIES
+        ),
+        ConfVar(
+            "traversal_sessions",
+            "Extra read-only sessions that split du, find, grep, summary & json_* scans (0 is off)",
+            0
+        ),
+        ConfVar(
+            "traversal_children_cache",
+            "Children names of big lists kept between scans, fetched again only if changed (0 is off)",
+            DEFAULT_CHILDREN_CACHE_SIZE
+        ),
+        ConfVar(
+            "write_max_inflight",
+            "Max outstanding write requests for recursive commands (set_acls, rmr, async cp & mirror)",
+            DEFAULT_MAX_INFLIGHT_WRITES
+        ),
+        ConfVar(
+            "path_cache_size",
+            "Children lists (and existence checks) cached for completion & path checks (0 is off)",
+            DEFAULT_PATH_CACHE_SIZE
+        ),
+        ConfVar(
+            "sort_buffer_size",
+            "Bytes of results sorted in memory (i.e.: by summary) before spilling to disk",
+            DEFAULT_SORT_BUFFER_SIZE
+        ),
+        ConfVar(
+            "grep_workers",
+            "Processes used to match values in grep & igrep (0 is one per CPU)",
+            0
+        ),
+        ConfVar(
+            "follow_interval",
+            "Milliseconds between the batches of changes applied by mirror with follow",
+            DEFAULT_FOLLOW_INTERVAL_MS
         )
     )
 
@@ -272,17 +366,18 @@ class Shell(XCmd):
                 cmd_param = cmd_param_text
             path = cmd_param.rstrip("/") if cmd_param != "/" else "/"
 
+        cache = self.path_cache
         if re.match(r"^\s*$", path):
-            return self._zk.get_children(self.curdir)
+            return cache.get_children(self.curdir)
 
         rpath = self.resolve_path(path)
-        if self._zk.exists(rpath):
-            opts = [os.path.join(path, znode) for znode in self._zk.get_children(rpath)]
+        if cache.exists(rpath):
+            opts = [os.path.join(path, znode) for znode in cache.get_children(rpath)]
         else:
             parent, child = os.path.dirname(rpath), os.path.basename(rpath)
             relpath = os.path.dirname(path)
             to_rel = lambda n: os.path.join(relpath, n) if relpath != "" else n
-            opts = [to_rel(n) for n in self._zk.get_children(parent) if n.startswith(child)]
+            opts = [to_rel(n) for n in cache.get_children(parent) if n.startswith(child)]
 
         offs = len(cmd_param) - len(cmd_param_text)
         return [opt[offs:] for opt in opts]
@@ -292,6 +387,76 @@ class Shell(XCmd):
         """ the connected ZK client, if any """
         return self._zk
 
+    @property
+    def path_cache(self):
+        """ the client's PathCache, sized by path_cache_size """
+        cache = self._zk.path_cache
+        cache.resize(self._conf.get_int("path_cache_size", DEFAULT_PATH_CACHE_SIZE))
+        return cache
+
+    @property
+    def max_inflight(self):
+        """ max outstanding requests for the async tree builders """
+        return self._conf.get_int("traversal_max_inflight", DEFAULT_MAX_INFLIGHT)
+
+    def _scan_window(self):
+        """
+        opens the extra read sessions (if any), sizes the children cache and
+        returns the Window for a scan: adaptive if traversal_target_latency is
+        set, with traversal_retries retries
+        """
+        self._open_read_sessions()
+        self._zk.set_children_cache_size(
+            self._conf.get_int("traversal_children_cache", DEFAULT_CHILDREN_CACHE_SIZE))
+
+        report = None
+        if self._conf.get_int("traversal_verbose", 0) > 0:
+            report = lambda limit, latency: self.show_output(
+                "concurrency: %d, latency: %.1fms", limit, latency * 1000)
+
+        retries = self._conf.get_int("traversal_retries", DEFAULT_RETRIES)
+        target = self._conf.get_int("traversal_target_latency", 0)
+        if target > 0:
+            return AdaptiveWindow(self.max_inflight, target / 1000.0, report=report, retries=retries)
+
+        return Window(self.max_inflight, report, retries)
+
+    def _report_retries(self, window):
+        """ the requests a scan had to re-send, if any """
+        if len(window.retried) == 0:
+            return
+
+        paths = sorted(window.retried)
+        self.show_output("Re-sent %d request(s) after connection losses, for:",
+                         sum(window.retried.values()))
+        for path in paths[:MAX_REPORTED_RETRIES]:
+            self.show_output("  %s", path)
+        if len(paths) > MAX_REPORTED_RETRIES:
+            self.show_output("  ... and %d more", len(paths) - MAX_REPORTED_RETRIES)
+
+    def _checkpoint(self, resume, *key):
+        """ the Checkpoint for the command identified by key, loaded if resume is set """
+        if not os.path.isdir(self.CHECKPOINTS_PATH):
+            os.makedirs(self.CHECKPOINTS_PATH)
+
+        name = hashlib.md5(to_bytes(repr(key))).hexdigest()
+        checkpoint = Checkpoint(os.path.join(self.CHECKPOINTS_PATH, "%s.json" % name), resume)
+        if checkpoint.resumed:
+            self.show_output("Resuming from %s.", checkpoint.filename)
+        elif resume:
+            self.show_output("No checkpoint to resume from, starting over.")
+
+        return checkpoint
+
+    def _open_read_sessions(self):
+        """ opens (or closes) the extra sessions for scans, see traversal_sessions """
+        self._zk.set_read_sessions(self._conf.get_int("traversal_sessions", 0))
+
+    @property
+    def max_inflight_writes(self):
+        """ max outstanding writes for recursive commands """
+        return self._conf.get_int("write_max_inflight", DEFAULT_MAX_INFLIGHT_WRITES)
+
     @property
     def server_endpoint(self):
         """ the literal endpoint for the currently connected server """
@@ -329,7 +494,8 @@ class Shell(XCmd):
         set_acls <path> <acls> [recursive]
 
 \x1b[1mOPTIONS\x1b[0m
-        * recursive: recursively set the acls on the children
+        * recursive: recursively set the acls on the children (requests are pipelined,
+                     see write_max_inflight; failures are reported at the end)
 
 \x1b[1mEXAMPLES\x1b[0m
         > set_acls /some/path 'world:anyone:r digest:user:aRxISyaKnTP2+OZ9OmQLkq04bvo=:cdrwa'
@@ -349,11 +515,22 @@ class Shell(XCmd):
             except (NoNodeError, BadVersionError, InvalidACLError, ZookeeperError) as ex:
                 self.show_output("Failed to set ACLs: %s. Error: %s", str(acls), str(ex))
 
-        if params.recursive:
-            for cpath, _ in self._zk.tree(params.path, 0, full_path=True):
-                set_acls(cpath)
+        if not params.recursive:
+            set_acls(params.path)
+            return
 
-        set_acls(params.path)
+        unlisted = []
+        failed = list(self._zk.set_acls_recursive(
+            params.path, acls, self.max_inflight_writes, unlisted))
+        if len(failed) > 0:
+            self.show_output("Failed to set ACLs: %s on %d path(s):", str(acls), len(failed))
+            for path, ex in failed:
+                self.show_output("  %s: %s", path, str(ex))
+        if len(unlisted) > 0:
+            self.show_output("Couldn't list the children of %d path(s), so they were skipped:",
+                             len(unlisted))
+            for path, ex in unlisted:
+                self.show_output("  %s: %s", path, str(ex))
 
     def complete_set_acls(self, cmd_param_text, full_cmd, *rest):
         """ FIXME: complete inside a quoted param is broken """
@@ -403,7 +580,9 @@ class Shell(XCmd):
             except ValueError:
                 pass
 
-        for path, acls in self._zk.get_acls_recursive(params.path, params.depth, params.ephemerals):
+        acls_by_path = self._zk.get_acls_recursive(
+            params.path, params.depth, params.ephemerals, self.max_inflight)
+        for path, acls in acls_by_path:
             replace(acls, READ_ACL_UNSAFE[0], "WORLD_READ")
             replace(acls, OPEN_ACL_UNSAFE[0], "WORLD_ALL")
             self.show_output("%s: %s", path, acls)
@@ -517,6 +696,87 @@ class Shell(XCmd):
         completers = [complete_cmd, self._complete_path, complete_boolean, complete_sleep]
         return complete(completers, cmd_param_text, full_cmd, *rest)
 
+    @connected
+    @ensure_params(Required("command"), Optional("path", ""))
+    def do_cache(self, params):
+        """
+\x1b[1mNAME\x1b[0m
+        cache - Mirror a subtree in memory, kept current via watches
+
+\x1b[1mSYNOPSIS\x1b[0m
+        cache <start|stop|stats> [path]
+
+\x1b[1mDESCRIPTION\x1b[0m
+        cache start <path>
+
+        loads the subtree with pipelined reads and keeps it current from
+        watch events. From then on, reads under path (ls, get, exists, stat,
+        find, grep, json_*, summary...) are answered from memory, unless a
+        change is being fetched (or a watch is requested).
+
+        cache stop <path>
+
+        cache stats [path]
+
+        shows the memory used, the lag between a change being notified and
+        applied and the hit rate for each cached subtree (or just path's).
+
+\x1b[1mEXAMPLES\x1b[0m
+        > cache start /services/registrations
+        Cached 12083 znodes under /services/registrations in 0.84 secs.
+        > cache stats
+        /services/registrations:
+          znodes: 12083
+          memory: 9.1MB
+          events: 17 (0 pending)
+          lag: 1.30 ms (max: 4.02 ms)
+          hits: 2205 (98.6%)
+          misses: 31
+        > cache stop /services/registrations
+
+        """
+        subtrees = self._zk.subtrees
+        if params.command == "start":
+            path = self.resolve_path(params.path or ".")
+            if not self._zk.exists(path):
+                self.show_output("Path %s doesn't exist", path)
+                return
+            try:
+                count = subtrees.start(path, self.max_inflight)
+            except ValueError as ex:
+                self.show_output(str(ex))
+                return
+            self.show_output("Cached %d znodes under %s in %.2f secs.",
+                             count, path, subtrees.get(path).loaded_in)
+        elif params.command == "stop":
+            path = self.resolve_path(params.path or ".")
+            if not subtrees.stop(path):
+                self.show_output("%s is not cached", path)
+        elif params.command == "stats":
+            path = self.resolve_path(params.path) if params.path else None
+            caches = [c for c in subtrees if path is None or c.path == path]
+            if len(caches) == 0 and path is None:
+                self.show_output("Nothing is cached")
+            elif len(caches) == 0:
+                self.show_output("%s is not cached", path)
+            for cache in caches:
+                lookups = cache.hits + cache.misses
+                self.show_output("%s:%s", cache.path, " (expired)" if cache.expired else "")
+                self.show_output("  znodes: %d", len(cache.znodes))
+                self.show_output("  memory: %s", pretty_bytes(cache.size()))
+                self.show_output("  events: %d (%d pending)", cache.events, len(cache.pending))
+                self.show_output("  lag: %.2f ms (max: %.2f ms)", cache.lag * 1000, cache.max_lag * 1000)
+                self.show_output("  hits: %d (%.1f%%)",
+                                 cache.hits, 100.0 * cache.hits / lookups if lookups else 0)
+                self.show_output("  misses: %d", cache.misses)
+        else:
+            self.show_output("cache <start|stop|stats> [path]")
+
+    def complete_cache(self, cmd_param_text, full_cmd, *rest):
+        complete_cmd = partial(complete_values, ["start", "stats", "stop"])
+        completers = [complete_cmd, self._complete_path]
+        return complete(completers, cmd_param_text, full_cmd, *rest)
+
     @ensure_params(
         Required("src"),
         Required("dst"),
@@ -524,7 +784,8 @@ class Shell(XCmd):
         LabeledBooleanOptional("overwrite"),
         LabeledBooleanOptional("async"),
         LabeledBooleanOptional("verbose"),
-        IntegerOptional("max_items", 0)
+        IntegerOptional("max_items", 0),
+        LabeledBooleanOptional("resume")
     )
     def do_cp(self, params):
         """
@@ -532,7 +793,7 @@ class Shell(XCmd):
         cp - Copy from/to local/remote or remote/remote paths
 
 \x1b[1mSYNOPSIS\x1b[0m
-        cp <src> <dst> [recursive] [overwrite] [async] [verbose] [max_items]
+        cp <src> <dst> [recursive] [overwrite] [async] [verbose] [max_items] [resume]
 
 \x1b[1mDESCRIPTION\x1b[0m
         src and dst can be:
@@ -541,6 +802,7 @@ class Shell(XCmd):
            zk://[scheme:user:passwd@]host/<path>
            json://!some!path!backup.json/some/path
            file:///some/file
+           snapshot://!some!path!snapshot.1a2b/some/path (read-only)
 
         with a few restrictions. Given the semantic differences that znodes have with filesystem
         directories recursive copying from znodes to an fs could lose data, but to a JSON file it
@@ -549,9 +811,11 @@ class Shell(XCmd):
 \x1b[1mOPTIONS\x1b[0m
         * recursive: recursively copy src (default: false)
         * overwrite: overwrite the dst path (default: false)
-        * async: do asyncronous copies (default: false)
+        * async: pipeline the reads & writes of zk:// paths (see traversal_max_inflight
+                 & write_max_inflight) (default: false)
         * verbose: verbose output of every path (default: false)
         * max_items: max number of paths to copy (0 is infinite) (default: 0)
+        * resume: continue an async recursive copy from its last checkpoint (default: false)
 
 \x1b[1mEXAMPLES\x1b[0m
         > cp /some/znode /backup/copy-znode  # local
@@ -574,7 +838,8 @@ class Shell(XCmd):
             complete_labeled_boolean("overwrite"),
             complete_labeled_boolean("async"),
             complete_labeled_boolean("verbose"),
-            complete_max
+            complete_max,
+            complete_labeled_boolean("resume")
         ]
         return complete(completers, cmd_param_text, full_cmd, *rest)
 
@@ -583,7 +848,10 @@ class Shell(XCmd):
         Required("dst"),
         LabeledBooleanOptional("async"),
         LabeledBooleanOptional("verbose"),
-        LabeledBooleanOptional("skip_prompt")
+        LabeledBooleanOptional("skip_prompt"),
+        LabeledBooleanOptional("resume"),
+        Optional("watermark", ""),
+        LabeledBooleanOptional("follow")
     )
     def do_mirror(self, params):
         """
@@ -591,7 +859,7 @@ class Shell(XCmd):
         mirror - Mirrors from/to local/remote or remote/remote paths
 
 \x1b[1mSYNOPSIS\x1b[0m
-        mirror <src> <dst> [async] [verbose] [skip_prompt]
+        mirror <src> <dst> [async] [verbose] [skip_prompt] [resume] [watermark] [follow]
 
 \x1b[1mDESCRIPTION\x1b[0m
         src and dst can be:
@@ -599,6 +867,7 @@ class Shell(XCmd):
            /some/path (in the connected server)
            zk://[user:passwd@]host/<path>
            json://!some!path!backup.json/some/path
+           snapshot://!some!path!snapshot.1a2b/some/path (src only)
 
         with a few restrictions. Given the semantic differences that znodes have with filesystem
         directories recursive copying from znodes to an fs could lose data, but to a JSON file it
@@ -607,14 +876,33 @@ class Shell(XCmd):
         The dst subtree will be modified to look the same as the src subtree with the exception
         of ephemeral nodes.
 
+        With watermark (a local file), the mzxid & pzxid of every src znode are saved after
+        mirroring and the next runs only read the values (and children lists) that changed
+        since then, and only write those to dst. The dst subtree must only be changed by these
+        mirrors. A zk:// src is needed.
+
+        With follow, a data & a child watch are set on every src znode before mirroring and,
+        once it's done, the changes they notify about are applied to dst in batches (every
+        follow_interval ms, so a burst of changes to a znode costs a single write) until
+        interrupted. The replication lag (from notification to write) is reported after each
+        batch. A zk:// src is needed too, and the subtree is kept in memory.
+
 \x1b[1mOPTIONS\x1b[0m
-        * async: do asyncronous copies (default: false)
+        * async: pipeline the reads & writes of zk:// paths (see traversal_max_inflight
+                 & write_max_inflight) (default: false)
         * verbose: verbose output of every path (default: false)
         * skip_prompt: don't ask for confirmation (default: false)
+        * resume: continue an async mirror from its last checkpoint (default: false)
+        * watermark: the state file for incremental mirrors (default: none)
+        * follow: keep applying the changes to src (default: false)
 
 \x1b[1mEXAMPLES\x1b[0m
         > mirror /some/znode /backup/copy-znode  # local
         > mirror /some/path json://!home!user!backup.json/ true true
+        > mirror /configs zk://10.0.1.1/configs true false true false /var/lib/configs.mirror
+        > mirror /configs zk://10.0.1.1/configs true false true false '' follow=true
+        Mirroring (asynchronously) from zk://10.0.0.1/configs to zk://10.0.1.1/configs
+        Applied 3 changes (pending: 0, lag: 0.012 secs, max lag: 0.014 secs)
 
         """
         question = "Are you sure you want to replace %s with %s?" % (params.dst, params.src)
@@ -627,7 +915,10 @@ class Shell(XCmd):
             self._complete_path,
             complete_labeled_boolean("async"),
             complete_labeled_boolean("verbose"),
-            complete_labeled_boolean("skip_prompt")
+            complete_labeled_boolean("skip_prompt"),
+            complete_labeled_boolean("resume"),
+            partial(complete_values, []),
+            complete_labeled_boolean("follow")
         ]
         return complete(completers, cmd_param_text, full_cmd, *rest)
 
@@ -657,6 +948,7 @@ class Shell(XCmd):
                 raise CopyError("Mirroring must not have a max items limit", True)
 
             src = Proxy.from_string(params.src, True, params.async, params.verbose)
+            src.max_inflight = self.max_inflight
             if src_connected_zk:
                 src.need_client = False
                 src.client = self._zk
@@ -665,11 +957,24 @@ class Shell(XCmd):
                                     exists=None if overwrite else False,
                                     async=params.async,
                                     verbose=params.verbose)
+            dst.max_inflight_writes = self.max_inflight_writes
             if dst_connected_zk:
                 dst.need_client = False
                 dst.client = self._zk
 
-            src.copy(dst, recursive, max_items, mirror)
+            watermark = getattr(params, "watermark", "")
+            if getattr(params, "follow", False):
+                self._follow(src, dst, watermark, params.resume)
+                return
+
+            if watermark:
+                self._mirror_incrementally(src, dst, watermark, params.resume)
+                return
+
+            checkpoint = self._checkpoint(
+                params.resume, "copy", params.src, params.dst, recursive, max_items, mirror)
+            src.copy(dst, recursive, max_items, mirror, checkpoint)
+            checkpoint.remove()
         except CopyError as ex:
             if ex.is_early_error:
                 msg = str(ex)
@@ -682,6 +987,235 @@ class Shell(XCmd):
 
             self.show_output(msg)
 
+    def _mirror_incrementally(self, src, dst, filename, resume):
+        """ see do_mirror()'s watermark """
+        if src.scheme != "zk":
+            raise CopyError("Incremental mirroring needs a zk:// source", True)
+        if resume:
+            raise CopyError("Incremental mirrors can't be resumed (just run them again)", True)
+        if dst.READ_ONLY:
+            raise CopyError("Can't write to %s:// paths" % (dst.scheme), True)
+
+        start = time.time()
+        watermarks = Watermarks(os.path.expanduser(filename), src.url, dst.url)
+        if watermarks.znodes is None:
+            self.show_output("No watermarks in %s, mirroring everything.", filename)
+
+        mirror = IncrementalMirror(src, dst, watermarks, self.max_inflight, src.verbose)
+        mirror.run()
+        self.show_output(
+            "Mirroring took %.2f secs (znodes: %d, values read: %d, children lists read: %d, "
+            "written: %d, deleted: %d)", time.time() - start, mirror.znodes, mirror.read,
+            mirror.listed, mirror.written, mirror.deleted)
+
+    def _follow(self, src, dst, watermark, resume):
+        """ see do_mirror()'s follow """
+        if src.scheme != "zk":
+            raise CopyError("Following needs a zk:// source", True)
+        if watermark or resume:
+            raise CopyError("Following mirrors can't have watermarks or be resumed", True)
+        if dst.READ_ONLY:
+            raise CopyError("Can't write to %s:// paths" % (dst.scheme), True)
+
+        interval = self._conf.get_int("follow_interval", DEFAULT_FOLLOW_INTERVAL_MS) / 1000.0
+        follower = Follower(src, dst, interval, self.max_inflight, src.verbose)
+        follower.start()
+        try:
+            with self.transitions_disabled():
+                for applied in follower.run():
+                    if applied:
+                        self.show_output(
+                            "Applied %d changes (pending: %d, lag: %.3f secs, max lag: %.3f secs)",
+                            applied, follower.pending, follower.lag, follower.max_lag)
+        finally:
+            follower.stop()
+
+        self.show_output("Followed for %d batches (changes: %d, full resyncs: %d)",
+                         follower.batches, follower.applied, follower.resyncs)
+
+    @ensure_params(Required("log"), Optional("path", "/"), IntegerOptional("top", 10), Optional("zxids", ""))
+    def do_txnlog(self, params):
+        """
+\x1b[1mNAME\x1b[0m
+        txnlog - Summarizes the writes in transaction logs
+
+\x1b[1mSYNOPSIS\x1b[0m
+        txnlog <log> [path] [top] [zxids]
+
+\x1b[1mDESCRIPTION\x1b[0m
+        Reads a transaction log (log.<zxid>) or every log in a dir (i.e.: a server's
+        version-2 dir) and reports the writes under path: the writes per second, the
+        writes per type and the children of path & the sessions with the most writes.
+
+        Ops within multis are counted one by one.
+
+\x1b[1mOPTIONS\x1b[0m
+        * path: only count writes under this path (default: /)
+        * top: number of paths & sessions to list (default: 10)
+        * zxids: the range of zxids to read, as <start>:<end> (default: all)
+
+\x1b[1mEXAMPLES\x1b[0m
+        > txnlog /var/lib/zookeeper/version-2 /configs 2
+        Writes: 9315 (0x100000001 - 0x10000249a)
+        From: Thu Oct 16 18:54:39 2014
+        To: Thu Oct 16 19:06:12 2014 (693.0 secs)
+        Writes/sec: 13.44 (avg), 212 (peak, at Thu Oct 16 18:55:01 2014)
+        By type: create=2105 delete=2098 setData=5112
+        Top paths:
+          /configs/primary           4012
+          /configs/secondary         3970
+        Top sessions:
+          0x14911e869aa0dc1          5077
+          0x14911e869aa0dc5          4238
+        > txnlog log.100000001 / 10 0x100000001:0x100000200
+
+        """
+        zxids = self._zxid_range(params.zxids)
+        if zxids is None:
+            return
+
+        stats = TxnStats(params.path)
+        try:
+            for txn in read_txns(params.log, *zxids):
+                stats.add(txn)
+        except (IOError, OSError, TxnLogError) as ex:
+            self.show_output("Failed to read transaction log: %s", ex)
+            return
+
+        if stats.writes == 0:
+            self.show_output("No writes under %s.", stats.path)
+            return
+
+        second, peak = stats.peak
+        self.show_output("Writes: %d (0x%x - 0x%x)", stats.writes, stats.first.zxid, stats.last.zxid)
+        self.show_output("From: %s", time.ctime(stats.first.time / 1000.0))
+        self.show_output("To: %s (%.1f secs)", time.ctime(stats.last.time / 1000.0), stats.duration)
+        self.show_output("Writes/sec: %.2f (avg), %d (peak, at %s)",
+                         stats.writes / max(stats.duration, 1.0), peak, time.ctime(second))
+        self.show_output("By type: %s", " ".join(
+            "%s=%d" % (name, count) for name, count in sorted(stats.by_type.items())))
+        self.show_output("Top paths:")
+        for path, count in stats.top_paths(params.top):
+            self.show_output("  %s%d", path.ljust(27), count)
+        self.show_output("Top sessions:")
+        for session, count in stats.top_sessions(params.top):
+            self.show_output("  %s%d", ("0x%x" % session).ljust(27), count)
+
+    def complete_txnlog(self, cmd_param_text, full_cmd, *rest):
+        complete_log = partial(complete_values, [])
+        complete_top = partial(complete_values, [str(i) for i in range(1, 11)])
+        completers = [complete_log, self._complete_path, complete_top]
+        return complete(completers, cmd_param_text, full_cmd, *rest)
+
+    @ensure_params(
+        Required("log"),
+        Required("dst"),
+        Optional("path", "/"),
+        Optional("zxids", ""),
+        LabeledBooleanOptional("verbose"),
+        LabeledBooleanOptional("skip_prompt")
+    )
+    def do_txnlog_replay(self, params):
+        """
+\x1b[1mNAME\x1b[0m
+        txnlog_replay - Applies the writes in transaction logs to a path
+
+\x1b[1mSYNOPSIS\x1b[0m
+        txnlog_replay <log> <dst> [path] [zxids] [verbose] [skip_prompt]
+
+\x1b[1mDESCRIPTION\x1b[0m
+        Reads a transaction log (log.<zxid>) or every log in a dir and applies the
+        creates, deletes & sets under path to dst, which can be:
+
+           /some/path (in the connected server)
+           zk://[scheme:user:passwd@]host/<path>
+           json://!some!path!backup.json/some/path
+
+        path is mapped to dst. Ephemerals are skipped and so are ACL changes.
+
+        Together with cp from a snapshot this restores a tree as of any zxid in
+        the logs: copy the snapshot and replay the logs from the snapshot's zxid.
+        Replaying is idempotent, so overlapping ranges are fine. Deletes only
+        remove the znode itself: if it still has children in dst (which then
+        doesn't match the log), the replay stops there.
+
+\x1b[1mOPTIONS\x1b[0m
+        * path: only replay writes under this path (default: /)
+        * zxids: the range of zxids to replay, as <start>:<end> (default: all)
+        * verbose: print every applied write (default: false)
+        * skip_prompt: don't ask for confirmation (default: false)
+
+\x1b[1mEXAMPLES\x1b[0m
+        > cp snapshot://!backups!snapshot.100000000/configs /configs true true
+        > txnlog_replay /backups/version-2 /configs /configs 0x100000000:0x100002000
+        Replayed 1873 writes (0x100000001 - 0x100001fe2).
+
+        """
+        zxids = self._zxid_range(params.zxids)
+        if zxids is None:
+            return
+
+        if not re.match(r"^\w+://", params.dst):
+            if not self.connected:
+                self.show_output("Not connected.")
+                return
+            params.dst = "%s%s" % (self._zk.zk_url(), self.resolve_path(params.dst))
+            dst_connected_zk = True
+        else:
+            dst_connected_zk = False
+
+        question = "Are you sure you want to replay %s onto %s?" % (params.log, params.dst)
+        if not params.skip_prompt and not self.prompt_yes_no(question):
+            return
+
+        applied = []
+
+        def progress(txn):
+            applied.append(txn.zxid)
+            if params.verbose:
+                self.show_output("0x%x %s %s", txn.zxid, txn.type_name, txn.path)
+
+        try:
+            dst = Proxy.from_string(params.dst, exists=None, verbose=params.verbose)
+            if dst.READ_ONLY:
+                raise CopyError("Can't write to %s:// paths" % (dst.scheme), True)
+            if dst_connected_zk:
+                dst.need_client = False
+                dst.client = self._zk
+            replay(read_txns(params.log, *zxids), params.path, dst, progress)
+        except (IOError, OSError, TxnLogError) as ex:
+            self.show_output("Failed to read transaction log: %s", ex)
+            return
+        except CopyError as ex:
+            self.show_output("Replay failed after %d writes: %s", len(applied), ex)
+            return
+
+        if applied:
+            self.show_output("Replayed %d writes (0x%x - 0x%x).", len(applied), applied[0], applied[-1])
+        else:
+            self.show_output("Nothing to replay.")
+
+    def complete_txnlog_replay(self, cmd_param_text, full_cmd, *rest):
+        complete_none = partial(complete_values, [])
+        completers = [
+            complete_none,
+            self._complete_path,
+            self._complete_path,
+            complete_none,
+            complete_labeled_boolean("verbose"),
+            complete_labeled_boolean("skip_prompt")
+        ]
+        return complete(completers, cmd_param_text, full_cmd, *rest)
+
+    def _zxid_range(self, zxids):
+        """ (start, end) from <start>:<end>, either can be omitted. None if invalid """
+        start, _, end = zxids.partition(":")
+        try:
+            return (int(start, 0) if start else 0, int(end, 0) if end else None)
+        except ValueError:
+            self.show_output("Invalid zxid range: %s (expected <start>:<end>).", zxids)
+            return None
+
     @connected
     @interruptible
     @ensure_params(Optional("path"), IntegerOptional("max_depth"))
@@ -713,7 +1247,8 @@ class Shell(XCmd):
 
         """
         self.show_output(".")
-        for child, level in self._zk.tree(params.path, params.max_depth):
+        for child, level in self._zk.tree(params.path, params.max_depth,
+                                          max_inflight=self.max_inflight):
             self.show_output(u"%s├── %s", u"│   " * level, child)
 
     def complete_tree(self, cmd_param_text, full_cmd, *rest):
@@ -744,8 +1279,8 @@ class Shell(XCmd):
         /bar: 3
 
         """
-        for child, level in self._zk.tree(params.path, params.depth, full_path=True):
-            self.show_output("%s: %d", child, self._zk.child_count(child))
+        for child, count in self._zk.child_counts(params.path, params.depth, self.max_inflight):
+            self.show_output("%s: %d", child, count)
 
     def complete_child_count(self, cmd_param_text, full_cmd, *rest):
         complete_depth = partial(complete_values, [str(i) for i in range(1, 11)])
@@ -753,7 +1288,7 @@ class Shell(XCmd):
         return complete(completers, cmd_param_text, full_cmd, *rest)
 
     @connected
-    @ensure_params(Optional("path"))
+    @ensure_params(Optional("path"), IntegerOptional("depth", 0), IntegerOptional("top", 10))
     @check_paths_exists("path")
     def do_du(self, params):
         """
@@ -761,19 +1296,70 @@ class Shell(XCmd):
         du - Total number of bytes under a path
 
 \x1b[1mSYNOPSIS\x1b[0m
-        du [path]
+        du [path] [depth] [top]
+
+\x1b[1mDESCRIPTION\x1b[0m
+        With depth, the same pass also reports the bytes & znodes under each subtree
+        down to depth (heaviest first), the largest znodes and a histogram of value
+        sizes.
 
 \x1b[1mOPTIONS\x1b[0m
         * path: the path (default: cwd)
+        * depth: how deep to break the total down (0 is no breakdown) (default: 0)
+        * top: number of subtrees & znodes to list (0 is all) (default: 10)
 
 \x1b[1mEXAMPLES\x1b[0m
         > du /
         90
+        > du / 2 2
+        Total: 1.0GB in 120345 znodes
+        Subtrees:
+        Bytes       Znodes      Path
+        1.0GB       118003      /services
+        1003.5MB    117251      /services/registrations
+        Largest znodes:
+        1.0MB       /services/registrations/catalog
+        512.0KB     /configs/topology
+        Value sizes:
+        0                       41002
+        1 - 64                  70211
+        ...
 
         """
-        self.show_output(pretty_bytes(self._zk.du(params.path)))
+        window = self._scan_window()
+        if params.depth <= 0:
+            self.show_output(pretty_bytes(self._zk.du(params.path, window)))
+            self._report_retries(window)
+            return
 
-    complete_du = _complete_path
+        breakdown = self._zk.du_breakdown(params.path, params.depth, params.top, window)
+        self.show_output("Total: %s in %d znodes", pretty_bytes(breakdown.bytes), breakdown.znodes)
+
+        self.show_output("Subtrees:")
+        self.show_output("%s%s%s", "Bytes".ljust(12), "Znodes".ljust(12), "Path")
+        for path, (size, znodes) in breakdown.top_subtrees():
+            self.show_output("%s%s%s", pretty_bytes(size).ljust(12), str(znodes).ljust(12), path)
+
+        self.show_output("Largest znodes:")
+        for size, path in breakdown.largest():
+            self.show_output("%s%s", pretty_bytes(size).ljust(12), path)
+
+        self.show_output("Value sizes:")
+        for low, high, znodes in breakdown.buckets():
+            if low == 0:
+                label = "0"
+            elif high is None:
+                label = ">= %s" % (pretty_bytes(low))
+            else:
+                label = "%s - %s" % (pretty_bytes(low), pretty_bytes(high))
+            self.show_output("%s%d", label.ljust(24), znodes)
+
+        self._report_retries(window)
+
+    def complete_du(self, cmd_param_text, full_cmd, *rest):
+        complete_depth = partial(complete_values, [str(i) for i in range(1, 11)])
+        completers = [self._complete_path, complete_depth, complete_depth]
+        return complete(completers, cmd_param_text, full_cmd, *rest)
 
     @connected
     @ensure_params(Optional("path"), Required("match"))
@@ -798,8 +1384,10 @@ class Shell(XCmd):
         /copy/foo
 
         """
-        for path in self._zk.find(params.path, params.match, 0):
+        window = self._scan_window()
+        for path in self._zk.find(params.path, params.match, 0, window):
             self.show_output(path)
+        self._report_retries(window)
 
     complete_find = _complete_path
 
@@ -829,9 +1417,12 @@ class Shell(XCmd):
 
         """
         seen = set()
+        window = self._scan_window()
 
         # we don't want to recurse once there's a child matching, hence exclude_recurse=
-        for path in self._zk.fast_tree(params.path, exclude_recurse=params.pattern):
+        paths = self._zk.fast_tree(
+            params.path, exclude_recurse=params.pattern, max_inflight=window)
+        for path in paths:
             parent, child = split(path)
 
             if parent in seen:
@@ -847,6 +1438,8 @@ class Shell(XCmd):
                     self.show_output(parent)
                     seen.add(parent)
 
+        self._report_retries(window)
+
     def complete_child_matches(self, cmd_param_text, full_cmd, *rest):
         complete_pats = partial(complete_values, ["some-pattern"])
         completers = [self._complete_path, complete_pats, complete_labeled_boolean("inverse")]
@@ -855,7 +1448,8 @@ class Shell(XCmd):
     @connected
     @ensure_params(
         Optional("path"),
-        IntegerOptional("top", 0)
+        IntegerOptional("top", 0),
+        Optional("sort", "name")
     )
     @check_paths_exists("path")
     def do_summary(self, params):
@@ -864,14 +1458,19 @@ class Shell(XCmd):
         summary - Prints summarized details of a path's children
 
 \x1b[1mSYNOPSIS\x1b[0m
-        summary [path] [top]
+        summary [path] [top] [sort]
 
 \x1b[1mDESCRIPTION\x1b[0m
-        The results are sorted by name.
+        The results are sorted by name, or by sort (ties are broken by name).
+
+        With top, only the top results are kept while the children are read. Otherwise
+        results over sort_buffer_size are sorted on disk.
 
 \x1b[1mOPTIONS\x1b[0m
         * path: the path (default: cwd)
-        * top: number of results to be displayed (0 is all) (default: 0)
+        * top: number of results to be displayed, the last ones if negative (0 is all)
+               (default: 0)
+        * sort: name, ctime, mtime, dataLength, numChildren or owner (default: name)
 
 \x1b[1mEXAMPLES\x1b[0m
         > summary /services/registrations
@@ -880,7 +1479,16 @@ class Shell(XCmd):
         Thu Oct 16 18:54:39 2014   Thu Oct 16 18:54:39 2014     -                   foo
         Thu Oct 12 10:04:01 2014   Thu Oct 12 10:04:01 2014     0x14911e869aa0dc1   member_0000001
 
+        > summary /services/registrations -1 ctime
+        Created                    Last modified               Owner                Name
+        Thu Oct 16 18:54:39 2014   Thu Oct 16 18:54:39 2014     -                   foo
+
         """
+        key = SUMMARY_KEYS.get(params.sort)
+        if key is None:
+            self.show_output("Unknown sort key: %s (expected one of: %s).",
+                             params.sort, ", ".join(sorted(SUMMARY_KEYS)))
+            return
 
         self.show_output("%s%s%s%s",
                          "Created".ljust(32),
@@ -888,21 +1496,16 @@ class Shell(XCmd):
                          "Owner".ljust(23),
                          "Name")
 
-        results = sorted(self._zk.stat_map(params.path))
-
-        # what slice do we want?
-        if params.top == 0:
-            start, end = 0, len(results)
-        elif params.top > 0:
-            start, end = 0, params.top if params.top < len(results) else len(results)
+        window = self._scan_window()
+        results = self._zk.stat_map(params.path, window)
+        if params.top != 0:
+            results = top(results, params.top, key)
         else:
-            start = len(results) + params.top if abs(params.top) < len(results) else 0
-            end = len(results)
+            max_bytes = self._conf.get_int("sort_buffer_size", DEFAULT_SORT_BUFFER_SIZE)
+            results = external_sort(results, key, max_bytes, summary_entry_size)
 
         offs = 1 if params.path == "/" else len(params.path) + 1
-        for i in range(start, end):
-            path, stat = results[i]
-
+        for path, stat in results:
             self.show_output(
                 "%s%s%s%s",
                 time.ctime(stat.created).ljust(32),
@@ -911,9 +1514,12 @@ class Shell(XCmd):
                 path[offs:]
             )
 
+        self._report_retries(window)
+
     def complete_summary(self, cmd_param_text, full_cmd, *rest):
         complete_top = partial(complete_values, [str(i) for i in range(1, 11)])
-        completers = [self._complete_path, complete_top]
+        complete_sort = partial(complete_values, sorted(SUMMARY_KEYS))
+        completers = [self._complete_path, complete_top, complete_sort]
         return complete(completers, cmd_param_text, full_cmd, *rest)
 
     @connected
@@ -939,8 +1545,10 @@ class Shell(XCmd):
         /copy/Foo
 
         """
-        for path in self._zk.find(params.path, params.match, re.IGNORECASE):
+        window = self._scan_window()
+        for path in self._zk.find(params.path, params.match, re.IGNORECASE, window):
             self.show_output(path)
+        self._report_retries(window)
 
     def complete_ifind(self, cmd_param_text, full_cmd, *rest):
         complete_match = partial(complete_values, ["sometext"])
@@ -948,7 +1556,13 @@ class Shell(XCmd):
         return complete(completers, cmd_param_text, full_cmd, *rest)
 
     @connected
-    @ensure_params(Optional("path"), Required("content"), LabeledBooleanOptional("show_matches"))
+    @ensure_params(
+        Optional("path"),
+        Required("content"),
+        LabeledBooleanOptional("show_matches"),
+        LabeledBooleanOptional("ordered"),
+        LabeledBooleanOptional("resume")
+    )
     @check_paths_exists("path")
     def do_grep(self, params):
         """
@@ -956,11 +1570,19 @@ class Shell(XCmd):
         grep - Prints znodes with a value matching the given text
 
 \x1b[1mSYNOPSIS\x1b[0m
-        grep [path] <content> [show_matches]
+        grep [path] <content> [show_matches] [ordered] [resume]
+
+\x1b[1mDESCRIPTION\x1b[0m
+        Values are fetched in parallel and matches are printed as they are found,
+        unless ordered is set. The number of processes used for matching big or
+        numerous values is set via the grep_workers conf variable.
 
 \x1b[1mOPTIONS\x1b[0m
         * path: the path (default: cwd)
         * show_matches: show the content that matched (default: false)
+        * ordered: print matches in tree (DFS) order (default: false)
+        * resume: save checkpoints as it goes, and continue from the last one of the same
+                  (unordered) grep if there's one (default: false)
 
 \x1b[1mEXAMPLES\x1b[0m
         > grep / unbound true
@@ -968,15 +1590,28 @@ class Shell(XCmd):
         /copy/passwd: unbound:x:992:991:Unbound DNS resolver:/etc/unbound:/sbin/nologin
 
         """
-        self.grep(params.path, params.content, 0, params.show_matches)
+        self.grep(params.path, params.content, 0, params.show_matches, params.ordered,
+                  params.resume)
 
     def complete_grep(self, cmd_param_text, full_cmd, *rest):
         complete_content = partial(complete_values, ["sometext"])
-        completers = [self._complete_path, complete_content, complete_labeled_boolean("show_matches")]
+        completers = [
+            self._complete_path,
+            complete_content,
+            complete_labeled_boolean("show_matches"),
+            complete_labeled_boolean("ordered"),
+            complete_labeled_boolean("resume")
+        ]
         return complete(completers, cmd_param_text, full_cmd, *rest)
 
     @connected
-    @ensure_params(Optional("path"), Required("content"), LabeledBooleanOptional("show_matches"))
+    @ensure_params(
+        Optional("path"),
+        Required("content"),
+        LabeledBooleanOptional("show_matches"),
+        LabeledBooleanOptional("ordered"),
+        LabeledBooleanOptional("resume")
+    )
     @check_paths_exists("path")
     def do_igrep(self, params):
         """
@@ -984,11 +1619,14 @@ class Shell(XCmd):
         igrep - Prints znodes with a value matching the given text (ignoring case)
 
 \x1b[1mSYNOPSIS\x1b[0m
-        igrep [path] <content> [show_matches]
+        igrep [path] <content> [show_matches] [ordered] [resume]
 
 \x1b[1mOPTIONS\x1b[0m
         * path: the path (default: cwd)
         * show_matches: show the content that matched (default: false)
+        * ordered: print matches in tree (DFS) order (default: false)
+        * resume: save checkpoints as it goes, and continue from the last one of the same
+                  (unordered) grep if there's one (default: false)
 
 \x1b[1mEXAMPLES\x1b[0m
         > igrep / UNBound true
@@ -996,18 +1634,32 @@ class Shell(XCmd):
         /copy/passwd: unbound:x:992:991:Unbound DNS resolver:/etc/unbound:/sbin/nologin
 
         """
-        self.grep(params.path, params.content, re.IGNORECASE, params.show_matches)
+        self.grep(params.path, params.content, re.IGNORECASE, params.show_matches, params.ordered,
+                  params.resume)
 
     complete_igrep = complete_grep
 
-    def grep(self, path, content, flags, show_matches):
-        for path, matches in self._zk.grep(path, content, flags):
+    def grep(self, path, content, flags, show_matches, ordered, resume):
+        workers = self._conf.get_int("grep_workers", 0)
+        window = self._scan_window()
+
+        # only resumable greps are checkpointed
+        checkpoint = None
+        if resume and not ordered:
+            checkpoint = self._checkpoint(resume, "grep", self._zk.zk_url(), path, content, flags)
+
+        results = self._zk.grep(path, content, flags, ordered, workers, window, checkpoint)
+        for mpath, matches in results:
             if show_matches:
-                self.show_output("%s:", path)
+                self.show_output("%s:", mpath)
                 for match in matches:
                     self.show_output(match)
             else:
-                self.show_output(path)
+                self.show_output(mpath)
+
+        if checkpoint is not None:
+            checkpoint.remove()
+        self._report_retries(window)
 
     @connected
     @ensure_params(Optional("path", "/"))
@@ -1039,6 +1691,7 @@ class Shell(XCmd):
 
         """
         self.update_curdir(params.path)
+        self.path_cache.prefetch(self.curdir)
 
     complete_cd = _complete_path
 
@@ -1787,13 +2440,29 @@ child_watches=%s"""
 \x1b[1mSYNOPSIS\x1b[0m
         rmr <path> [path] [path] ... [path]
 
+\x1b[1mDESCRIPTION\x1b[0m
+        The children are found with pipelined reads and deleted deepest first,
+        using batches of deletes (multis) with up to write_max_inflight of them
+        outstanding. Progress is reported every few seconds for big subtrees.
+
 \x1b[1mEXAMPLES\x1b[0m
         > rmr /foo
         > rmr /foo /bar
 
         """
+        def progress(found, deleted, elapsed):
+            self.show_output("Found %d znodes, deleted %d (%d znodes/sec)",
+                             found, deleted, deleted / max(elapsed, 0.001))
+
         for path in params.paths:
-            self._zk.delete(path, recursive=True)
+            try:
+                self._zk.delete_recursive(path, self.max_inflight, self.max_inflight_writes, progress)
+            except NoAuthError as ex:
+                # say which znode it was, if it's known
+                if not ex.args:
+                    raise
+                self.show_output("%s.", str(ex))
+                return
 
     complete_rmr = complete_rm
 
@@ -1864,6 +2533,8 @@ child_watches=%s"""
           ++ means the znode is new in /new-configs
           +- means the znode's content differ between /configs and /new-configs
 
+        Differences are listed in DFS order, with children sorted by name.
+
 \x1b[1mEXAMPLES\x1b[0m
         > diff /configs /new-configs
         -- service-x/hosts
@@ -1872,7 +2543,8 @@ child_watches=%s"""
 
         """
         count = 0
-        for count, (diff, path) in enumerate(self._zk.diff(params.path_a, params.path_b), 1):
+        diffs = self._zk.diff(params.path_a, params.path_b, self.max_inflight)
+        for count, (diff, path) in enumerate(diffs, 1):
             if diff == -1:
                 self.show_output("-- %s", path)
             elif diff == 0:
@@ -1932,7 +2604,8 @@ child_watches=%s"""
         if not params.recursive:
             check_valid(params.path, False)
         else:
-            for cpath, _ in self._zk.tree(params.path, 0, full_path=True):
+            paths = self._zk.tree(params.path, 0, full_path=True, max_inflight=self.max_inflight)
+            for cpath, _ in paths:
                 check_valid(cpath, True)
 
     def complete_json_valid(self, cmd_param_text, full_cmd, *rest):
@@ -1994,7 +2667,8 @@ child_watches=%s"""
         if not params.recursive:
             json_output(params.path, False)
         else:
-            for cpath, _ in self._zk.tree(params.path, 0, full_path=True):
+            paths = self._zk.tree(params.path, 0, full_path=True, max_inflight=self.max_inflight)
+            for cpath, _ in paths:
                 json_output(cpath, True)
 
     def complete_json_cat(self, cmd_param_text, full_cmd, *rest):
@@ -2036,7 +2710,7 @@ child_watches=%s"""
             return
 
         if params.recursive:
-            paths = self._zk.tree(params.path, 0, full_path=True)
+            paths = self._zk.tree(params.path, 0, full_path=True, max_inflight=self.max_inflight)
             print_path = True
         else:
             paths = [(params.path, 0)]
@@ -2104,7 +2778,8 @@ child_watches=%s"""
             self.show_output(str(ex))
             return
 
-        path_map = PathMap(self._zk, params.path)
+        window = self._scan_window()
+        path_map = PathMap(self._zk.reader(params.path), params.path, window)
 
         values = defaultdict(int)
         for path, data in path_map.get():
@@ -2118,6 +2793,8 @@ child_watches=%s"""
                 if params.report_errors:
                     self.show_output("Path %s is missing key %s.", path, ex)
 
+        self._report_retries(window)
+
         results = sorted(values.items(), key=lambda item: item[1], reverse=params.reverse)
         results = [r for r in results if r[1] >= params.minfreq]
 
@@ -2162,7 +2839,8 @@ child_watches=%s"""
         Required("keys"),
         Optional("prefix", ""),
         LabeledBooleanOptional("report_errors", default=False),
-        LabeledBooleanOptional("first", default=False)
+        LabeledBooleanOptional("first", default=False),
+        LabeledBooleanOptional("resume", default=False)
     )
     @check_paths_exists("path")
     def do_json_dupes_for_keys(self, params):
@@ -2171,7 +2849,7 @@ child_watches=%s"""
         json_duples_for_keys - Gets the duplicate znodes for the given keys
 
 \x1b[1mSYNOPSIS\x1b[0m
-        json_dupes_for_keys <path> <keys> [prefix] [report_errors] [first]
+        json_dupes_for_keys <path> <keys> [prefix] [report_errors] [first] [resume]
 
 \x1b[1mDESCRIPTION\x1b[0m
         Znodes with duplicated keys are sorted and all but the first (original) one
@@ -2181,6 +2859,7 @@ child_watches=%s"""
         * prefix: only include matching znodes
         * report_errors: turn on error reporting (i.e.: bad JSON in a znode)
         * first: print the first, non duplicated, znode too.
+        * resume: continue from the last checkpoint of the same scan.
 
 \x1b[1mEXAMPLES\x1b[0m
         > json_cat /configs/primary_service true
@@ -2216,9 +2895,14 @@ child_watches=%s"""
             self.show_output(str(ex))
             return
 
-        path_map = PathMap(self._zk, params.path)
+        window = self._scan_window()
+        checkpoint = self._checkpoint(params.resume, "json_dupes_for_keys", self._zk.zk_url(),
+                                      params.path, params.keys, params.prefix)
+        path_map = PathMap(
+            self._zk.reader(params.path), params.path, window, checkpoint)
 
-        dupes_by_path = defaultdict(lambda: defaultdict(list))
+        # kept in the checkpoint, so it has to be JSON friendly: values are serialized
+        dupes_by_path = checkpoint.state.setdefault("dupes_by_path", {})
         for path, data in path_map.get():
             parent, child = split(path)
 
@@ -2227,7 +2911,8 @@ child_watches=%s"""
 
             try:
                 value = Keys.value(json_deserialize(data), params.keys)
-                dupes_by_path[parent][value].append(path)
+                paths_by_value = dupes_by_path.setdefault(parent, {})
+                paths_by_value.setdefault(json.dumps(value, sort_keys=True), []).append(path)
             except BadJSON as ex:
                 if params.report_errors:
                     self.show_output("Path %s has bad JSON.", path)
@@ -2235,6 +2920,8 @@ child_watches=%s"""
                 if params.report_errors:
                     self.show_output("Path %s is missing key %s.", path, ex)
 
+        self._report_retries(window)
+
         dupes = []
         for _, paths_by_value in dupes_by_path.items():
             for _, paths in paths_by_value.items():
@@ -2248,6 +2935,8 @@ child_watches=%s"""
         for dup in dupes:
             self.show_output(dup)
 
+        checkpoint.remove()
+
         # if no dupes were found we call it a failure (i.e.: exit(1) from --run-once)
         if len(dupes) == 0:
             return False
@@ -2257,7 +2946,8 @@ child_watches=%s"""
         completers = [
             self._complete_path,
             complete_keys,
-            complete_labeled_boolean("report_errors")
+            complete_labeled_boolean("report_errors"),
+            complete_labeled_boolean("resume")
         ]
         return complete(completers, cmd_param_text, full_cmd, *rest)
 
@@ -2445,7 +3135,8 @@ child_watches=%s"""
         if not params.recursive:
             check(params.path, False, params.reverse)
         else:
-            for cpath, _ in self._zk.tree(params.path, 0, full_path=True):
+            paths = self._zk.tree(params.path, 0, full_path=True, max_inflight=self.max_inflight)
+            for cpath, _ in paths:
                 check(cpath, True, params.reverse)
 
     def complete_ephemeral_endpoint(self, cmd_param_text, full_cmd, *rest):
@@ -2672,8 +3363,13 @@ child_watches=%s"""
 \x1b[1mSYNOPSIS\x1b[0m
         connect <hosts>
 
+\x1b[1mDESCRIPTION\x1b[0m
+        With snapshot://<file>, the znodes are read from a snapshot file (i.e.: one
+        copied off a server) instead. Writes fail with "Not a read-only operation."
+
 \x1b[1mEXAMPLES\x1b[0m
         > connect host1:2181,host2:2181
+        > connect snapshot:///var/lib/zookeeper/version-2/snapshot.1a2b
 
         """
 
@@ -2743,6 +3439,8 @@ child_watches=%s"""
         self.state_transitions_enabled = True
 
     def _disconnect(self):
+        if self._zk:
+            self._zk.set_read_sessions(0)
         if self._zk and self.connected:
             self._zk.stop()
             self._zk.close()
@@ -2764,6 +3462,10 @@ child_watches=%s"""
         ```
         """
         self._disconnect()
+        if hosts_list[0].startswith("snapshot://"):
+            self._open_snapshot(hosts_list[0][len("snapshot://"):].replace("!", "/"))
+            return
+
         auth_data = []
         hosts = []
 
@@ -2788,6 +3490,14 @@ child_watches=%s"""
         else:
             self._connect_sync()
 
+    def _open_snapshot(self, filename):
+        try:
+            self._zk = SnapshotClient(filename)
+            self.connected = True
+        except (IOError, OSError, SnapshotError) as ex:
+            self.show_output("Failed to open snapshot: %s", ex)
+        self.update_curdir("/")
+
     def _connect_async(self):
         def listener(state):
             self.connected = state == KazooState.CONNECTED
@@ -0,0 +1,350 @@
+"""
+Offline access to ZooKeeper snapshots (snapshot.<zxid> files)
+
+A snapshot is the serialized DataTree: a header, the sessions, the ACLs
+(referenced by id from each znode) and then a record per znode in DFS
+order, each one being the path, the data, the ACL id & the persisted stat.
+Snapshot memory-maps the file and walks the records once to index where
+each one starts (the data is only read when asked for). SnapshotClient
+serves kazoo's read requests from a Snapshot, so everything built on the
+client's async API (tree, find, grep, du, summary, json_*...) runs against
+a snapshot copied off a server without touching the ensemble.
+
+write_snapshot() produces synthetic snapshots (i.e.: for tests).
+
+  Example usage:
+    >>> from zk_shell.snapshot import SnapshotClient, write_snapshot
+    >>> write_snapshot("/tmp/snapshot.1", {"/configs/a": b"hello"})
+    >>> zk = SnapshotClient("/tmp/snapshot.1")
+    >>> zk.get("/configs/a")[0]
+    'hello'
+    >>> zk.du("/")
+    5
+    >>> zk.stop()
+
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError, NotReadOnlyCallError
+from kazoo.protocol.serialization import (
+    Exists,
+    GetACL,
+    GetChildren,
+    GetChildren2,
+    GetData,
+    Sync,
+)
+from kazoo.protocol.states import ZnodeStat
+from kazoo.security import ACL, Id, OPEN_ACL_UNSAFE
+
+from .util import to_bytes
+from .xclient import XClient
+
+
+SNAP_MAGIC = 0x5a4b534e  # ZKSN
+SNAP_VERSION = 2
+
+# ACL id for world:anyone:cdrwa (i.e.: znodes created without ACLs)
+OPEN_ACL_UNSAFE_ID = -1
+
+INT = struct.Struct(">i")
+LONG = struct.Struct(">q")
+# czxid, mzxid, ctime, mtime, version, cversion, aversion, ephemeralOwner, pzxid
+STAT = struct.Struct(">qqqqiiiqq")
+
+# bytes per adler32 update when verifying
+CHECKSUM_CHUNK = 16 * 1024 * 1024
+
+
+class SnapshotError(Exception):
+    """ the file isn't a (complete) snapshot """
+    pass
+
+
+class Snapshot(object):
+    """ an indexed, memory-mapped snapshot """
+    __slots__ = ("filename", "fh", "buf", "offsets", "children", "acls", "sessions")
+
+    def __init__(self, filename, verify=True):
+        """
+        :param filename: the snapshot file
+        :param verify: check the checksum at the end of the file
+        """
+        self.filename = filename
+        self.fh = open(filename, "rb")
+        try:
+            self.buf = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            self.fh.close()
+            raise SnapshotError("%s is empty" % (filename))
+
+        self.offsets = {}
+        self.children = {}
+        self.acls = {}
+        self.sessions = {}
+
+        try:
+            end = self._index()
+            if verify:
+                self._verify(end)
+        except (struct.error, IndexError, UnicodeDecodeError):
+            self.close()
+            raise SnapshotError("%s is truncated or corrupt" % (filename))
+        except SnapshotError:
+            self.close()
+            raise
+
+    @property
+    def zxid(self):
+        """ the last zxid included, from the file name (or -1) """
+        try:
+            return int(os.path.basename(self.filename).split(".")[-1], 16)
+        except ValueError:
+            return -1
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.buf.close()
+        self.fh.close()
+
+    def exists(self, path):
+        """ the stat for path, or None """
+        offs = self.offsets.get(path)
+        return None if offs is None else self._stat(path, offs)
+
+    def get(self, path):
+        """ (data, stat), raises NoNodeError """
+        offs = self._offset(path)
+        size = INT.unpack_from(self.buf, offs)[0]
+        data = self.buf[offs + 4:offs + 4 + size] if size >= 0 else None
+        return (data, self._stat(path, offs))
+
+    def get_children(self, path):
+        """ the children's names, raises NoNodeError """
+        self._offset(path)
+        return list(self.children.get(path, ()))
+
+    def get_acls(self, path):
+        """ (acls, stat), raises NoNodeError """
+        offs = self._offset(path)
+        size = max(INT.unpack_from(self.buf, offs)[0], 0)
+        acl_id = LONG.unpack_from(self.buf, offs + 4 + size)[0]
+        acls = OPEN_ACL_UNSAFE if acl_id == OPEN_ACL_UNSAFE_ID else self.acls.get(acl_id, [])
+        return (list(acls), self._stat(path, offs))
+
+    def walk(self, path):
+        """ yields the paths under path, parents before their children """
+        stack = [path]
+        while stack:
+            parent = stack.pop()
+            for child in reversed(self.children.get(parent, ())):
+                child_path = os.path.join(parent, child)
+                yield child_path
+                stack.append(child_path)
+
+    def _offset(self, path):
+        offs = self.offsets.get(path)
+        if offs is None:
+            raise NoNodeError()
+        return offs
+
+    def _stat(self, path, offs):
+        size = INT.unpack_from(self.buf, offs)[0]
+        fields = STAT.unpack_from(self.buf, offs + 4 + max(size, 0) + 8)
+        return ZnodeStat(*(fields[:8] + (max(size, 0), len(self.children.get(path, ())), fields[8])))
+
+    def _string(self, offs):
+        """ returns (string, next offset) """
+        size = INT.unpack_from(self.buf, offs)[0]
+        if size < 0:
+            return None, offs + 4
+        return self.buf[offs + 4:offs + 4 + size].decode("utf-8"), offs + 4 + size
+
+    def _index(self):
+        """ walks the records, returns where the tree ends """
+        buf = self.buf
+        magic, version = struct.unpack_from(">ii", buf, 0)
+        if magic != SNAP_MAGIC:
+            raise SnapshotError("%s isn't a snapshot" % (self.filename))
+        if version != SNAP_VERSION:
+            raise SnapshotError("Unsupported snapshot version: %d" % (version))
+        offs = 16
+
+        count, offs = INT.unpack_from(buf, offs)[0], offs + 4
+        for _ in range(0, count):
+            session_id, timeout = struct.unpack_from(">qi", buf, offs)
+            self.sessions[session_id] = timeout
+            offs += 12
+
+        count, offs = INT.unpack_from(buf, offs)[0], offs + 4
+        for _ in range(0, count):
+            acl_id, size = struct.unpack_from(">qi", buf, offs)
+            offs += 12
+            acls = []
+            for _ in range(0, max(size, 0)):
+                perms, offs = INT.unpack_from(buf, offs)[0], offs + 4
+                scheme, offs = self._string(offs)
+                ident, offs = self._string(offs)
+                acls.append(ACL(perms, Id(scheme, ident)))
+            self.acls[acl_id] = acls
+
+        offsets, children = self.offsets, self.children
+        while True:
+            path, offs = self._string(offs)
+            if path == "/":
+                return offs
+
+            # the root is serialized as ""
+            path = path or "/"
+            offsets[path] = offs
+            if path != "/":
+                parent, child = path.rsplit("/", 1)
+                children.setdefault(parent or "/", []).append(child)
+
+            size = INT.unpack_from(buf, offs)[0]
+            offs += 4 + max(size, 0) + 8 + STAT.size
+            if offs > len(buf):
+                raise SnapshotError("%s is truncated" % (self.filename))
+
+    def _verify(self, end):
+        value = 1
+        for offs in range(0, end, CHECKSUM_CHUNK):
+            value = zlib.adler32(self.buf[offs:min(offs + CHECKSUM_CHUNK, end)], value)
+
+        if LONG.unpack_from(self.buf, end)[0] != value & 0xffffffff:
+            raise SnapshotError("Bad checksum for %s" % (self.filename))
+
+
+class SnapshotClient(XClient):
+    """ a read-only client that serves requests from a Snapshot """
+
+    def __init__(self, filename, verify=True):
+        super(SnapshotClient, self).__init__(read_only=True)
+        self.snapshot = Snapshot(filename, verify)
+        # for the callbacks of the async results
+        self.handler.start()
+
+    @property
+    def connected(self):
+        return True
+
+    @property
+    def client_state(self):
+        return "SNAPSHOT"
+
+    def stop(self):
+        self.handler.stop()
+        self.snapshot.close()
+
+    def close(self):
+        pass
+
+    def set_read_sessions(self, count):
+        return 0
+
+    def zk_url(self):
+        """ the URL of the snapshot, for copying from it (see SnapshotProxy) """
+        return "snapshot://%s" % (self.snapshot.filename.replace("/", "!"))
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        # lists can't change, no need for validating them
+        return KazooClient.get_children_async(self, path, watch, include_data)
+
+    def _call(self, request, async_object):
+        """ every request ends up here, watches are ignored (nothing changes) """
+        snapshot = self.snapshot
+        try:
+            if isinstance(request, GetData):
+                async_object.set(snapshot.get(request.path))
+            elif isinstance(request, GetChildren):
+                async_object.set(snapshot.get_children(request.path))
+            elif isinstance(request, GetChildren2):
+                async_object.set((snapshot.get_children(request.path), snapshot.exists(request.path)))
+            elif isinstance(request, Exists):
+                async_object.set(snapshot.exists(request.path))
+            elif isinstance(request, GetACL):
+                async_object.set(snapshot.get_acls(request.path))
+            elif isinstance(request, Sync):
+                async_object.set(request.path)
+            else:
+                async_object.set_exception(NotReadOnlyCallError())
+        except NoNodeError as ex:
+            async_object.set_exception(ex)
+        return True
+
+
+def write_snapshot(filename, znodes, acls=None, ephemerals=None, sessions=None):
+    """
+    writes a synthetic snapshot
+
+    :param znodes: dict of path -> value, parents are added if missing
+    :param acls: dict of path -> list of ACLs (default: OPEN_ACL_UNSAFE)
+    :param ephemerals: dict of path -> owner session id
+    :param sessions: dict of session id -> timeout (ms)
+    """
+    acls = acls or {}
+    ephemerals = ephemerals or {}
+    sessions = sessions or dict((owner, 10000) for owner in ephemerals.values())
+
+    values = {"/": b"", "/zookeeper": b"", "/zookeeper/quota": b""}
+    for path, value in znodes.items():
+        values[path] = to_bytes(value) if value is not None else None
+        parent = os.path.dirname(path)
+        while parent not in values:
+            values[parent] = b""
+            parent = os.path.dirname(parent)
+
+    children = {}
+    for path in sorted(values):
+        if path != "/":
+            children.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+
+    # czxids follow creation order (parents first)
+    czxids = dict((path, zxid) for zxid, path in enumerate(sorted(values), 1))
+
+    acl_ids = {}
+    for path in sorted(acls):
+        acl_ids.setdefault(tuple(acls[path]), len(acl_ids) + 1)
+
+    def string(value):
+        if value is None:
+            return INT.pack(-1)
+        value = to_bytes(value)
+        return INT.pack(len(value)) + value
+
+    out = [struct.pack(">iiq", SNAP_MAGIC, SNAP_VERSION, -1), INT.pack(len(sessions))]
+    for session_id, timeout in sorted(sessions.items()):
+        out.append(struct.pack(">qi", session_id, timeout))
+
+    out.append(INT.pack(len(acl_ids)))
+    for acl_list, acl_id in sorted(acl_ids.items(), key=lambda item: item[1]):
+        out.append(struct.pack(">qi", acl_id, len(acl_list)))
+        for acl in acl_list:
+            out.append(INT.pack(acl.perms) + string(acl.id.scheme) + string(acl.id.id))
+
+    stack = ["/"]
+    while stack:
+        path = stack.pop()
+        names = children.get(path, [])
+        czxid = czxids[path]
+        pzxid = max([czxids[os.path.join(path, n)] for n in names] + [czxid])
+        value = values[path]
+        out.append(string("" if path == "/" else path))
+        out.append(INT.pack(-1) if value is None else string(value))
+        out.append(LONG.pack(acl_ids.get(tuple(acls.get(path, ())), OPEN_ACL_UNSAFE_ID)))
+        out.append(STAT.pack(czxid, czxid, 0, 0, 0, len(names), 0, ephemerals.get(path, 0), pzxid))
+        stack.extend(os.path.join(path, n) for n in reversed(names))
+    out.append(string("/"))
+
+    content = b"".join(out)
+    with open(filename, "wb") as fh:
+        fh.write(content)
+        fh.write(LONG.pack(zlib.adler32(content) & 0xffffffff))
+        fh.write(string("/"))
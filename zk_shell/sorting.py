@@ -0,0 +1,92 @@
+"""
+Sorting streams of results with bounded memory
+
+top() keeps a heap of |count| items while the results stream in, and
+external_sort() sorts runs of up to max_bytes in memory, spilling each
+one to a temp file, and then merges them.
+
+  Example usage:
+    >>> from zk_shell.sorting import external_sort, top
+    >>> gen = zk.stat_map("/services/registrations")
+    >>> top(gen, -2, key=lambda item: item[1].ctime)
+    [('/services/registrations/web-9', ZnodeStat(...)), ('/services/registrations/web-7', ...)]
+    >>> for path, stat in external_sort(zk.stat_map("/"), key=lambda item: item[0]):
+    ...     print(path)
+
+"""
+
+import heapq
+import sys
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:  # py3k
+    import pickle
+
+
+# default bytes of items to sort in memory before spilling to disk
+DEFAULT_SORT_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+def top(iterable, count, key):
+    """
+    the first count items (by key) if count is positive, or the last -count
+    ones (still in ascending order) if it's negative. 0 means all of them.
+    """
+    if count > 0:
+        return heapq.nsmallest(count, iterable, key=key)
+    if count < 0:
+        return list(reversed(heapq.nlargest(-count, iterable, key=key)))
+    return sorted(iterable, key=key)
+
+
+def external_sort(iterable, key, max_bytes=DEFAULT_SORT_BUFFER_SIZE, size=sys.getsizeof):
+    """
+    yields the items sorted by key, spilling sorted runs to temp files when
+    the buffered items go over max_bytes (as estimated by size)
+    """
+    runs = []
+    buf, used = [], 0
+    try:
+        for seq, item in enumerate(iterable):
+            buf.append((key(item), seq, item))
+            used += size(item)
+            if used >= max_bytes:
+                runs.append(_spill(buf))
+                buf, used = [], 0
+
+        buf.sort()
+        if not runs:
+            for _, _, item in buf:
+                yield item
+            return
+
+        # the seqs make the merge stable and spare comparing items
+        for _, _, item in heapq.merge(iter(buf), *[_read_run(run) for run in runs]):
+            yield item
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _spill(buf):
+    """ writes buf, sorted, to a temp file (deleted once closed) """
+    buf.sort()
+    run = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+    for entry in buf:
+        pickler.dump(entry)
+        # don't let the memo keep every entry alive
+        pickler.clear_memo()
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    unpickler = pickle.Unpickler(run)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
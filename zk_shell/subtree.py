@@ -0,0 +1,420 @@
+"""
+In-memory mirrors of subtrees, kept current via watches
+
+A SubtreeCache loads a subtree with pipelined reads, setting a data and
+a child watch on every znode, and from then on each notification triggers
+a refresh of what changed (new children are loaded the same way, removed
+ones are dropped). Reads for a path that is loaded and has no refresh
+pending are answered from memory, anything else goes to the server.
+
+Ordering: replies (and so their rawlink callbacks) come in the order the
+server sent them, so every change is applied in that order from kazoo's
+completion thread. A path is pending from the moment a notification is
+received until the refresh it triggered is applied, and this session
+gets the notification for its own write before the reply to it: once the
+watch callbacks that are queued have run (see Subtrees.flush()), reads
+never return stale data after a write from this session. After
+Subtrees.mark_stale(), the first lookup that hits a cache flushes first
+(and reloads the caches lost with a session), so commands that don't read
+under a cached subtree don't pay for it.
+
+ACL changes fire no watches, so the cached stats' aversion might lag.
+
+Reads that fail because the connection was lost are sent again once it's
+back (meanwhile, their paths are read from the server). Only losing the
+session, and its watches with it, expires a cache: it's loaded again
+from scratch. Znodes that can't be read otherwise (i.e.: NoAuth) are
+left out and read from the server.
+
+A listener, if given, is called (from the completion thread, with the
+lock held) with each path that's notified about, dropped or discovered,
+and whether it's new (see zk_shell.follow).
+
+  Example usage:
+    >>> from zk_shell.subtree import Subtrees
+    >>> subtrees = Subtrees(zk)
+    >>> subtrees.start("/services/registrations")
+    12083
+    >>> subtrees.flush()
+    >>> subtrees.lookup("/services/registrations/web-0").value
+    (b'{"host": "10.0.0.2"}', ZnodeStat(czxid=...))
+    >>> subtrees.stop("/services/registrations")
+    True
+
+"""
+
+from functools import partial
+import os
+import sys
+import threading
+import time
+
+from kazoo.exceptions import (
+    ConnectionLoss,
+    KazooException,
+    NoNodeError,
+    OperationTimeoutError,
+    SessionExpiredError,
+)
+from kazoo.protocol.states import Callback, KazooState
+
+from .pipeline import pipelined
+from .util import DEFAULT_MAX_INFLIGHT
+
+
+DATA, CHILDREN = 0, 1
+
+# how smooth (0-1, higher is less) the lag average is
+LAG_WEIGHT = 0.2
+
+# seconds to wait for queued callbacks
+FLUSH_TIMEOUT = 1.0
+
+
+def covers(root, path):
+    """ True if path is root or under it """
+    return path == root or path.startswith(root.rstrip("/") + "/")
+
+
+class Znode(object):
+    """ value is (data, stat), children a tuple of names """
+    __slots__ = ("value", "children")
+
+    def __init__(self, value=None, children=None):
+        self.value, self.children = value, children
+
+    @property
+    def loaded(self):
+        return self.value is not None and self.children is not None
+
+    def size(self):
+        """ approximate bytes used """
+        size = sys.getsizeof(self)
+        if self.value is not None:
+            size += sys.getsizeof(self.value[0]) + sys.getsizeof(self.value[1])
+        if self.children is not None:
+            size += sys.getsizeof(self.children) + sum(sys.getsizeof(c) for c in self.children)
+        return size
+
+
+class SubtreeCache(object):
+    """ a mirror of the subtree at path """
+    __slots__ = (
+        "zk", "path", "listener", "lock", "znodes", "pending", "expired", "unsent",
+        "hits", "misses", "events", "lag", "max_lag", "loaded_in",
+    )
+
+    def __init__(self, zk, path, listener=None):
+        self.zk, self.path, self.listener = zk, path, listener
+        self.lock = threading.RLock()
+        self.znodes = {}
+        self.pending = {}
+        self.expired = False
+        # reads to send again once reconnected
+        self.unsent = []
+        self.hits = self.misses = self.events = 0
+        self.lag = self.max_lag = 0.0
+        self.loaded_in = None
+
+    def load(self, max_inflight=DEFAULT_MAX_INFLIGHT):
+        """ loads the subtree, level by level, returns the number of znodes """
+        start = time.time()
+        with self.lock:
+            self.znodes.clear()
+            self.pending.clear()
+            del self.unsent[:]
+            self.expired = False
+
+        level = [self.path]
+        while level:
+            requests = []
+            for path in level:
+                requests.append(((DATA, path), partial(self._fetch, DATA, path)))
+                requests.append(((CHILDREN, path), partial(self._fetch, CHILDREN, path)))
+
+            level = []
+            for (kind, path), value, _ in pipelined(requests, max_inflight):
+                if kind == CHILDREN and value is not None:
+                    level.extend(os.path.join(path, child) for child in value[0])
+
+        # the replies are applied from the completion thread, wait for the last ones
+        done = self.zk.handler.event_object()
+        barrier = self.zk.handler.async_result()
+        barrier.rawlink(lambda _: done.set())
+        barrier.set(None)
+        done.wait(FLUSH_TIMEOUT)
+
+        self.loaded_in = time.time() - start
+        return len(self.znodes)
+
+    def lookup(self, path):
+        """ the Znode for path if it's loaded & current, None otherwise """
+        if self.expired:
+            return None
+
+        znode = self.znodes.get(path)
+        if znode is None or not znode.loaded or path in self.pending:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return znode
+
+    def absent(self, path):
+        """ True if path is known not to exist """
+        if self.expired or path == self.path:
+            return False
+
+        parent = os.path.dirname(path)
+        znode = self.znodes.get(parent)
+        if znode is None or znode.children is None or parent in self.pending:
+            return False
+
+        if os.path.basename(path) in znode.children:
+            return False
+
+        self.hits += 1
+        return True
+
+    def reconnected(self):
+        """ sends again the reads that failed while disconnected """
+        with self.lock:
+            unsent, self.unsent = self.unsent, []
+            for args in unsent:
+                self._fetch(*args)
+
+    def size(self):
+        """ approximate bytes used """
+        with self.lock:
+            return sum(sys.getsizeof(p) + z.size() for p, z in self.znodes.items())
+
+    def _fetch(self, kind, path, refresh=False, discover=False):
+        """
+        sends the read (which sets the watch) and applies its reply when it
+        comes. With discover, the children that are found are fetched too
+        (otherwise load() takes care of them)
+        """
+        if kind == DATA:
+            result = self.zk.get_async(path, watch=self._data_changed)
+        else:
+            result = self.zk.get_children_async(path, watch=self._children_changed, include_data=True)
+        result.rawlink(partial(self._apply, kind, path, refresh, discover))
+        return result
+
+    def _apply(self, kind, path, refresh, discover, result):
+        try:
+            value = result.get()
+        except NoNodeError:
+            value = None
+        except SessionExpiredError:
+            # the watches are gone, start over (see Subtrees.flush())
+            self.expired = True
+            return
+        except (ConnectionLoss, OperationTimeoutError):
+            # the watch might not be set, read it again once reconnected. Meanwhile
+            # path is pending (or not loaded yet), and what's under it is discovered then
+            args = (kind, path, refresh, discover or not refresh)
+            with self.lock:
+                if self.zk.connected:
+                    self._fetch(*args)
+                else:
+                    self.unsent.append(args)
+            return
+        except KazooException:
+            with self.lock:
+                if refresh:
+                    self._done(kind, path)
+                self._unload(kind, path)
+            return
+
+        with self.lock:
+            if refresh:
+                self._done(kind, path)
+
+            if discover:
+                self._touched(path, value is not None)
+
+            if value is None:
+                self._drop(path)
+                return
+
+            # replies for what was under a removed znode
+            if path != self.path and os.path.dirname(path) not in self.znodes:
+                return
+
+            znode = self.znodes.setdefault(path, Znode())
+            if kind == DATA:
+                znode.value = value
+                return
+
+            children, stat = value
+            old = znode.children or ()
+            znode.children = tuple(children)
+            if znode.value is not None:
+                # cversion, numChildren & pzxid changed without a data watch firing
+                znode.value = (znode.value[0], stat)
+
+            for child in set(old).difference(children):
+                self._drop(os.path.join(path, child))
+                self._touched(os.path.join(path, child), False)
+
+            if refresh or discover:
+                for child in set(children).difference(old):
+                    self._fetch(DATA, os.path.join(path, child), discover=True)
+                    self._fetch(CHILDREN, os.path.join(path, child), discover=True)
+
+    def _unload(self, kind, path):
+        """ path is read from the server from now on (called with the lock held) """
+        znode = self.znodes.get(path)
+        if znode is None:
+            return
+        if kind == DATA:
+            znode.value = None
+        else:
+            znode.children = None
+
+    def _drop(self, path):
+        znode = self.znodes.pop(path, None)
+        if znode is not None and znode.children:
+            for child in znode.children:
+                self._drop(os.path.join(path, child))
+
+    def _notified(self, kind, event):
+        if self.expired:
+            return
+
+        with self.lock:
+            self.events += 1
+            kinds = self.pending.setdefault(event.path, {})
+            count, first = kinds.get(kind, (0, time.time()))
+            kinds[kind] = (count + 1, first)
+            self._touched(event.path, False)
+
+        self._fetch(kind, event.path, refresh=True)
+
+    def _touched(self, path, new):
+        if self.listener is not None:
+            self.listener(path, new)
+
+    def _done(self, kind, path):
+        """ a refresh was applied (called with the lock held) """
+        kinds = self.pending.get(path)
+        if kinds is None or kind not in kinds:
+            # pending was reset by a reload
+            return
+
+        count, first = kinds[kind]
+        if count > 1:
+            kinds[kind] = (count - 1, first)
+            return
+
+        del kinds[kind]
+        if not kinds:
+            del self.pending[path]
+
+        lag = time.time() - first
+        self.lag += LAG_WEIGHT * (lag - self.lag)
+        self.max_lag = max(self.max_lag, lag)
+
+    def _data_changed(self, event):
+        self._notified(DATA, event)
+
+    def _children_changed(self, event):
+        self._notified(CHILDREN, event)
+
+
+class Subtrees(object):
+    """ the SubtreeCaches of a client """
+    __slots__ = ("zk", "caches", "stale")
+
+    def __init__(self, zk):
+        self.zk = zk
+        self.caches = []
+        # the thread that's due to flush before its next lookup, if any
+        self.stale = None
+        zk.add_listener(self._state_changed)
+
+    def __len__(self):
+        return len(self.caches)
+
+    def __iter__(self):
+        return iter(list(self.caches))
+
+    def get(self, path):
+        """ the cache that covers path, if any """
+        for cache in self.caches:
+            if covers(cache.path, path):
+                return cache
+        return None
+
+    def start(self, path, max_inflight=DEFAULT_MAX_INFLIGHT):
+        """ starts caching path, raises ValueError if it overlaps another cache """
+        for cache in self.caches:
+            if covers(cache.path, path) or covers(path, cache.path):
+                raise ValueError("%s overlaps the cache for %s" % (path, cache.path))
+
+        cache = SubtreeCache(self.zk, path)
+        count = cache.load(max_inflight)
+        self.caches.append(cache)
+        return count
+
+    def stop(self, path):
+        """ stops caching path (the watches will just fire into the void) """
+        for cache in self.caches:
+            if cache.path == path:
+                self.caches.remove(cache)
+                cache.expired = True
+                return True
+        return False
+
+    def mark_stale(self):
+        """ the next lookup from this thread that hits a cache flushes first """
+        if self.caches:
+            self.stale = threading.current_thread()
+
+    def flush(self):
+        """ runs the watch callbacks already queued & reloads caches lost with a session """
+        self.stale = None
+        if not self.caches:
+            return
+
+        done = self.zk.handler.event_object()
+        self.zk.handler.dispatch_callback(Callback("subtrees", done.set, ()))
+        done.wait(FLUSH_TIMEOUT)
+
+        for cache in self.caches:
+            if cache.expired and self.zk.connected:
+                cache.load()
+
+    def lookup(self, path):
+        """ the current Znode for path, if it's cached """
+        cache = self._current(path)
+        return cache.lookup(path) if cache else None
+
+    def absent(self, path):
+        """ True if path is cached as not existing """
+        cache = self._current(path)
+        return cache.absent(path) if cache else False
+
+    def _current(self, path):
+        """
+        the cache that covers path, flushed if it's due. Other threads (i.e.:
+        kazoo's, which can't wait for a flush) go to the server meanwhile
+        """
+        cache = self.get(path)
+        stale = self.stale
+        if cache is None or stale is None:
+            return cache
+        if stale is not threading.current_thread():
+            return None
+        self.flush()
+        return cache
+
+    def _state_changed(self, state):
+        # the watches are gone along with the session
+        if state == KazooState.LOST:
+            for cache in self.caches:
+                cache.expired = True
+        elif state == KazooState.CONNECTED:
+            for cache in self.caches:
+                cache.reconnected()
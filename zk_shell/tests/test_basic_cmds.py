@@ -6,6 +6,7 @@ import socket
 
 from .shell_test_case import PYTHON3, ShellTestCase
 
+from kazoo.security import make_acl, OPEN_ACL_UNSAFE
 from kazoo.testing.harness import get_global_cluster
 
 
@@ -48,6 +49,34 @@ class BasicCmdsTestCase(ShellTestCase):
         self.assertEqual("Path %s/one doesn't exist\n" % (
             self.tests_path), self.output.getvalue())
 
+    def test_path_cache(self):
+        """ cached children & existence follow changes """
+        self.shell.onecmd("conf set path_cache_size 1000")
+        self.shell.onecmd("create %s/one 'hello'" % (self.tests_path))
+        self.shell.onecmd("cd %s" % (self.tests_path))
+        self.assertEqual(["one"], self.shell.complete_cd("", "cd ", 0, 0))
+        self.shell.onecmd("create %s/two 'hello'" % (self.tests_path))
+        self.shell.onecmd("rm %s/one" % (self.tests_path))
+        self.assertEqual(["two"], self.shell.complete_cd("", "cd ", 0, 0))
+        self.shell.onecmd("get one")
+        self.assertEqual("Path %s/one doesn't exist\n" % (
+            self.tests_path), self.output.getvalue())
+        self.assertGreater(self.shell.client.path_cache.hits, 0)
+
+    def test_cache_subtree(self):
+        """ reads under a cached subtree follow changes """
+        self.shell.onecmd("create %s/one 'hello' false false true" % (self.tests_path))
+        self.shell.onecmd("cache start %s" % (self.tests_path))
+        self.shell.onecmd("get %s/one" % (self.tests_path))
+        self.shell.onecmd("set %s/one 'bye'" % (self.tests_path))
+        self.shell.onecmd("get %s/one" % (self.tests_path))
+        self.shell.onecmd("create %s/two 'hi'" % (self.tests_path))
+        self.shell.onecmd("ls %s" % (self.tests_path))
+        self.shell.onecmd("cache stop %s" % (self.tests_path))
+        expected = "Cached 2 znodes under %s in " % (self.tests_path)
+        self.assertTrue(self.output.getvalue().startswith(expected))
+        self.assertTrue(self.output.getvalue().endswith("hello\nbye\none\ntwo\n"))
+
     def test_create_delete_recursive(self):
         """ create & delete a znode recursively """
         self.shell.onecmd("create %s/one 'hello'" % (self.tests_path))
@@ -84,6 +113,21 @@ class BasicCmdsTestCase(ShellTestCase):
         self.shell.onecmd("du %s/one" % (self.tests_path))
         self.assertEqual("5\n", self.output.getvalue())
 
+    def test_du_breakdown(self):
+        """ test breaking down a path's size by subtree """
+        self.shell.onecmd("create %s/one/a 'hello' false false true" % (self.tests_path))
+        self.shell.onecmd("create %s/two 'hi'" % (self.tests_path))
+        self.shell.onecmd("du %s 1 1" % (self.tests_path))
+        expected = [
+            "Total: 7 in 4 znodes",
+            "Subtrees:",
+            "Bytes       Znodes      Path",
+            "5           2           %s/one" % (self.tests_path),
+            "Largest znodes:",
+            "5           %s/one/a" % (self.tests_path),
+        ]
+        self.assertEqual(expected, self.output.getvalue().split("\n")[:len(expected)])
+
     def test_set_get_acls(self):
         """ test setting & getting acls for a path """
         self.shell.onecmd("create %s/one 'hello'" % (self.tests_path))
@@ -122,6 +166,50 @@ class BasicCmdsTestCase(ShellTestCase):
 
         self.assertEqual(expected_output, self.output.getvalue())
 
+    def test_get_acls_recursive_unlistable(self):
+        """ the ACLs of a znode whose children can't be listed are still shown """
+        path_two = "%s/one/two" % (self.tests_path)
+        self.shell.onecmd("create %s/three 'hello' false false true" % (path_two))
+        self.shell.onecmd("set_acls %s 'world:anyone:a'" % (path_two))
+        try:
+            self.shell.onecmd("get_acls %s/one 0" % (self.tests_path))
+        finally:
+            self.client.set_acls(path_two, OPEN_ACL_UNSAFE)
+
+        paths = [line.split(":")[0] for line in self.output.getvalue().split("\n") if line]
+        self.assertEqual(["/tests/one", "/tests/one/two"], paths)
+
+    def test_set_acls_recursive_max_inflight(self):
+        """ recursive set_acls with a single outstanding write """
+        paths = ["%s/one" % (self.tests_path),
+                 "%s/one/two" % (self.tests_path),
+                 "%s/one/three" % (self.tests_path),
+                 "%s/one/two/four" % (self.tests_path)]
+        for path in paths:
+            self.shell.onecmd("create %s 'hello'" % (path))
+        self.shell.onecmd("conf set write_max_inflight 1")
+        self.shell.onecmd("set_acls %s 'world:anyone:r digest:%s:cdrwa' true" % (
+            paths[0], self.auth_digest))
+
+        self.assertEqual("", self.output.getvalue())
+        for path in paths:
+            acls, _ = self.client.get_acls(path)
+            self.assertEqual(2, len(acls))
+
+    def test_set_acls_recursive_unlistable(self):
+        """ subtrees that can't be listed are reported """
+        path_two = "%s/one/two" % (self.tests_path)
+        self.shell.onecmd("create %s/three 'hello' false false true" % (path_two))
+        self.shell.onecmd("set_acls %s 'world:anyone:a'" % (path_two))
+        try:
+            self.shell.onecmd("set_acls %s/one 'world:anyone:cdrwa' true" % (self.tests_path))
+        finally:
+            self.client.set_acls(path_two, OPEN_ACL_UNSAFE)
+
+        lines = self.output.getvalue().split("\n")
+        self.assertEqual("Couldn't list the children of 1 path(s), so they were skipped:", lines[0])
+        self.assertTrue(lines[1].startswith("  %s: " % (path_two)))
+
     def test_set_get_bad_acl(self):
         """ make sure we handle badly formed acls"""
         path_one = "%s/one" % (self.tests_path)
@@ -141,6 +229,39 @@ class BasicCmdsTestCase(ShellTestCase):
         self.shell.onecmd("find %s/ one" % (self.tests_path))
         self.assertEqual("/tests/one\n", self.output.getvalue())
 
+    def test_find_max_inflight(self):
+        """ a window of 1 outstanding request still walks the whole tree """
+        self.shell.onecmd("conf set traversal_max_inflight 1")
+        self.shell.onecmd("create %s/one/two/three 'hello' false false true" % (self.tests_path))
+        self.shell.onecmd("create %s/four 'goodbye'" % (self.tests_path))
+        self.shell.onecmd("find %s/ t" % (self.tests_path))
+        self.assertEqual(
+            "/tests/one/two\n/tests/one/two/three\n", self.output.getvalue())
+
+    def test_find_read_sessions(self):
+        """ top-level subtrees split among extra sessions """
+        self.shell.onecmd("conf set traversal_sessions 2")
+        for i in range(0, 5):
+            self.shell.onecmd("create %s/%d/two 'hello' false false true" % (self.tests_path, i))
+        self.shell.onecmd("find %s/ two" % (self.tests_path))
+        self.shell.onecmd("du %s" % (self.tests_path))
+        expected = ["/tests/%d/two" % (i) for i in range(0, 5)] + ["25"]
+        self.assertEqual(sorted(expected), sorted(self.output.getvalue().split()))
+        self.assertEqual(2, len(self.shell.client._read_sessions))
+
+    def test_find_children_cache(self):
+        """ big children lists are only fetched again when they change """
+        self.shell.onecmd("conf set traversal_children_cache 1000000")
+        for i in range(0, 100):
+            self.shell.onecmd("create %s/%d 'hello' false false true" % (self.tests_path, i))
+        self.shell.onecmd("find %s/ 99" % (self.tests_path))
+        self.shell.onecmd("create %s/199 'hello'" % (self.tests_path))
+        self.shell.onecmd("find %s/ 99" % (self.tests_path))
+        self.shell.onecmd("find %s/ 99" % (self.tests_path))
+        expected = ["/tests/199", "/tests/199", "/tests/99", "/tests/99", "/tests/99"]
+        self.assertEqual(expected, sorted(self.output.getvalue().split()))
+        self.assertEqual(1, self.shell.client.children_cache.hits)
+
     def test_ifind(self):
         """ test case-insensitive find """
         self.shell.onecmd("create %s/ONE 'hello'" % (self.tests_path))
@@ -156,6 +277,18 @@ class BasicCmdsTestCase(ShellTestCase):
         self.shell.onecmd("grep %s hello" % (self.tests_path))
         self.assertEqual("%s\n" % (path), self.output.getvalue())
 
+    def test_grep_ordered(self):
+        """ matches are printed in DFS order """
+        for path in ["one", "one/two", "three"]:
+            self.shell.onecmd("create %s/%s 'hello'" % (self.tests_path, path))
+        self.shell.onecmd("grep %s hello ordered=true" % (self.tests_path))
+        expected = []
+        for child in self.client.get_children(self.tests_path):
+            cpath = "%s/%s" % (self.tests_path, child)
+            expected.append(cpath)
+            expected.extend("%s/%s" % (cpath, c) for c in self.client.get_children(cpath))
+        self.assertEqual("".join("%s\n" % p for p in expected), self.output.getvalue())
+
     def test_igrep(self):
         """ test case-insensitive grep """
         path = "%s/semi/long/path" % (self.tests_path)
@@ -322,6 +455,30 @@ class BasicCmdsTestCase(ShellTestCase):
         self.shell.onecmd("exists %s/a" % self.tests_path)
         self.assertIn("numChildren=0", self.output.getvalue())
 
+    def test_rmr_wide(self):
+        """ rmr a subtree that needs a few batches per level """
+        for i in range(0, 30):
+            for j in range(0, 10):
+                self.client.create("%s/a/%d/%d" % (self.tests_path, i, j), makepath=True)
+        self.shell.onecmd("conf set write_max_inflight 2")
+        self.shell.onecmd("rmr %s/a" % self.tests_path)
+        self.assertEqual(None, self.client.exists("%s/a" % self.tests_path))
+        self.assertEqual([], self.client.get_children(self.tests_path))
+
+    def test_rmr_unlistable(self):
+        """ a subtree that can't be listed is reported as such """
+        path_two = "%s/a/b" % (self.tests_path)
+        self.client.create("%s/c" % (path_two), makepath=True)
+        self.client.set_acls(path_two, [make_acl("world", "anyone", delete=True, admin=True)])
+        try:
+            self.shell.onecmd("rmr %s/a" % self.tests_path)
+        finally:
+            self.client.set_acls(path_two, OPEN_ACL_UNSAFE)
+
+        self.assertEqual("Not authorized to list the children of %s.\n" % (path_two),
+                         self.output.getvalue())
+        self.assertIsNotNone(self.client.exists("%s/c" % (path_two)))
+
     def test_conf_get_all(self):
         self.shell.onecmd("conf get")
         self.assertIn("chkzk_stat_retries", self.output.getvalue())
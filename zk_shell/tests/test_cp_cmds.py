@@ -2,14 +2,20 @@
 
 """test cp cmds"""
 
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from collections import OrderedDict
 import json
+import os
 import zlib
 
 from .shell_test_case import PYTHON3, ShellTestCase
 
+from kazoo.exceptions import NoAuthError
 from kazoo.testing.harness import get_global_cluster
 
+from zk_shell.checkpoint import Checkpoint
+from zk_shell.copy import CopyError, Proxy
+
 
 # pylint: disable=R0904
 class CpCmdsTestCase(ShellTestCase):
@@ -23,6 +29,14 @@ class CpCmdsTestCase(ShellTestCase):
         """ copy from one zk cluster to another (async) """
         self.zk2zk(async=True)
 
+    def test_cp_zk2zk_overwrite(self):
+        """ copy onto existing znodes, skipping ephemerals """
+        self.zk2zk_overwrite(async=False)
+
+    def test_cp_zk2zk_async_overwrite(self):
+        """ pipelined copy onto existing znodes, skipping ephemerals """
+        self.zk2zk_overwrite(async=True)
+
     def test_zk2json(self):
         """ copy from zk to a json file (uncompressed) """
         self.zk2json(compressed=False, async=False)
@@ -65,6 +79,62 @@ class CpCmdsTestCase(ShellTestCase):
         """ copy from a json file to a ZK cluster (compressed) """
         self.json2zk(compressed=True, async=True)
 
+    def test_json2zk_async_nested(self):
+        """ copy a json file whose parents come after their children, or are missing (async) """
+        json_file = "%s/backup.json" % (self.temp_dir)
+        tree = [
+            ("/backup/a/b/c", u"deep"),
+            ("/backup/x", u"x"),
+            ("/backup/a", u"top"),
+            ("/backup", u""),
+        ]
+        with open(json_file, "w") as fph:
+            fph.write(json.dumps(OrderedDict(
+                (path, {"content": b64encode(value.encode()).decode(), "acls": []})
+                for path, value in tree)))
+
+        json_url = "json://%s/backup" % (json_file.replace("/", "!"))
+        dst_zk = "zk://%s/%s/from-json" % (self.zk_hosts, self.tests_path)
+        self.shell.onecmd("cp %s %s recursive=true overwrite=true async=true" % (json_url, dst_zk))
+        self.shell.onecmd("get %s/from-json/a/b/c" % (self.tests_path))
+        self.shell.onecmd("get %s/from-json/a" % (self.tests_path))
+        self.shell.onecmd("get %s/from-json/x" % (self.tests_path))
+        self.assertTrue(self.output.getvalue().endswith("deep\ntop\nx\n"))
+        self.assertEqual(b"", self.client.get("%s/from-json/a/b" % (self.tests_path))[0])
+
+    def test_cp_async_resume(self):
+        """ resuming a failed copy doesn't skip the znodes whose writes were in flight """
+        src_path = "%s/src" % (self.tests_path)
+        dst_path = "%s/dst" % (self.tests_path)
+        for i in range(0, 20):
+            self.client.create("%s/%d/child" % (src_path, i), b"HELLO", makepath=True)
+        filename = os.path.join(self.temp_dir, "checkpoint.json")
+
+        def copy(checkpoint, failing=None):
+            src = Proxy.from_string("zk://%s%s" % (self.zk_hosts, src_path), True, True)
+            dst = Proxy.from_string("zk://%s%s" % (self.zk_hosts, dst_path), None, True)
+            write_path_async = dst.write_path_async
+
+            def write(path, *args):
+                if path != failing:
+                    return write_path_async(path, *args)
+                result = dst.client.handler.async_result()
+                result.set_exception(NoAuthError())
+                return result
+
+            dst.write_path_async = write
+            src.copy(dst, True, 0, False, checkpoint)
+
+        failing = "%s/10/child" % (dst_path)
+        self.assertRaises(CopyError, copy, Checkpoint(filename, interval=0), failing)
+        self.assertIsNone(self.client.exists(failing))
+
+        checkpoint = Checkpoint(filename, resume=True)
+        self.assertTrue(checkpoint.resumed)
+        copy(checkpoint)
+        for i in range(0, 20):
+            self.assertIsNotNone(self.client.exists("%s/%d/child" % (dst_path, i)))
+
     def test_json2zk_bad(self):
         """ try to copy from non-existent path in json to zk """
         jsonf = ("%s/backup.json" % (self.temp_dir)).replace("/", "!")
@@ -117,6 +187,24 @@ class CpCmdsTestCase(ShellTestCase):
 """
         self.assertEqual(expected_output, self.output.getutf8())
 
+    def zk2zk_overwrite(self, async):
+        """ helper for copying onto existing znodes """
+        host = self.zk_hosts
+        src = "%s/src" % (self.tests_path)
+        dst = "%s/dst" % (self.tests_path)
+        self.shell.onecmd("create %s/one 'new' ephemeral=false sequence=false recursive=true" % (src))
+        self.shell.onecmd("create %s/two 'same' ephemeral=false sequence=false recursive=true" % (src))
+        self.shell.onecmd("create %s/eph 'e' ephemeral=true" % (src))
+        self.shell.onecmd("create %s/one 'old' ephemeral=false sequence=false recursive=true" % (dst))
+        self.shell.onecmd("create %s/two 'same' ephemeral=false sequence=false recursive=true" % (dst))
+        self.shell.onecmd("cp zk://%s%s zk://%s%s recursive=true overwrite=true async=%s" % (
+            host, src, host, dst, "true" if async else "false"))
+        self.assertEqual(b"new", self.client.get("%s/one" % (dst))[0])
+        self.assertEqual(1, self.client.exists("%s/one" % (dst)).version)
+        self.assertIsNone(self.client.exists("%s/eph" % (dst)))
+        # unchanged values aren't written
+        self.assertEqual(0, self.client.exists("%s/two" % (dst)).version)
+
     def zk2json(self, compressed, async):
         """ helper for copying from zk to json """
         src_path = "%s/src" % (self.tests_path)
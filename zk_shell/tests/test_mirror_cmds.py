@@ -6,6 +6,9 @@ from base64 import b64decode
 import json
 import zlib
 
+from zk_shell.copy import Proxy
+from zk_shell.follow import Follower
+
 from .shell_test_case import PYTHON3, ShellTestCase
 
 
@@ -28,6 +31,70 @@ class MirrorCmdsTestCase(ShellTestCase):
 """
         self.assertEqual(expected_output, self.output.getutf8())
 
+    def test_mirror_watermark(self):
+        """ incremental mirrors only read & write what changed """
+        src_path = "%s/src" % (self.tests_path)
+        dst_path = "%s/dst" % (self.tests_path)
+        state = "%s/mirror.state" % (self.temp_dir)
+        self.shell.onecmd("create %s/a/one 'HELLO' false false true" % (src_path))
+        self.shell.onecmd("create %s/b 'HELLO' false false true" % (src_path))
+        self.shell.onecmd("create %s/stale 'OLD' false false true" % (dst_path))
+        mirror = "mirror zk://%s%s zk://%s%s true false true false %s" % (
+            self.zk_hosts, src_path, self.zk_hosts, dst_path, state)
+
+        self.shell.onecmd(mirror)
+        self.assertIn("values read: 4, children lists read: 4, written: 4, deleted: 1",
+                      self.output.getvalue())
+        self.assertIsNone(self.client.exists("%s/stale" % (dst_path)))
+
+        self.output.reset()
+        self.shell.onecmd(mirror)
+        self.assertIn("values read: 0, children lists read: 0, written: 0, deleted: 0",
+                      self.output.getvalue())
+
+        self.shell.onecmd("set %s/a/one 'BYE'" % (src_path))
+        self.shell.onecmd("rmr %s/b" % (src_path))
+        self.output.reset()
+        self.shell.onecmd(mirror)
+        self.assertIn("values read: 1, children lists read: 1, written: 1, deleted: 1",
+                      self.output.getvalue())
+        self.assertEqual(b"BYE", self.client.get("%s/a/one" % (dst_path))[0])
+        self.assertIsNone(self.client.exists("%s/b" % (dst_path)))
+
+    def test_mirror_follow(self):
+        """ after mirroring, changes are applied as they're notified """
+        src_path = "%s/src" % (self.tests_path)
+        dst_path = "%s/dst" % (self.tests_path)
+        self.shell.onecmd("create %s/a/one 'HELLO' false false true" % (src_path))
+        self.shell.onecmd("create %s/b 'HELLO' false false true" % (src_path))
+        src = Proxy.from_string("zk://%s%s" % (self.zk_hosts, src_path), True, True)
+        dst = Proxy.from_string("zk://%s%s" % (self.zk_hosts, dst_path), None, True)
+        follower = Follower(src, dst, interval=0.1)
+        follower.start()
+        self.assertEqual(b"HELLO", self.client.get("%s/b" % (dst_path))[0])
+
+        self.client.set("%s/a/one" % (src_path), b"BYE")
+        self.client.create("%s/c/two" % (src_path), b"NEW", makepath=True)
+        self.client.delete("%s/b" % (src_path))
+        for _ in follower.run(50):
+            if self.client.exists("%s/c/two" % (dst_path)) and \
+               not self.client.exists("%s/b" % (dst_path)) and \
+               self.client.get("%s/a/one" % (dst_path))[0] == b"BYE":
+                break
+        follower.stop()
+
+        self.assertEqual(b"BYE", self.client.get("%s/a/one" % (dst_path))[0])
+        self.assertEqual(b"NEW", self.client.get("%s/c/two" % (dst_path))[0])
+        self.assertIsNone(self.client.exists("%s/b" % (dst_path)))
+        self.assertGreater(follower.max_lag, 0)
+
+    def test_mirror_follow_needs_zk(self):
+        """ following needs watches """
+        json_file = "%s/backup.json" % (self.temp_dir)
+        self.shell.onecmd("mirror json://%s/backup %s/dst false false true false '' true" % (
+            json_file.replace("/", "!"), self.tests_path))
+        self.assertEqual("Following needs a zk:// source\n", self.output.getvalue())
+
     def test_mirror_zk2json(self):
         """ mirror from zk to a json file (uncompressed) """
         src_path = "%s/src" % (self.tests_path)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+""" test cmds against a (synthetic) snapshot """
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from kazoo.security import make_digest_acl
+
+from zk_shell.shell import Shell
+from zk_shell.snapshot import Snapshot, SnapshotError, write_snapshot
+
+from .shell_test_case import XStringIO
+
+
+# pylint: disable=R0904
+class SnapshotTestCase(unittest.TestCase):
+    """ read-only query mode over a snapshot file """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.temp_dir, "snapshot.1a")
+        self.acl = make_digest_acl("user", "user", all=True)
+        write_snapshot(
+            self.snapshot,
+            {
+                "/configs/a": b"hello",
+                "/configs/b": b'{"x": 1}',
+                "/services/web-0": b'{"host": "10.0.0.2"}',
+                "/services/web-1": b'{"host": "10.0.0.3"}',
+            },
+            acls={"/configs/a": [self.acl]},
+            ephemerals={"/services/web-1": 0x1234})
+        self.output = XStringIO()
+        self.shell = Shell(["snapshot://%s" % (self.snapshot)], 5, self.output,
+                           setup_readline=False, async=False)
+
+    def tearDown(self):
+        self.shell.onecmd("disconnect")
+        self.output.close()
+        shutil.rmtree(self.temp_dir, True)
+
+    def test_read(self):
+        """ znodes, stats & acls """
+        snapshot = Snapshot(self.snapshot)
+        self.assertEqual(0x1a, snapshot.zxid)
+        self.assertEqual({0x1234: 10000}, snapshot.sessions)
+        self.assertEqual(["a", "b"], sorted(snapshot.get_children("/configs")))
+        value, stat = snapshot.get("/configs/a")
+        self.assertEqual((b"hello", 5), (value, stat.dataLength))
+        self.assertEqual([self.acl], snapshot.get_acls("/configs/a")[0])
+        self.assertEqual(0x1234, snapshot.exists("/services/web-1").ephemeralOwner)
+        self.assertEqual(2, snapshot.exists("/services").numChildren)
+        snapshot.close()
+
+    def test_truncated(self):
+        """ a partial copy is detected """
+        with open(self.snapshot, "rb") as fh:
+            content = fh.read()
+        with open(self.snapshot, "wb") as fh:
+            fh.write(content[:len(content) // 2])
+        self.assertRaises(SnapshotError, Snapshot, self.snapshot)
+
+    def test_ls_get(self):
+        """ basic reads """
+        self.shell.onecmd("ls /configs")
+        self.shell.onecmd("get /configs/a")
+        self.assertEqual("a\nb\nhello\n", self.output.getvalue())
+
+    def test_scans(self):
+        """ du, find & grep """
+        self.shell.onecmd("du /")
+        self.shell.onecmd("find / web")
+        self.shell.onecmd("grep /services 10.0.0.3")
+        expected = ["/services/web-0", "/services/web-1", "/services/web-1", "53"]
+        self.assertEqual(expected, sorted(self.output.getvalue().split()))
+
+    def test_du_breakdown(self):
+        """ subtrees, largest znodes & value sizes in one pass """
+        self.shell.onecmd("du / 1 2")
+        expected = [
+            "Total: 53 in 9 znodes",
+            "Subtrees:",
+            "Bytes       Znodes      Path",
+            "40          3           /services",
+            "13          3           /configs",
+            "Largest znodes:",
+            "20          /services/web-1",
+            "20          /services/web-0",
+            "Value sizes:",
+            "0                       5",
+            "1 - 64                  4",
+        ]
+        self.assertEqual(expected, self.output.getvalue().split("\n")[:len(expected)])
+
+    def test_summary_sort(self):
+        """ sort keys & negative tops """
+        self.shell.onecmd("summary /configs -1 dataLength")
+        self.shell.onecmd("summary / -2 numChildren")
+        names = [line.split()[-1] for line in self.output.getvalue().split("\n") if line]
+        self.assertEqual(["Name", "b", "Name", "configs", "services"], names)
+
+    def test_summary_bad_sort(self):
+        """ unknown keys """
+        self.shell.onecmd("summary / 0 size")
+        self.assertTrue(self.output.getvalue().startswith("Unknown sort key: size"))
+
+    def test_json_get(self):
+        """ json cmds """
+        self.shell.onecmd("json_get /configs/b x")
+        self.assertEqual("1\n", self.output.getvalue())
+
+    def test_read_only(self):
+        """ writes fail """
+        self.shell.onecmd("set /configs/a bye")
+        self.assertEqual("Not a read-only operation.\n", self.output.getvalue())
+
+    def test_cp_to_json(self):
+        """ copy out of a snapshot, skipping ephemerals """
+        backup = os.path.join(self.temp_dir, "backup.json")
+        self.shell.onecmd("cp /services json://%s/services true true" % (backup.replace("/", "!")))
+        with open(backup) as fh:
+            paths = sorted(json.load(fh).keys())
+        self.assertEqual(["/services", "/services/web-0"], paths)
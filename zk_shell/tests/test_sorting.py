@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+""" test bounded-memory sorting """
+
+import random
+import unittest
+
+from zk_shell.sorting import external_sort, top
+
+
+# pylint: disable=R0904
+class SortingTestCase(unittest.TestCase):
+    """ top & external_sort """
+
+    def setUp(self):
+        rand = random.Random(42)
+        self.items = [(rand.randint(0, 50), "item-%d" % i) for i in range(0, 1000)]
+
+    def test_top(self):
+        """ first, last & all """
+        key = lambda item: item[0]
+        ordered = sorted(self.items, key=key)
+        self.assertEqual([k for k, _ in ordered[:5]], [k for k, _ in top(iter(self.items), 5, key)])
+        self.assertEqual([k for k, _ in ordered[-5:]], [k for k, _ in top(iter(self.items), -5, key)])
+        self.assertEqual(ordered, top(iter(self.items), 0, key))
+
+    def test_external_sort(self):
+        """ spilled runs are merged, keeping the order of ties """
+        key = lambda item: item[0]
+        result = list(external_sort(iter(self.items), key, max_bytes=100, size=lambda _: 1))
+        self.assertEqual(sorted(self.items, key=key), result)
+
+    def test_in_memory(self):
+        """ nothing spilled """
+        key = lambda item: item[1]
+        self.assertEqual(sorted(self.items, key=key), list(external_sort(iter(self.items), key)))
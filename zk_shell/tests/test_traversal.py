@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""test the async traversal engine"""
+
+import os
+import shutil
+import tempfile
+
+from kazoo.security import make_acl, OPEN_ACL_UNSAFE
+
+from zk_shell.checkpoint import Checkpoint
+from zk_shell.traversal import ACLS, CHILDREN, DATA, STAT, Traversal
+from zk_shell.window import AdaptiveWindow
+
+from .shell_test_case import ShellTestCase
+
+
+# pylint: disable=R0904
+class TraversalTestCase(ShellTestCase):
+    """ Traversal tests """
+
+    def setUp(self):
+        super(TraversalTestCase, self).setUp()
+        for path in ["a/b/c", "a/d", "e"]:
+            self.client.create("%s/%s" % (self.tests_path, path), b"val", makepath=True)
+
+    def paths(self, **kwargs):
+        traversal = Traversal(self.client, self.tests_path, **kwargs)
+        return sorted(node.path[len(self.tests_path) + 1:] for node in traversal.get())
+
+    def test_paths(self):
+        self.assertEqual(["a", "a/b", "a/b/c", "a/d", "e"], self.paths())
+
+    def test_max_depth(self):
+        self.assertEqual(["a", "e"], self.paths(max_depth=1))
+        self.assertEqual(["a", "a/b", "a/d", "e"], self.paths(max_depth=2))
+
+    def test_prune(self):
+        self.assertEqual(["a", "e"], self.paths(prune=lambda path: path.endswith("/a")))
+
+    def test_max_inflight(self):
+        self.assertEqual(["a", "a/b", "a/b/c", "a/d", "e"], self.paths(max_inflight=1))
+
+    def test_adaptive_window(self):
+        window = AdaptiveWindow(100, target=10.0, start=1)
+        self.assertEqual(["a", "a/b", "a/b/c", "a/d", "e"], self.paths(max_inflight=window))
+        self.assertTrue(window.limit > 1)
+        self.assertTrue(window.latency is not None)
+
+        # way over target, so it shrinks back to 1
+        window = AdaptiveWindow(100, target=0.0, start=2)
+        self.assertEqual(["a", "a/b", "a/b/c", "a/d", "e"], self.paths(max_inflight=window))
+        self.assertEqual(1, window.limit)
+
+    def test_adaptive_window_backoff(self):
+        """ a lost connection cuts the limit once, however many requests were in flight """
+        window = AdaptiveWindow(100, target=10.0, start=100)
+        for _ in range(0, 100):
+            window.backoff()
+        self.assertEqual(25, window.limit)
+
+    def test_checkpoint(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "checkpoint.json")
+            checkpoint = Checkpoint(filename, interval=0)
+            traversal = Traversal(self.client, self.tests_path, max_inflight=1, checkpoint=checkpoint)
+            nodes = traversal.get()
+            seen = [next(nodes).path, next(nodes).path]
+            nodes.close()
+
+            checkpoint = Checkpoint(filename, resume=True)
+            self.assertTrue(checkpoint.resumed)
+            traversal = Traversal(self.client, self.tests_path, checkpoint=checkpoint)
+            seen.extend(node.path for node in traversal.get())
+            self.assertEqual(
+                ["a", "a/b", "a/b/c", "a/d", "e"],
+                sorted(set(path[len(self.tests_path) + 1:] for path in seen)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_needs(self):
+        traversal = Traversal(self.client, self.tests_path, needs=CHILDREN | STAT | DATA | ACLS)
+        nodes = dict((node.path, node) for node in traversal.get())
+        node = nodes["%s/a" % (self.tests_path)]
+        self.assertEqual(["b", "d"], sorted(node.children))
+        self.assertEqual(2, node.stat.numChildren)
+        self.assertEqual(b"val", node.data)
+        self.assertTrue(len(node.acls) > 0)
+
+    def test_ordered(self):
+        def dfs(path, level=0):
+            for child in self.client.get_children(path):
+                cpath = "%s/%s" % (path, child)
+                yield cpath, level
+                for pair in dfs(cpath, level + 1):
+                    yield pair
+
+        for max_inflight in [1, 2, 100]:
+            traversal = Traversal(self.client, self.tests_path, max_inflight=max_inflight)
+            nodes = [(node.path, node.level) for node in traversal.get(ordered=True)]
+            self.assertEqual(list(dfs(self.tests_path)), nodes)
+
+    def test_unreadable(self):
+        """ znodes that can't be listed are still yielded, without children """
+        locked = "%s/a/b" % (self.tests_path)
+        self.client.set_acls(locked, [make_acl("world", "anyone", write=True, admin=True)])
+        try:
+            self.assertEqual(["a", "a/b", "a/d", "e"], self.paths())
+            self.assertEqual(["a", "a/b", "a/d", "e"], self.paths(needs=STAT))
+            traversal = Traversal(self.client, self.tests_path, needs=ACLS)
+            nodes = dict((node.path, node) for node in traversal.get(ordered=True))
+            self.assertEqual([], nodes[locked].children)
+            self.assertEqual(1, len(nodes[locked].acls))
+        finally:
+            self.client.set_acls(locked, OPEN_ACL_UNSAFE)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+""" test reading & replaying (synthetic) transaction logs """
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from kazoo.security import make_digest_acl
+
+from zk_shell.shell import Shell
+from zk_shell.txnlog import (
+    CREATE,
+    DELETE,
+    read_txns,
+    SET_DATA,
+    Txn,
+    TxnLog,
+    TxnLogError,
+    TxnStats,
+    write_txnlog,
+)
+
+from .shell_test_case import XStringIO
+
+
+SESSION = 0x1234
+TIME = 1413485679000
+
+
+def txn(zxid, txn_type, path, data=None, **kwargs):
+    """ a Txn from SESSION, one per second """
+    return Txn(SESSION, zxid, zxid, TIME + zxid * 1000, txn_type, path, data, **kwargs)
+
+
+# pylint: disable=R0904
+class TxnLogTestCase(unittest.TestCase):
+    """ transaction logs """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.acl = make_digest_acl("user", "user", all=True)
+        self.log = os.path.join(self.temp_dir, "log.1")
+        write_txnlog(self.log, [
+            txn(1, CREATE, "/configs", b""),
+            txn(2, CREATE, "/configs/a", b"one", acls=[self.acl]),
+            txn(3, CREATE, "/configs/b", b"two"),
+            txn(3, SET_DATA, "/configs/a", b"uno"),  # a multi
+            txn(4, CREATE, "/services", b""),
+            txn(5, CREATE, "/services/web-0", b"10.0.0.2", ephemeral=True),
+            txn(6, DELETE, "/configs/b"),
+        ])
+        self.output = XStringIO()
+        self.shell = Shell([], 5, self.output, setup_readline=False, async=False)
+
+    def tearDown(self):
+        self.output.close()
+        shutil.rmtree(self.temp_dir, True)
+
+    def test_read(self):
+        """ multis are flattened, ACLs are decoded """
+        txns = list(read_txns(self.log))
+        self.assertEqual([1, 2, 3, 3, 4, 5, 6], [t.zxid for t in txns])
+        self.assertEqual("setData", txns[3].type_name)
+        self.assertEqual((b"uno", [self.acl]), (txns[3].data, txns[1].acls))
+        self.assertTrue(txns[5].ephemeral)
+
+    def test_range(self):
+        """ zxid ranges, across a dir of logs """
+        write_txnlog(os.path.join(self.temp_dir, "log.7"), [txn(7, DELETE, "/configs/a")])
+        zxids = [t.zxid for t in read_txns(self.temp_dir, 3, 7)]
+        self.assertEqual([3, 3, 4, 5, 6, 7], zxids)
+
+    def test_range_end(self):
+        """ logs that start after the end of the range aren't opened """
+        with open(os.path.join(self.temp_dir, "log.7"), "wb") as fh:
+            fh.write(b"not a transaction log")
+        zxids = [t.zxid for t in read_txns(self.temp_dir, 0, 6)]
+        self.assertEqual([1, 2, 3, 3, 4, 5, 6], zxids)
+
+    def test_torn_tail(self):
+        """ reading stops at a partial record """
+        with open(self.log, "rb") as fh:
+            content = fh.read().rstrip(b"\x00")
+        with open(self.log, "wb") as fh:
+            fh.write(content[:-5])
+        log = TxnLog(self.log)
+        self.assertEqual(5, max(t.zxid for t in log.get()))
+        log.close()
+
+    def test_not_a_log(self):
+        """ bad magic """
+        with open(self.log, "wb") as fh:
+            fh.write(b"not a transaction log")
+        self.assertRaises(TxnLogError, TxnLog, self.log)
+
+    def test_stats(self):
+        """ writes by type, child & second """
+        stats = TxnStats("/configs")
+        for t in read_txns(self.log):
+            stats.add(t)
+        self.assertEqual(5, stats.writes)
+        self.assertEqual({"create": 3, "delete": 1, "setData": 1}, dict(stats.by_type))
+        self.assertEqual([("/configs/a", 2), ("/configs/b", 2)], sorted(stats.top_paths(2)))
+        self.assertEqual((TIME // 1000 + 3, 2), stats.peak)
+        self.assertEqual(5.0, stats.duration)
+
+    def test_txnlog_cmd(self):
+        """ the summary """
+        self.shell.onecmd("txnlog %s /services" % (self.log))
+        lines = self.output.getvalue().split("\n")
+        self.assertEqual("Writes: 2 (0x4 - 0x5)", lines[0])
+        self.assertEqual("By type: create=2", lines[4])
+        self.assertEqual("  %s1" % ("/services/web-0".ljust(27)), lines[7])
+
+    def test_replay_to_json(self):
+        """ replay onto a backup, skipping ephemerals """
+        backup = os.path.join(self.temp_dir, "backup.json")
+        self.shell.onecmd("txnlog_replay %s json://%s/restored / : false true" % (
+            self.log, backup.replace("/", "!")))
+        self.assertEqual("Replayed 6 writes (0x1 - 0x6).\n", self.output.getvalue())
+
+        with open(backup) as fh:
+            tree = json.load(fh)
+        self.assertEqual(["/restored/configs", "/restored/configs/a", "/restored/services"], sorted(tree))
+        self.assertEqual(1, len(tree["/restored/configs/a"]["acls"]))
+
+    def test_replay_delete_not_empty(self):
+        """ deletes aren't recursive, a delete that's already applied is fine """
+        write_txnlog(os.path.join(self.temp_dir, "log.7"), [
+            txn(7, DELETE, "/configs/b"),
+            txn(8, DELETE, "/configs"),
+        ])
+        backup = os.path.join(self.temp_dir, "backup.json")
+        self.shell.onecmd("txnlog_replay %s json://%s/restored / : false true" % (
+            self.temp_dir, backup.replace("/", "!")))
+        self.assertEqual("Replay failed after 7 writes: Path /restored/configs isn't empty\n",
+                         self.output.getvalue())
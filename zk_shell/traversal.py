@@ -0,0 +1,507 @@
+"""
+Pipelined async traversal engine
+
+Each caller declares what it needs for every znode (children, stat, data,
+ACLs) and the engine issues the smallest set of requests per znode:
+
+  * children (and/or stat) only: a single get_children (with the stat)
+  * data and/or ACLs: a get and/or get_acls, followed by a get_children
+    only when the returned stat says there are children to recurse into
+  * stat only, for znodes that won't be recursed: a single exists
+
+Replies are consumed in completion order (kazoo's rawlink feeds a queue),
+so a slow reply, e.g. a big znode's data, doesn't stall the others. The
+unordered mode yields nodes as soon as they are complete and the ordered
+one puts them back in DFS order.
+
+  Example usage:
+    >>> from kazoo.client import KazooClient
+    >>> from zk_shell.traversal import DATA, STAT, Traversal
+    >>> zk = KazooClient(hosts)
+    >>> zk.start()
+    >>> gen = Traversal(zk, "/configs", needs=STAT | DATA).get()
+    >>> str([(node.path, node.stat.dataLength, node.data) for node in gen])
+    [
+      ('/configs/servers', 0, b''),
+      ('/configs/ports', 12, b'10000, 11000'),
+    ]
+    >>> zk.stop()
+
+"""
+
+from bisect import bisect_right
+import heapq
+import os
+import time
+
+try:
+    from Queue import Queue
+except ImportError: # py3k
+    from queue import Queue
+
+from kazoo.exceptions import ConnectionLoss, KazooException, NoAuthError, NoNodeError
+
+from .shards import ShardedReader
+from .util import DEFAULT_MAX_INFLIGHT
+from .window import Window
+
+
+# what a caller might need for each znode
+CHILDREN = 1 << 0
+STAT = 1 << 1
+DATA = 1 << 2
+ACLS = 1 << 3
+
+# the requests used to get them
+GET_CHILDREN, GET_CHILDREN2, EXISTS, GET_DATA, GET_ACLS = range(5)
+
+# how long to wait for the client to reconnect, and how often to check
+RECONNECT_TIMEOUT = 60.0
+RECONNECT_POLL = 0.1
+
+
+class Node(object):
+    """ a traversed znode along with what's been fetched for it """
+    __slots__ = (
+        "path", "level", "key", "recurse", "children", "nodes", "stat", "data", "acls",
+        "waiting", "sent", "done", "failed", "hidden", "after"
+    )
+
+    def __init__(self, path, level, key=()):
+        self.path, self.level, self.key = path, level, key
+        self.recurse = self.hidden = False
+        self.after = None
+        self.children = self.nodes = self.stat = self.data = self.acls = None
+        self.waiting = 0
+        self.sent = self.done = self.failed = False
+
+    def __repr__(self):
+        return "Node(path=%s, level=%d)" % (self.path, self.level)
+
+    @property
+    def entry(self):
+        """ this node (or its children after node.after, if hidden) as a frontier entry """
+        if self.hidden:
+            return ["c", self.path, self.level, self.after]
+        return ["n", self.path, self.level]
+
+
+class Nodes(object):
+    """ iterates over a list of nodes """
+    __slots__ = ("nodes", "pos")
+
+    def __init__(self, nodes):
+        self.nodes, self.pos = nodes, 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos >= len(self.nodes):
+            raise StopIteration
+        self.pos += 1
+        return self.nodes[self.pos - 1]
+
+    next = __next__
+
+    @property
+    def pending(self):
+        return [node.entry for node in self.nodes[self.pos:]]
+
+
+class Siblings(object):
+    """ iterates over parent's children (those after parent.after) as nodes """
+    __slots__ = ("traversal", "parent", "pos")
+
+    def __init__(self, traversal, parent):
+        self.traversal, self.parent = traversal, parent
+        if parent.after is None:
+            self.pos = 0
+        else:
+            self.pos = bisect_right(parent.children, parent.after)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        children = self.parent.children
+        if self.pos >= len(children):
+            raise StopIteration
+        self.pos += 1
+        return self.traversal._child(self.parent, self.pos - 1, children[self.pos - 1])
+
+    next = __next__
+
+    @property
+    def pending(self):
+        parent = self.parent
+        if self.pos >= len(parent.children):
+            return []
+        after = parent.children[self.pos - 1] if self.pos > 0 else parent.after
+        return [["c", parent.path, parent.level, after]]
+
+
+class Request(object):
+    __slots__ = ("node", "op", "result", "started", "latency")
+
+    def __init__(self, node, op, result):
+        self.node, self.op, self.result = node, op, result
+        self.started = time.time()
+        self.latency = 0
+
+    @property
+    def value(self):
+        return self.result.get()
+
+    def notify(self, done):
+        """ puts this request in done (a Queue) once its reply arrives """
+        def completed(_):
+            self.latency = time.time() - self.started
+            done.put(self)
+
+        self.result.rawlink(completed)
+
+
+class Traversal(object):
+    """
+    walks the subtree under path (excluding path itself) yielding a Node for
+    each znode found, with the fields requested via needs filled in.
+
+    :param needs: a mask of CHILDREN, STAT, DATA and ACLS
+    :param prune: callable, given a path it returns True if it shouldn't be recursed
+    :param max_depth: max depth of the traversal (0 means no limit)
+    :param max_inflight: max number of outstanding requests, or a Window
+                         (e.g.: an AdaptiveWindow to follow the latency)
+    :param sort: sort each znode's children (so the DFS order is deterministic)
+    :param checkpoint: a Checkpoint to periodically save the frontier to (and
+                       to resume from, if it was loaded). Unordered mode only,
+                       children are sorted.
+    :param strict: raise NoAuthError instead of skipping znodes that can't be read
+    :param unlisted: callable, given a path and the exception, for each znode whose
+                     children couldn't be listed (its subtree is skipped)
+    :param autosave: save the checkpoint when it's due (and when the walk fails).
+                     Callers that hold on to yielded nodes (i.e.: to batch them)
+                     turn it off and call save() once they've handled them
+    """
+    __slots__ = (
+        "zk", "path", "needs", "prune", "max_depth", "window", "sort", "checkpoint", "strict",
+        "unlisted", "autosave", "frontier"
+    )
+
+    def __init__(self, zk, path, needs=0, prune=None, max_depth=0,
+                 max_inflight=DEFAULT_MAX_INFLIGHT, sort=False, checkpoint=None, strict=False,
+                 unlisted=None, autosave=True):
+        self.zk, self.path, self.needs = zk, path, needs
+        self.prune, self.max_depth = prune, max_depth
+        self.strict, self.unlisted, self.autosave = strict, unlisted, autosave
+        self.frontier = None
+        if isinstance(max_inflight, Window):
+            self.window = max_inflight
+        else:
+            self.window = Window(max_inflight)
+        self.sort = sort or checkpoint is not None
+        self.checkpoint = checkpoint
+
+    def get(self, ordered=False):
+        """
+        if ordered is True, nodes are yielded in DFS order (children in the order
+        returned by the server, unless sort is set). Otherwise they are yielded
+        as they are fetched.
+        """
+        return self._get_ordered() if ordered else self._get_unordered()
+
+    def save(self):
+        """
+        saves the frontier of the walk in progress to the checkpoint: every node
+        yielded so far is taken as handled
+        """
+        if self.checkpoint is not None and self.frontier is not None:
+            self.checkpoint.save(self.frontier())
+
+    def _root(self):
+        return self._node(["c", self.path, -1, None])
+
+    def _node(self, entry):
+        """ the node for a frontier entry """
+        if entry[0] == "c":
+            node = Node(entry[1], entry[2])
+            node.recurse = node.hidden = True
+            node.after = entry[3]
+            return node
+
+        return self._recurse(Node(entry[1], entry[2]))
+
+    def _child(self, parent, pos, child):
+        node = Node(os.path.join(parent.path, child), parent.level + 1, parent.key + (pos,))
+        return self._recurse(node)
+
+    def _recurse(self, node):
+        node.recurse = self.max_depth <= 0 or node.level + 1 < self.max_depth
+        if node.recurse and self.prune is not None:
+            node.recurse = not self.prune(node.path)
+        return node
+
+    def _first_ops(self, node):
+        """ the requests that can be sent before knowing anything about node """
+        needs = self.needs
+        ops = []
+
+        if node.hidden:
+            return [GET_CHILDREN]
+
+        if needs & DATA:
+            ops.append(GET_DATA)
+        if needs & ACLS:
+            ops.append(GET_ACLS)
+        if ops:
+            return ops
+
+        if node.recurse or needs & CHILDREN:
+            return [GET_CHILDREN2 if needs & STAT else GET_CHILDREN]
+
+        return [EXISTS] if needs & STAT else []
+
+    def _send(self, done, node, ops):
+        zk = self.zk
+        # XClient's keeps big lists between scans (see ChildrenCache)
+        children_async = getattr(zk, "scan_children_async", zk.get_children_async)
+        node.sent = True
+        node.waiting += len(ops)
+        for op in ops:
+            if op == GET_CHILDREN:
+                result = children_async(node.path)
+            elif op == GET_CHILDREN2:
+                result = children_async(node.path, include_data=True)
+            elif op == EXISTS:
+                result = zk.exists_async(node.path)
+            elif op == GET_DATA:
+                result = zk.get_async(node.path)
+            else:
+                result = zk.get_acls_async(node.path)
+            Request(node, op, result).notify(done)
+
+    def _receive(self, req):
+        """
+        stores the reply for req in its node and returns the requests the node
+        still needs, if any. node.done is set once everything has been fetched.
+        """
+        node = req.node
+        node.waiting -= 1
+
+        try:
+            value = req.value
+            self.window.completed(req.latency)
+            if req.op == GET_CHILDREN:
+                node.children = value
+            elif req.op == GET_CHILDREN2:
+                node.children, node.stat = value
+            elif req.op == EXISTS:
+                node.stat = value
+                node.failed = value is None
+            elif req.op == GET_DATA:
+                node.data, node.stat = value
+            else:
+                node.acls, node.stat = value
+        except NoAuthError as ex:
+            if self.strict:
+                raise
+            if req.op in (GET_CHILDREN, GET_CHILDREN2):
+                return self._unlisted(node, req.op, ex)
+            node.failed = True
+        except NoNodeError as ex:
+            if req.op == GET_CHILDREN:
+                return self._unlisted(node, req.op, ex)
+            node.failed = True
+        except ConnectionLoss:
+            # the request was in flight when the connection dropped, send it again
+            if not self.window.retry(node.path):
+                raise
+            self.window.backoff()
+            self._wait_connected(node.path)
+            return [req.op]
+
+        if node.waiting > 0 or node.failed:
+            return []
+
+        if self.sort and node.children:
+            node.children = sorted(node.children)
+
+        if node.children is None and (node.recurse or self.needs & CHILDREN):
+            if node.stat.numChildren > 0:
+                return [GET_CHILDREN]
+            node.children = []
+
+        node.done = True
+        return []
+
+    def _unlisted(self, node, op, ex):
+        """
+        node was listed by its parent, so it's yielded without children even if
+        it can't be listed itself. The stat that came with the listing is
+        fetched with an exists (which needs no permissions) instead
+        """
+        node.children = []
+        if self.unlisted is not None:
+            self.unlisted(node.path, ex)
+        if op == GET_CHILDREN2:
+            return [EXISTS]
+        if node.waiting == 0 and not node.failed:
+            node.done = True
+        return []
+
+    def _wait_connected(self, path):
+        """
+        kazoo reconnects on its own (unless the session expires), wait for the
+        client that path's requests go to
+        """
+        client = self.zk.session(path) if isinstance(self.zk, ShardedReader) else self.zk
+        deadline = time.time() + RECONNECT_TIMEOUT
+        while not client.connected:
+            if time.time() > deadline:
+                raise ConnectionLoss("Timed out waiting to reconnect")
+            time.sleep(RECONNECT_POLL)
+
+    def _get_unordered(self):
+        done = Queue()
+        pending = 0
+        window = self.window
+        checkpoint = self.checkpoint
+        inflight = set()
+
+        if checkpoint is not None and checkpoint.frontier is not None:
+            backlog = [Nodes([self._node(entry) for entry in checkpoint.frontier])]
+        else:
+            backlog = [Nodes([self._root()])]
+
+        def frontier():
+            """ what's left to walk: the nodes being fetched & the rest of the backlog """
+            entries = [node.entry for node in inflight]
+            for nodes in backlog:
+                entries.extend(nodes.pending)
+            return entries
+
+        self.frontier = frontier
+        if checkpoint is not None:
+            checkpoint.walk = frontier
+        try:
+            while True:
+                # every yielded node has been handled by now, so this is consistent
+                if self.autosave and checkpoint is not None and checkpoint.due():
+                    checkpoint.save(frontier())
+
+                # depth first, so the backlog stays proportional to depth * fan-out
+                while pending < window.limit and backlog:
+                    try:
+                        node = next(backlog[-1])
+                    except StopIteration:
+                        backlog.pop()
+                        continue
+
+                    ops = self._first_ops(node)
+                    if not ops:
+                        node.done = True
+                        yield node
+                        continue
+
+                    pending += len(ops)
+                    inflight.add(node)
+                    self._send(done, node, ops)
+
+                if pending == 0:
+                    break
+
+                # replies are handled as they arrive, so a slow one doesn't hold the rest
+                req = done.get()
+                pending -= 1
+                node = req.node
+
+                ops = self._receive(req)
+                if ops:
+                    pending += len(ops)
+                    self._send(done, node, ops)
+
+                if node.failed:
+                    inflight.discard(node)
+                if not node.done:
+                    continue
+                inflight.discard(node)
+
+                if node.recurse and node.children:
+                    backlog.append(Siblings(self, node))
+
+                if not node.hidden:
+                    yield node
+        except KazooException:
+            # e.g.: the session expired, save what's left so it can be resumed
+            if self.autosave and checkpoint is not None:
+                checkpoint.save(frontier())
+            raise
+
+    def _get_ordered(self):
+        """
+        requests are sent ahead of time following the DFS order (node keys are
+        the positions of each node & its ancestors amongst their siblings, so
+        comparing them gives the DFS order). Up to max_inflight nodes can be
+        fetched but not yet yielded. Replies are handled in completion order,
+        nodes are reordered as they are yielded.
+        """
+        done = Queue()
+        heap = []
+        ahead = 0
+        window = self.window
+
+        def send(node):
+            ops = self._first_ops(node)
+            if ops:
+                self._send(done, node, ops)
+            else:
+                node.done = True
+            return len(ops) > 0
+
+        def receive():
+            req = done.get()
+            node = req.node
+            ops = self._receive(req)
+            if ops:
+                self._send(done, node, ops)
+            elif node.done and node.recurse and node.children:
+                node.nodes = [self._child(node, pos, c) for pos, c in enumerate(node.children)]
+                for child in node.nodes:
+                    heapq.heappush(heap, (child.key, child))
+
+        root = self._root()
+        stack = [[root]]
+        send(root)
+        ahead += 1
+
+        while stack:
+            # siblings are kept in reverse order, so yielded nodes can be dropped
+            if not stack[-1]:
+                stack.pop()
+                continue
+            node = stack[-1].pop()
+
+            # the node we need next might not have been sent yet
+            if not node.sent and not node.done and send(node):
+                ahead += 1
+
+            while not node.done and not node.failed:
+                while ahead < window.limit and heap:
+                    _, upcoming = heapq.heappop(heap)
+                    if not upcoming.sent and send(upcoming):
+                        ahead += 1
+                receive()
+
+            if node.failed:
+                ahead -= 1
+                continue
+
+            if not node.hidden:
+                yield node
+
+            if node.sent:
+                ahead -= 1
+
+            if node.nodes:
+                stack.append(node.nodes[::-1])
+                node.nodes = None
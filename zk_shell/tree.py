@@ -18,63 +18,25 @@ Async tree builder
 
 import os
 
-try:
-    from Queue import Queue
-except ImportError: # py3k
-    from queue import Queue
-
-from kazoo.exceptions import NoAuthError, NoNodeError
-
-
-class Request(object):
-    __slots__ = ('path', 'result')
-
-    def __init__(self, path, result):
-        self.path, self.result = path, result
-
-    @property
-    def value(self):
-        return self.result.get()
+from .traversal import Traversal
+from .util import DEFAULT_MAX_INFLIGHT
 
 
 class Tree(object):
-    __slots__ = ("zk", "path")
+    __slots__ = ("zk", "path", "max_inflight")
 
-    def __init__(self, zk, path):
-        self.zk, self.path = zk, path
+    def __init__(self, zk, path, max_inflight=DEFAULT_MAX_INFLIGHT):
+        self.zk, self.path, self.max_inflight = zk, path, max_inflight
 
     def get(self, exclude_recurse=None):
         """
         Paths matching exclude_recurse will not be recursed.
         """
-        reqs = Queue()
-        pending = 1
-        path = self.path
-        zk = self.zk
-
-        def child_of(path):
-            return zk.get_children_async(path)
-
-        def dispatch(path):
-            return Request(path, child_of(path))
-
-        stat = zk.exists(path)
-        if stat is None or stat.numChildren == 0:
-            return
-
-        reqs.put(dispatch(path))
-
-        while pending:
-            req = reqs.get()
-
-            try:
-                children = req.value
-                for child in children:
-                    cpath = os.path.join(req.path, child)
-                    if exclude_recurse is None or exclude_recurse not in child:
-                        pending += 1
-                        reqs.put(dispatch(cpath))
-                    yield cpath
-            except (NoNodeError, NoAuthError): pass
-
-            pending -= 1
+        if exclude_recurse is None:
+            prune = None
+        else:
+            prune = lambda path: exclude_recurse in os.path.basename(path)
+
+        traversal = Traversal(self.zk, self.path, prune=prune, max_inflight=self.max_inflight)
+        for node in traversal.get():
+            yield node.path
@@ -0,0 +1,402 @@
+"""
+Reading (and replaying) ZooKeeper transaction logs (log.<zxid> files)
+
+A log is a header followed by a record per transaction: its adler32, its
+length, the transaction itself (a header with the session, zxid, time &
+type plus the type's record) and an end-of-record marker. Logs are
+preallocated, so the first zero-length record (or a torn one) ends it.
+Multis are flattened: each of their ops comes out as a Txn with the
+multi's zxid.
+
+replay() applies the creates, deletes & sets within a zxid range through
+a copy.Proxy (i.e.: zk:// or json://), so a restored snapshot can catch
+up with the log's tail. Replaying is idempotent, like ZK's own replay of
+logs over a (fuzzy) snapshot: creating what exists sets its value and
+deleting what doesn't exist is a no-op. Ephemerals are skipped.
+
+  Example usage:
+    >>> from zk_shell.txnlog import read_txns, TxnStats
+    >>> stats = TxnStats("/configs")
+    >>> for txn in read_txns("/var/lib/zookeeper/version-2", start=0x100000001):
+    ...     stats.add(txn)
+    >>> stats.writes, stats.top_paths(1)
+    (9315, [('/configs/primary', 4012)])
+
+"""
+
+from collections import defaultdict
+import mmap
+import os
+import struct
+import zlib
+
+from kazoo.security import ACL, Id
+
+from .util import to_bytes
+
+
+LOG_MAGIC = 0x5a4b4c47  # ZKLG
+LOG_VERSION = 2
+EOR = 0x42
+
+CREATE = 1
+DELETE = 2
+SET_DATA = 5
+SET_ACL = 7
+CHECK = 13
+MULTI = 14
+CREATE2 = 15
+CREATE_CONTAINER = 19
+DELETE_CONTAINER = 20
+CREATE_TTL = 21
+CREATE_SESSION = -10
+CLOSE_SESSION = -11
+ERROR = -1
+
+TYPE_NAMES = {
+    CREATE: "create",
+    DELETE: "delete",
+    SET_DATA: "setData",
+    SET_ACL: "setACL",
+    CHECK: "check",
+    MULTI: "multi",
+    CREATE2: "create2",
+    CREATE_CONTAINER: "createContainer",
+    DELETE_CONTAINER: "deleteContainer",
+    CREATE_TTL: "createTTL",
+    CREATE_SESSION: "createSession",
+    CLOSE_SESSION: "closeSession",
+    ERROR: "error",
+}
+
+CREATES = (CREATE, CREATE2, CREATE_CONTAINER, CREATE_TTL)
+DELETES = (DELETE, DELETE_CONTAINER)
+WRITES = CREATES + DELETES + (SET_DATA, SET_ACL)
+
+INT = struct.Struct(">i")
+LONG = struct.Struct(">q")
+# session, cxid, zxid, time, type
+HEADER = struct.Struct(">qiqqi")
+
+
+class TxnLogError(Exception):
+    """ the file isn't a transaction log """
+    pass
+
+
+class Txn(object):
+    """ a transaction (or an op of a multi) """
+    __slots__ = ("session", "cxid", "zxid", "time", "type", "path", "data", "acls", "ephemeral", "version")
+
+    def __init__(self, session, cxid, zxid, time, txn_type, path=None, data=None,
+                 acls=None, ephemeral=False, version=-1):
+        """
+        :param time: in ms since the epoch
+        :param txn_type: one of the TYPE_NAMES' keys
+        """
+        self.session, self.cxid, self.zxid, self.time = session, cxid, zxid, time
+        self.type, self.path, self.data, self.acls = txn_type, path, data, acls
+        self.ephemeral, self.version = ephemeral, version
+
+    @property
+    def type_name(self):
+        return TYPE_NAMES.get(self.type, str(self.type))
+
+    def __repr__(self):
+        return "Txn(zxid=0x%x, type=%s, path=%s)" % (self.zxid, self.type_name, self.path)
+
+
+class Reader(object):
+    """ decodes jute types from a buffer """
+    __slots__ = ("buf", "offs")
+
+    def __init__(self, buf, offs=0):
+        self.buf, self.offs = buf, offs
+
+    def int(self):
+        self.offs += 4
+        return INT.unpack_from(self.buf, self.offs - 4)[0]
+
+    def long(self):
+        self.offs += 8
+        return LONG.unpack_from(self.buf, self.offs - 8)[0]
+
+    def bool(self):
+        self.offs += 1
+        return self.buf[self.offs - 1:self.offs] != b"\x00"
+
+    def buffer(self):
+        size = self.int()
+        if size < 0:
+            return None
+        self.offs += size
+        return self.buf[self.offs - size:self.offs]
+
+    def string(self):
+        value = self.buffer()
+        return value.decode("utf-8") if value is not None else None
+
+    def acls(self):
+        return [ACL(self.int(), Id(self.string(), self.string())) for _ in range(0, max(self.int(), 0))]
+
+
+def decode(session, cxid, zxid, time, txn_type, reader):
+    """ yields the Txn(s) for a record (more than one for multis) """
+    if txn_type == MULTI:
+        for _ in range(0, max(reader.int(), 0)):
+            op_type = reader.int()
+            op = Reader(reader.buffer())
+            for txn in decode(session, cxid, zxid, time, op_type, op):
+                yield txn
+        return
+
+    txn = Txn(session, cxid, zxid, time, txn_type)
+    if txn_type in CREATES:
+        txn.path, txn.data, txn.acls = reader.string(), reader.buffer(), reader.acls()
+        if txn_type in (CREATE, CREATE2):
+            txn.ephemeral = reader.bool()
+    elif txn_type in DELETES:
+        txn.path = reader.string()
+    elif txn_type == SET_DATA:
+        txn.path, txn.data, txn.version = reader.string(), reader.buffer(), reader.int()
+    elif txn_type == SET_ACL:
+        txn.path, txn.acls, txn.version = reader.string(), reader.acls(), reader.int()
+    elif txn_type == CHECK:
+        txn.path, txn.version = reader.string(), reader.int()
+    yield txn
+
+
+class TxnLog(object):
+    """ a memory-mapped transaction log """
+    __slots__ = ("filename", "fh", "buf")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = open(filename, "rb")
+        try:
+            self.buf = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            self.fh.close()
+            raise TxnLogError("%s is empty" % (filename))
+
+        if len(self.buf) < 16 or struct.unpack_from(">ii", self.buf, 0) != (LOG_MAGIC, LOG_VERSION):
+            self.close()
+            raise TxnLogError("%s isn't a transaction log" % (filename))
+
+    @property
+    def first_zxid(self):
+        """ from the file name (or -1) """
+        return zxid_of(self.filename)
+
+    def close(self):
+        self.buf.close()
+        self.fh.close()
+
+    def get(self, start=0, end=None):
+        """ yields the Txns with start <= zxid <= end """
+        buf, offs = self.buf, 16
+        while offs + 12 <= len(buf):
+            crc, size = struct.unpack_from(">qi", buf, offs)
+            if size <= 0 or offs + 12 + size + 1 > len(buf):
+                return
+            entry = buf[offs + 12:offs + 12 + size]
+            if zlib.adler32(entry) & 0xffffffff != crc or buf[offs + 12 + size] not in (EOR, b"B"):
+                # a torn write at the tail
+                return
+            offs += 12 + size + 1
+
+            session, cxid, zxid, time, txn_type = HEADER.unpack_from(entry, 0)
+            if zxid < start:
+                continue
+            if end is not None and zxid > end:
+                return
+            for txn in decode(session, cxid, zxid, time, txn_type, Reader(entry, HEADER.size)):
+                yield txn
+
+
+def zxid_of(filename):
+    """ the zxid in a log.<zxid> (or snapshot.<zxid>) file name, or -1 """
+    try:
+        return int(os.path.basename(filename).split(".")[-1], 16)
+    except ValueError:
+        return -1
+
+
+def log_files(path):
+    """ path if it's a file, the log.* files in it (by zxid) if it's a dir """
+    if not os.path.isdir(path):
+        return [path]
+    names = [name for name in os.listdir(path) if name.startswith("log.")]
+    return [os.path.join(path, name) for name in sorted(names, key=zxid_of)]
+
+
+def read_txns(path, start=0, end=None):
+    """ yields the Txns in a log, or in a dir of logs, with start <= zxid <= end """
+    files = log_files(path)
+    for i, filename in enumerate(files):
+        # the next log starts before start, nothing to see here
+        if i + 1 < len(files) and 0 <= zxid_of(files[i + 1]) <= start:
+            continue
+        # and neither in this one or the ones after it, if it starts after end
+        if end is not None and zxid_of(filename) > end:
+            break
+        log = TxnLog(filename)
+        try:
+            for txn in log.get(start, end):
+                yield txn
+        finally:
+            log.close()
+
+
+class TxnStats(object):
+    """ aggregates the writes under path """
+    __slots__ = ("path", "offs", "txns", "writes", "first", "last",
+                 "by_type", "by_child", "by_session", "by_second")
+
+    def __init__(self, path="/"):
+        self.path = path.rstrip("/") or "/"
+        self.offs = 1 if self.path == "/" else len(self.path) + 1
+        self.txns = self.writes = 0
+        self.first = self.last = None
+        self.by_type = defaultdict(int)
+        self.by_child = defaultdict(int)
+        self.by_session = defaultdict(int)
+        self.by_second = defaultdict(int)
+
+    def add(self, txn):
+        """ counts txn if it's a write under path """
+        if txn.type not in WRITES:
+            return
+        if txn.path != self.path and not txn.path.startswith(self.path.rstrip("/") + "/"):
+            return
+
+        self.writes += 1
+        self.first = self.first or txn
+        self.last = txn
+        self.by_type[txn.type_name] += 1
+        self.by_child[self.path if txn.path == self.path else self.child_of(txn.path)] += 1
+        self.by_session[txn.session] += 1
+        self.by_second[txn.time // 1000] += 1
+
+    def child_of(self, path):
+        """ the child of self.path that path is under """
+        return os.path.join(self.path, path[self.offs:].split("/", 1)[0])
+
+    @property
+    def duration(self):
+        """ seconds between the first & last writes """
+        return (self.last.time - self.first.time) / 1000.0 if self.writes else 0.0
+
+    @property
+    def peak(self):
+        """ (second, writes) for the busiest second """
+        return max(self.by_second.items(), key=lambda item: item[1]) if self.writes else (0, 0)
+
+    def top_paths(self, count):
+        return sorted(self.by_child.items(), key=lambda item: -item[1])[:count]
+
+    def top_sessions(self, count):
+        return sorted(self.by_session.items(), key=lambda item: -item[1])[:count]
+
+
+def replay(txns, path, dst, progress=None):
+    """
+    applies the creates, deletes & sets under path onto dst (a copy.Proxy,
+    with path mapped to its url), returns the number of applied txns
+
+    :param progress: called with each applied Txn
+    """
+    from .copy import CopyError, ZKProxy
+
+    path = path.rstrip("/") or "/"
+    offs = 0 if path == "/" else len(path)
+    base_url = dst.url.rstrip("/")
+    applied = 0
+
+    with dst:
+        for txn in txns:
+            if txn.type not in CREATES + DELETES + (SET_DATA,) or txn.ephemeral:
+                continue
+            if txn.path != path and not txn.path.startswith(path.rstrip("/") + "/"):
+                continue
+
+            dst.set_url(base_url + (txn.path[offs:] or "/"))
+            data = txn.data if txn.data is not None else b""
+            if txn.type in DELETES:
+                # its children were deleted by earlier txns, if they were replayed
+                dst.delete_path()
+            elif txn.type == SET_DATA:
+                # keep the ACLs it has
+                dst.exists = True
+                try:
+                    dst.check_path()
+                    current = dst.read_path()
+                    dst.write_path(current.__class__(data, current.acl))
+                except CopyError:
+                    dst.write_path(ZKProxy.ZKPathValue(data))
+            else:
+                dst.write_path(ZKProxy.ZKPathValue(data, txn.acls))
+
+            applied += 1
+            if progress is not None:
+                progress(txn)
+
+    dst.set_url(base_url)
+    return applied
+
+
+def write_txnlog(filename, txns):
+    """
+    writes a synthetic transaction log, consecutive Txns with the same zxid
+    are written as a multi
+    """
+    def string(value):
+        if value is None:
+            return INT.pack(-1)
+        value = to_bytes(value)
+        return INT.pack(len(value)) + value
+
+    def record(txn):
+        if txn.type in CREATES:
+            out = string(txn.path) + string(txn.data)
+            acls = txn.acls or []
+            out += INT.pack(len(acls))
+            for acl in acls:
+                out += INT.pack(acl.perms) + string(acl.id.scheme) + string(acl.id.id)
+            if txn.type in (CREATE, CREATE2):
+                out += b"\x01" if txn.ephemeral else b"\x00"
+            return out + INT.pack(0)
+        if txn.type in DELETES:
+            return string(txn.path)
+        if txn.type == SET_DATA:
+            return string(txn.path) + string(txn.data) + INT.pack(txn.version)
+        if txn.type == CHECK:
+            return string(txn.path) + INT.pack(txn.version)
+        if txn.type == CREATE_SESSION:
+            return INT.pack(30000)
+        return b""
+
+    groups = []
+    for txn in txns:
+        if groups and groups[-1][0].zxid == txn.zxid:
+            groups[-1].append(txn)
+        else:
+            groups.append([txn])
+
+    out = [struct.pack(">iiq", LOG_MAGIC, LOG_VERSION, 0)]
+    for group in groups:
+        first = group[0]
+        if len(group) == 1:
+            body = record(first)
+            txn_type = first.type
+        else:
+            body = INT.pack(len(group))
+            body += b"".join(INT.pack(txn.type) + string(record(txn)) for txn in group)
+            txn_type = MULTI
+        entry = HEADER.pack(first.session, first.cxid, first.zxid, first.time, txn_type) + body
+        out.append(struct.pack(">qi", zlib.adler32(entry) & 0xffffffff, len(entry)) + entry + b"B")
+
+    with open(filename, "wb") as fh:
+        fh.write(b"".join(out))
+        # preallocated space
+        fh.write(b"\x00" * 64)
@@ -8,29 +8,25 @@ Fast path size calculations
     >>> zk.start()
     >>> print('Total = %d' % (Usage(zk, "/").get()))
     Total = 5567
+    >>> breakdown = Breakdown(zk, "/", depth=2, top=1).get()
+    >>> breakdown.top_subtrees()
+    [('/services', [4096, 12])]
+    >>> breakdown.largest()
+    [(1024, '/services/web/config')]
     >>> zk.stop()
 
 """
 
+from bisect import bisect_right
+import heapq
 import os
 
-try:
-    from Queue import Queue
-except ImportError: # py3k
-    from queue import Queue
+from .traversal import STAT, Traversal
+from .util import DEFAULT_MAX_INFLIGHT
 
-from kazoo.exceptions import NoAuthError, NoNodeError
 
-
-class Request(object):
-    __slots__ = ('path', 'result')
-
-    def __init__(self, path, result):
-        self.path, self.result = path, result
-
-    @property
-    def value(self):
-        return self.result.get()
+# the lower bounds of the value size buckets (in bytes)
+SIZE_BUCKETS = (0, 1, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
 
 
 class Total(object):
@@ -44,10 +40,10 @@ class Total(object):
 
 
 class Usage(object):
-    __slots__ = ("zk", "path")
+    __slots__ = ("zk", "path", "max_inflight")
 
-    def __init__(self, zk, path):
-        self.zk, self.path = zk, path
+    def __init__(self, zk, path, max_inflight=DEFAULT_MAX_INFLIGHT):
+        self.zk, self.path, self.max_inflight = zk, path, max_inflight
 
     @property
     def value(self):
@@ -59,38 +55,102 @@ class Usage(object):
             return total.value
 
     def get(self, ptotal=None):
-        reqs = Queue()
-        pending = 1
-        total = 0
-        path = self.path
-        zk = self.zk
-        child_of = lambda path: zk.get_children_async(path, include_data=True)
-        dispatch = lambda path: Request(path, child_of(path))
-
-        stat = zk.exists(path)
-        if stat is None:
-            return 0
-
-        reqs.put(dispatch(path))
-
-        while pending:
-            req = reqs.get()
-
-            try:
-                children, stat = req.value
-            except (NoNodeError, NoAuthError):
-                continue
+        total = Total()
 
-            if stat.dataLength > 0:
-                total += stat.dataLength
-                if ptotal:
-                    ptotal.add(stat.dataLength)
+        def add(count):
+            total.add(count)
+            if ptotal:
+                ptotal.add(count)
 
-            if stat.numChildren > 0:
-                pending += stat.numChildren
-                for child in children:
-                    reqs.put(dispatch(os.path.join(req.path, child)))
+        stat = self.zk.exists(self.path)
+        if stat is None:
+            return 0
 
-            pending -= 1
+        add(stat.dataLength)
+
+        traversal = Traversal(self.zk, self.path, needs=STAT, max_inflight=self.max_inflight)
+        for node in traversal.get():
+            add(node.stat.dataLength)
+
+        return total.value
+
+
+class Breakdown(object):
+    """
+    the bytes & znodes under each subtree down to depth, the top largest
+    znodes and a histogram of value sizes, all in a single pass
+    """
+    __slots__ = (
+        "zk", "path", "depth", "top", "max_inflight",
+        "bytes", "znodes", "subtrees", "heap", "histogram"
+    )
+
+    def __init__(self, zk, path, depth=1, top=10, max_inflight=DEFAULT_MAX_INFLIGHT):
+        """
+        :param depth: how deep (relative to path) to aggregate subtrees
+        :param top: how many subtrees & znodes to keep (0 is all)
+        """
+        self.zk, self.path, self.depth, self.top = zk, path, depth, top
+        self.max_inflight = max_inflight
+        self.bytes = self.znodes = 0
+        # prefix -> [bytes, znodes]
+        self.subtrees = {}
+        # a min-heap of (dataLength, path), bounded by top
+        self.heap = []
+        self.histogram = [0] * len(SIZE_BUCKETS)
+
+    def get(self):
+        """ runs the scan, stopping early (with partial results) if interrupted """
+        stat = self.zk.exists(self.path)
+        if stat is None:
+            return self
 
-        return total
+        self.add(self.path, stat.dataLength)
+        traversal = Traversal(self.zk, self.path, needs=STAT, max_inflight=self.max_inflight)
+        try:
+            for node in traversal.get():
+                self.add(node.path, node.stat.dataLength)
+        except KeyboardInterrupt:
+            pass
+
+        return self
+
+    def add(self, path, size):
+        self.bytes += size
+        self.znodes += 1
+        self.histogram[bisect_right(SIZE_BUCKETS, size) - 1] += 1
+
+        if self.top == 0 or len(self.heap) < self.top:
+            heapq.heappush(self.heap, (size, path))
+        elif size > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (size, path))
+
+        if path == self.path:
+            return
+
+        offs = 1 if self.path == "/" else len(self.path) + 1
+        parts = path[offs:].split("/", self.depth)
+        for level in range(1, min(self.depth, len(parts)) + 1):
+            prefix = os.path.join(self.path, "/".join(parts[:level]))
+            totals = self.subtrees.get(prefix)
+            if totals is None:
+                self.subtrees[prefix] = [size, 1]
+            else:
+                totals[0] += size
+                totals[1] += 1
+
+    def top_subtrees(self):
+        """ [(prefix, [bytes, znodes])], heaviest first """
+        key = lambda item: item[1][0]
+        if self.top == 0:
+            return sorted(self.subtrees.items(), key=key, reverse=True)
+        return heapq.nlargest(self.top, self.subtrees.items(), key=key)
+
+    def largest(self):
+        """ [(dataLength, path)], largest first """
+        return sorted(self.heap, reverse=True)
+
+    def buckets(self):
+        """ [(low, high, znodes)], high is None for the last bucket """
+        highs = list(SIZE_BUCKETS[1:]) + [None]
+        return list(zip(SIZE_BUCKETS, highs, self.histogram))
@@ -10,6 +10,12 @@ import sys
 
 PYTHON3 = sys.version_info > (3, )
 
+# max number of outstanding requests for the async tree builders
+DEFAULT_MAX_INFLIGHT = 1000
+
+# max number of outstanding writes (they all go through the leader)
+DEFAULT_MAX_INFLIGHT_WRITES = 100
+
 
 def pretty_bytes(num):
     """ pretty print the given number of bytes """
@@ -0,0 +1,213 @@
+"""
+Incremental mirroring based on zxid watermarks
+
+After a mirror, the mzxid, pzxid & children of every source znode are
+saved to a state file. The next run stats each source znode and only
+reads its value if its mzxid changed, and only lists its children if its
+pzxid changed (the saved list is used otherwise). Only what changed is
+written to (or deleted from) the destination, which isn't read at all.
+
+ZooKeeper has no subtree-wide change marker, so every source znode is
+still stat'ed (a single, small exists per znode), but values, ACLs and
+children lists are only transferred for changes. The destination is
+expected to be changed only by these mirrors. Without a (matching)
+state file, the first run is a full mirror.
+
+  Example usage:
+    >>> from zk_shell.copy import Proxy
+    >>> from zk_shell.watermark import IncrementalMirror, Watermarks
+    >>> src = Proxy.from_string("zk://10.0.0.1/configs", exists=True)
+    >>> dst = Proxy.from_string("zk://10.0.1.1/configs", exists=None)
+    >>> watermarks = Watermarks("/var/lib/mirror.state", src.url, dst.url)
+    >>> mirror = IncrementalMirror(src, dst, watermarks)
+    >>> mirror.run()
+    >>> mirror.read, mirror.written, mirror.deleted
+    (12, 12, 1)
+
+"""
+
+from functools import partial
+import json
+import os
+
+from kazoo.exceptions import NoAuthError, NoNodeError, ZookeeperError
+
+from .copy import AuthError, CopyError, ZKProxy
+from .pipeline import pipelined
+from .util import DEFAULT_MAX_INFLIGHT
+
+
+MZXID, PZXID, CHILDREN = range(3)
+
+
+class Watermarks(object):
+    """ the mzxid, pzxid & children of each mirrored znode, by path relative to the src """
+    __slots__ = ("filename", "key", "znodes")
+
+    def __init__(self, filename, src_url, dst_url):
+        self.filename = filename
+        self.key = [src_url, dst_url]
+        self.znodes = None
+        self.load()
+
+    def load(self):
+        """ the state is only used if it's for the same src & dst """
+        try:
+            with open(self.filename) as fh:
+                content = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if content.get("key") != self.key:
+            return False
+
+        self.znodes = content["znodes"]
+        return True
+
+    def save(self, znodes):
+        """ writes the state, atomically """
+        tmp = "%s.tmp" % (self.filename)
+        with open(tmp, "w") as fh:
+            json.dump({"key": self.key, "znodes": znodes}, fh)
+        os.rename(tmp, self.filename)
+        self.znodes = znodes
+
+
+class IncrementalMirror(object):
+    """ mirrors src (a ZKProxy) to dst, reading & writing only what changed """
+    __slots__ = (
+        "src", "dst", "watermarks", "max_inflight", "verbose",
+        "znodes", "read", "listed", "written", "deleted"
+    )
+
+    def __init__(self, src, dst, watermarks, max_inflight=DEFAULT_MAX_INFLIGHT, verbose=False):
+        self.src, self.dst, self.watermarks = src, dst, watermarks
+        self.max_inflight, self.verbose = max_inflight, verbose
+        self.znodes = self.read = self.listed = self.written = self.deleted = 0
+
+    def run(self):
+        """ walks the src level by level, saves the new watermarks once it's done """
+        src, dst = self.src, self.dst
+        old = self.watermarks.znodes
+        new = {}
+
+        with src:
+            with dst:
+                # first run: whatever the dst has that the src doesn't must go
+                extra = set(dst.children_of()) if old is None else set()
+                old = old or {}
+
+                level = [""]
+                try:
+                    while level:
+                        level = self._level(level, old, new, extra)
+                except NoAuthError:
+                    raise AuthError("read", "under %s" % (src.path))
+                except ZookeeperError:
+                    raise CopyError("ZooKeeper server error")
+
+                deleted = None
+                for rel in sorted(extra):
+                    if deleted is None or not rel.startswith(deleted + "/"):
+                        self._delete(rel)
+                        deleted = rel
+
+        self.watermarks.save(new)
+
+    def _level(self, level, old, new, extra):
+        """ mirrors the znodes in level, returns the next level """
+        zk = self.src.client
+        path = lambda rel: os.path.join(self.src.path, rel) if rel else self.src.path
+
+        # what changed since the last run?
+        stats = ((rel, partial(zk.exists_async, path(rel))) for rel in level)
+        requests = []
+        for rel, stat, ex in pipelined(stats, self.max_inflight):
+            if ex is not None:
+                raise ex
+            if stat is None or stat.ephemeralOwner != 0:
+                # gone since its parent was listed (the root is checked by the src proxy)
+                if rel and rel in old:
+                    self._delete(rel)
+                continue
+
+            self.znodes += 1
+            extra.discard(rel)
+            entry = old.get(rel)
+            new[rel] = [stat.mzxid, stat.pzxid, None]
+            if entry is None or entry[MZXID] != stat.mzxid:
+                requests.append(((rel, "data"), partial(zk.get_async, path(rel))))
+                requests.append(((rel, "acls"), partial(zk.get_acls_async, path(rel))))
+            if entry is None or entry[PZXID] != stat.pzxid:
+                requests.append(((rel, "children"), partial(zk.get_children_async, path(rel), include_data=True)))
+            else:
+                new[rel][CHILDREN] = entry[CHILDREN]
+
+        # fetch the changes
+        values, acls, gone = {}, {}, set()
+        for (rel, kind), value, ex in pipelined(requests, self.max_inflight):
+            if isinstance(ex, NoNodeError):
+                gone.add(rel)
+                continue
+            if ex is not None:
+                raise ex
+
+            if kind == "data":
+                values[rel] = value[0]
+                new[rel][MZXID] = value[1].mzxid
+                self.read += 1
+            elif kind == "acls":
+                acls[rel] = value[0]
+            else:
+                children, stat = value
+                new[rel][PZXID], new[rel][CHILDREN] = stat.pzxid, sorted(children)
+                self.listed += 1
+
+        for rel in gone:
+            new.pop(rel, None)
+            values.pop(rel, None)
+            if rel and rel in old:
+                self._delete(rel)
+
+        self._write(level, values, acls, old)
+
+        # children that were removed, and the next level
+        next_level = []
+        for rel in level:
+            entry = new.get(rel)
+            if entry is None:
+                continue
+            children = entry[CHILDREN]
+            previous = old.get(rel)
+            if previous is not None and previous[CHILDREN] is not None and previous[CHILDREN] != children:
+                for child in set(previous[CHILDREN]).difference(children):
+                    self._delete(os.path.join(rel, child) if rel else child)
+            next_level.extend(os.path.join(rel, child) if rel else child for child in children)
+
+        return next_level
+
+    def _write(self, level, values, acls, old):
+        """ writes the changed values (parents are in previous levels, so they're done) """
+        dst = self.dst
+        if "" in values:
+            dst.write_path(ZKProxy.ZKPathValue(values.pop(""), acls.get("")))
+            self._report("", "Wrote")
+            self.written += 1
+
+        changes = ((rel, ZKProxy.ZKPathValue(values[rel], acls.get(rel))) for rel in level if rel in values)
+        for rel in dst.write_paths(changes, old):
+            self._report(rel, "Wrote")
+            self.written += 1
+
+    def _delete(self, rel):
+        dst = self.dst
+        url = dst.url
+        dst.set_url(os.path.join(url, rel))
+        dst.delete_path_recursively()
+        dst.set_url(url)
+        self._report(rel, "Deleted")
+        self.deleted += 1
+
+    def _report(self, rel, action):
+        if self.verbose:
+            print("%s %s" % (action, os.path.join(self.dst.url, rel) if rel else self.dst.url))
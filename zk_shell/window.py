@@ -0,0 +1,127 @@
+"""
+Limits for the number of outstanding requests (and for retries)
+
+Window is a fixed limit that keeps track of the observed latency, along
+with how many times the request for each path was re-sent after
+connection losses (each path has its own budget, so a loss with many
+requests in flight doesn't use it all up). With
+AdaptiveWindow the limit follows the latency, AIMD style: it starts small
+and doubles every round trip (slow start) until a reply is slower than
+the target latency, from then on it grows by one every round trip while
+replies are on target and shrinks by a quarter (at most once per round
+trip) when they aren't. Lost connections cut it to a quarter, once for
+all the requests that were in flight.
+
+  Example usage:
+    >>> from zk_shell.usage import Usage
+    >>> from zk_shell.window import AdaptiveWindow
+    >>> window = AdaptiveWindow(1000, target=0.020)
+    >>> Usage(zk, "/", window).value
+    1073741824
+    >>> window.limit, window.latency
+    (176, 0.0183)
+
+"""
+
+import time
+
+
+# how smooth (0-1, higher is less) the latency average is
+LATENCY_WEIGHT = 0.2
+
+# seconds between reports
+REPORT_INTERVAL = 2.0
+
+# times the request for a path can be re-sent after connection losses
+DEFAULT_RETRIES = 5
+
+
+class Window(object):
+    """ a fixed limit """
+    __slots__ = ("limit", "latency", "report", "reported", "retries", "retried")
+
+    def __init__(self, limit, report=None, retries=DEFAULT_RETRIES):
+        """
+        :param limit: max number of outstanding requests
+        :param report: called with (limit, average latency) every REPORT_INTERVAL seconds
+        :param retries: max number of times the request for a path is re-sent after
+                        connection losses
+        """
+        self.limit = max(limit, 1)
+        self.latency = None
+        self.report = report
+        self.reported = time.time()
+        self.retries = retries
+        self.retried = {}
+
+    def retry(self, path):
+        """ returns True if a request for path can be re-sent, and counts it """
+        count = self.retried.get(path, 0)
+        if count >= self.retries:
+            return False
+        self.retried[path] = count + 1
+        return True
+
+    def completed(self, latency):
+        """ a reply arrived, latency seconds after its request was sent """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_WEIGHT * (latency - self.latency)
+
+        self.adjust()
+
+        now = time.time()
+        if self.report is not None and now - self.reported >= REPORT_INTERVAL:
+            self.reported = now
+            self.report(self.limit, self.latency)
+
+    def adjust(self):
+        pass
+
+    def backoff(self):
+        """ the connection was lost """
+        pass
+
+
+class AdaptiveWindow(Window):
+    """ a limit that holds the latency around target """
+    __slots__ = ("max_limit", "target", "slow_start", "acked", "cooldown")
+
+    def __init__(self, max_limit, target, start=8, report=None, retries=DEFAULT_RETRIES):
+        """
+        :param max_limit: the limit won't go over this
+        :param target: the target latency, in seconds
+        :param start: the initial limit
+        """
+        super(AdaptiveWindow, self).__init__(min(start, max_limit), report, retries)
+        self.max_limit = max(max_limit, 1)
+        self.target = target
+        self.slow_start = True
+        self.acked = self.cooldown = 0
+
+    def adjust(self):
+        self.cooldown -= 1
+
+        if self.latency > self.target:
+            self.slow_start = False
+            if self.cooldown <= 0:
+                self.decrease(0.75)
+            return
+
+        # slow start grows by one per reply, then by one per round trip
+        self.acked += 1
+        if self.slow_start or self.acked >= self.limit:
+            self.acked = 0
+            self.limit = min(self.limit + 1, self.max_limit)
+
+    def decrease(self, factor):
+        self.limit = max(int(self.limit * factor), 1)
+        self.acked = 0
+        self.cooldown = self.limit
+
+    def backoff(self):
+        # every request in flight fails along, one cut per round trip as well
+        self.slow_start = False
+        if self.cooldown <= 0:
+            self.decrease(0.25)
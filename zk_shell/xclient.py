@@ -2,6 +2,7 @@
 a decorated KazooClient with handy operations on a ZK datatree and its znodes
 """
 from contextlib import contextmanager
+from functools import partial
 import os
 import re
 import socket
@@ -12,10 +13,19 @@ from kazoo.client import KazooClient, TransactionRequest
 from kazoo.exceptions import NoAuthError, NoNodeError
 from kazoo.protocol.states import KazooState
 
+from .cache import ChildrenCache, PathCache
+from .childcount import ChildCount
+from .delete import RecursiveDelete
+from .diff import Diff
+from .grep import Grep
+from .pipeline import pipelined
+from .shards import ReadSessions
 from .statmap import StatMap
+from .subtree import Subtrees
+from .traversal import ACLS, STAT, Traversal
 from .tree import Tree
-from .usage import Usage
-from .util import get_ips, hosts_to_endpoints, to_bytes
+from .usage import Breakdown, Usage
+from .util import DEFAULT_MAX_INFLIGHT, DEFAULT_MAX_INFLIGHT_WRITES, get_ips, hosts_to_endpoints, to_bytes
 
 
 @contextmanager
@@ -100,6 +110,13 @@ class XClient(KazooClient):
     IP_PORT_REGEX = re.compile(r"^\tip:\s/(\d+\.\d+\.\d+\.\d+):(\d+)\ssessionId:\s(0x\w+)\Z")
     PATH_REGEX = re.compile(r"^\t((?:/.*)+)\Z")
 
+    def __init__(self, *args, **kwargs):
+        super(XClient, self).__init__(*args, **kwargs)
+        self._read_sessions = ReadSessions(self)
+        self._path_cache = PathCache(self)
+        self._subtrees = Subtrees(self)
+        self._children_cache = ChildrenCache(self, super(XClient, self).get_children_async)
+
     @property
     def xid(self):
         """ the session's current xid or -1 if not connected """
@@ -134,6 +151,21 @@ class XClient(KazooClient):
         """
         return getattr(self, "_protocol_version", 0)
 
+    @property
+    def path_cache(self):
+        """ the cache used to complete & check paths (see PathCache) """
+        return self._path_cache
+
+    @property
+    def children_cache(self):
+        """ big children lists, validated by their parent's pzxid (see ChildrenCache) """
+        return self._children_cache
+
+    @property
+    def subtrees(self):
+        """ the subtrees mirrored in memory (see Subtrees) """
+        return self._subtrees
+
     @property
     def data_watches(self):
         """ paths for data watches """
@@ -156,6 +188,45 @@ class XClient(KazooClient):
 
         return (value, stat)
 
+    def _cached(self, value):
+        result = self.handler.async_result()
+        result.set(value)
+        return result
+
+    def get_async(self, path, watch=None):
+        """ served from memory when path is under a cached subtree (and no watch is needed) """
+        znode = self._subtrees.lookup(path) if watch is None and self._subtrees else None
+        if znode is None:
+            return super(XClient, self).get_async(path, watch)
+        return self._cached(znode.value)
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        """ served from memory when path is under a cached subtree (and no watch is needed) """
+        znode = self._subtrees.lookup(path) if watch is None and self._subtrees else None
+        if znode is None:
+            return super(XClient, self).get_children_async(path, watch, include_data)
+        children = list(znode.children)
+        return self._cached((children, znode.value[1]) if include_data else children)
+
+    def scan_children_async(self, path, include_data=False):
+        """
+        get_children_async() for scans (see Traversal): big lists are only
+        fetched if their parent's pzxid changed (see set_children_cache_size())
+        """
+        if self._subtrees.get(path) is not None:
+            return self.get_children_async(path, include_data=include_data)
+        return self._children_cache.get_children_async(path, include_data)
+
+    def exists_async(self, path, watch=None):
+        """ served from memory when path is under a cached subtree (and no watch is needed) """
+        if watch is None and self._subtrees:
+            if self._subtrees.absent(path):
+                return self._cached(None)
+            znode = self._subtrees.lookup(path)
+            if znode is not None:
+                return self._cached(znode.value[1])
+        return super(XClient, self).exists_async(path, watch)
+
     def get_bytes(self, *args, **kwargs):
         """ no string decoding performed """
         return super(XClient, self).get(*args, **kwargs)
@@ -179,34 +250,101 @@ class XClient(KazooClient):
         """ use XTransactionRequest which is encoding aware (Py3k) """
         return XTransactionRequest(self)
 
-    def du(self, path):
+    def set_read_sessions(self, count):
+        """Opens (or closes) the extra read-only sessions used by scans
+
+        With count > 0, du(), find(), grep(), fast_tree() & stat_map() split
+        the top-level subtrees of their path among count sessions (plus this
+        one), each preferring a different member of the ensemble.
+
+        :returns: the number of extra sessions that are connected
+        """
+        return self._read_sessions.resize(count)
+
+    def set_children_cache_size(self, max_names):
+        """Sizes the children caches of this session & the extra read sessions
+
+        Scans keep the big children lists they see (up to max_names names in
+        total per session, 0 is off) along with their parent's pzxid, and
+        only download them again if a stat says they changed.
+        """
+        for client in [self] + self._read_sessions.clients:
+            client.children_cache.resize(max_names)
+
+    def reader(self, path):
+        """ what a scan under path reads from (see set_read_sessions()) """
+        if self._subtrees.get(path) is not None:
+            return self
+        return self._read_sessions.reader(path)
+
+    def du(self, path, max_inflight=DEFAULT_MAX_INFLIGHT):
         """ returns the bytes used under path """
-        return Usage(self, path).value
+        return Usage(self.reader(path), path, max_inflight).value
 
-    def get_acls_recursive(self, path, depth, include_ephemerals):
+    def du_breakdown(self, path, depth, top, max_inflight=DEFAULT_MAX_INFLIGHT):
+        """ returns a Breakdown of the bytes used under path, see usage.Breakdown """
+        return Breakdown(self.reader(path), path, depth, top, max_inflight).get()
+
+    def get_acls_recursive(self, path, depth, include_ephemerals,
+                           max_inflight=DEFAULT_MAX_INFLIGHT):
         """A recursive generator wrapper for get_acls
 
+        ACLs are fetched with pipelined requests, and the stat that comes
+        with them is used to skip ephemerals. The ACLs of znodes whose
+        children can't be listed are yielded too, only the descent is skipped.
+
         :param path: path from which to start
         :param depth: depth of the recursion (-1 no recursion, 0 means no limit)
         :param include_ephemerals: get ACLs for ephemerals too
+        :param max_inflight: max number of outstanding requests
         """
         yield path, self.get_acls(path)[0]
 
         if depth == -1:
             return
 
-        for tpath, _ in self.tree(path, depth, full_path=True):
-            try:
-                acls, stat = self.get_acls(tpath)
-            except NoNodeError:
+        traversal = Traversal(self, path, needs=ACLS, max_depth=depth, max_inflight=max_inflight)
+        for node in traversal.get(ordered=True):
+            if not include_ephemerals and node.stat.ephemeralOwner != 0:
                 continue
 
-            if not include_ephemerals and stat.ephemeralOwner != 0:
-                continue
+            yield node.path, node.acls
+
+    def set_acls_recursive(self, path, acls, max_inflight=DEFAULT_MAX_INFLIGHT, unlisted=None):
+        """Sets acls on path and on every znode under it
 
-            yield tpath, acls
+        Paths come from a pipelined traversal and the set_acls requests are
+        pipelined too, with up to max_inflight of them outstanding (setACL
+        can't be part of a multi, so requests aren't batched). A failure
+        doesn't stop the walk, path is done last.
 
-    def find(self, path, match, flags):
+        :param unlisted: a list to append (path, exception) to for each znode
+                         whose children couldn't be listed (so they were skipped)
+        :returns: a generator of (path, exception) for each failed path
+        """
+        def requests():
+            on_unlisted = None if unlisted is None else lambda *failure: unlisted.append(failure)
+            traversal = Traversal(self, path, max_inflight=max_inflight, unlisted=on_unlisted)
+            for node in traversal.get():
+                yield node.path, partial(self.set_acls_async, node.path, acls)
+            yield path, partial(self.set_acls_async, path, acls)
+
+        for cpath, _, ex in pipelined(requests(), max_inflight):
+            if ex is not None:
+                yield cpath, ex
+
+    def delete_recursive(self, path, max_inflight=DEFAULT_MAX_INFLIGHT,
+                         max_inflight_writes=DEFAULT_MAX_INFLIGHT_WRITES, progress=None):
+        """Deletes path and everything under it, deepest levels first
+
+        :param max_inflight: max number of outstanding reads
+        :param max_inflight_writes: max number of outstanding deletes (multis)
+        :param progress: called with (found, deleted, elapsed) while running
+        :returns: the number of deleted znodes
+        """
+        return RecursiveDelete(self, path, max_inflight, max_inflight_writes, progress).run()
+
+    def find(self, path, match, flags, max_inflight=DEFAULT_MAX_INFLIGHT):
         """ find every matching child path under path """
         try:
             match = re.compile(match, flags)
@@ -215,44 +353,29 @@ class XClient(KazooClient):
             return
 
         offset = len(path)
-        for cpath in Tree(self, path).get():
+        for cpath in Tree(self.reader(path), path, max_inflight).get():
             if match.search(cpath[offset:]):
                 yield cpath
 
-    def grep(self, path, content, flags):
-        """ grep every child path under path for content """
+    def grep(self, path, content, flags, ordered=False, workers=0,
+             max_inflight=DEFAULT_MAX_INFLIGHT, checkpoint=None):
+        """ grep every child path under path for content
+
+        :param ordered: yield matches in DFS order, otherwise as they are found
+        :param workers: max number of processes used for matching (0 is one per CPU)
+        :param checkpoint: a Checkpoint to save progress to (or resume from), unordered only
+        """
         try:
             match = re.compile(content, flags)
         except sre_constants.error as ex:
             print("Bad regexp: %s" % (ex))
             return
 
-        for gpath, matches in self.do_grep(path, match):
+        grep = Grep(self.reader(path), path, match, workers, max_inflight, checkpoint)
+        for gpath, matches in grep.get(ordered):
             yield (gpath, matches)
 
-    def do_grep(self, path, match):
-        """ grep's work horse """
-        try:
-            children = self.get_children(path)
-        except (NoNodeError, NoAuthError):
-            children = []
-
-        for child in children:
-            full_path = os.path.join(path, child)
-            try:
-                value, _ = self.get(full_path)
-            except (NoNodeError, NoAuthError):
-                value = ""
-
-            if value is not None:
-                matches = [line for line in value.split("\n") if match.search(line)]
-                if len(matches) > 0:
-                    yield (full_path, matches)
-
-            for mpath, matches in self.do_grep(full_path, match):
-                yield (mpath, matches)
-
-    def child_count(self, path):
+    def child_count(self, path, max_inflight=DEFAULT_MAX_INFLIGHT):
         """
         returns the child count under path (deals with znodes going away as it's
         traversing the tree).
@@ -262,90 +385,63 @@ class XClient(KazooClient):
             return 0
 
         count = stat.numChildren
-        for _, _, stat in self.tree(path, 0, include_stat=True):
-            if stat:
-                count += stat.numChildren
+        for node in Traversal(self, path, needs=STAT, max_inflight=max_inflight).get():
+            count += node.stat.numChildren
         return count
 
-    def tree(self, path, max_depth, full_path=False, include_stat=False):
+    def child_counts(self, path, max_depth, max_inflight=DEFAULT_MAX_INFLIGHT):
+        """
+        a generator for (path, child count) for every path up to max_depth, in
+        DFS order. The whole subtree is traversed once (as opposed to calling
+        child_count() for each path).
+        """
+        return ChildCount(self, path, max_depth, max_inflight).get()
+
+    def tree(self, path, max_depth, full_path=False, include_stat=False,
+             max_inflight=DEFAULT_MAX_INFLIGHT):
         """DFS generator which starts from a given path and goes up to a max depth.
 
+        Children (and stats) of upcoming subtrees are prefetched while the
+        earlier ones are being yielded, but the DFS order is preserved.
+
         :param path: path from which the DFS will start
         :param max_depth: max depth of DFS (0 means no limit)
         :param full_path: should the full path of the child node be returned
         :param include_stat: return the child Znode's stat along with the name & level
+        :param max_inflight: max number of znodes fetched ahead of the DFS
         """
-        for child_level_stat in self.do_tree(path, max_depth, 0, full_path, include_stat):
-            yield child_level_stat
-
-    def do_tree(self, path, max_depth, level, full_path, include_stat):
-        """ tree's work horse """
-        try:
-            children = self.get_children(path)
-        except (NoNodeError, NoAuthError):
-            children = []
-
-        for child in children:
-            cpath = os.path.join(path, child) if full_path else child
+        traversal = Traversal(self,
+                              path,
+                              needs=STAT if include_stat else 0,
+                              max_depth=max_depth,
+                              max_inflight=max_inflight)
+        for node in traversal.get(ordered=True):
+            cpath = node.path if full_path else os.path.basename(node.path)
             if include_stat:
-                yield cpath, level, self.stat(os.path.join(path, child))
+                yield cpath, node.level, node.stat
             else:
-                yield cpath, level
+                yield cpath, node.level
 
-            if max_depth == 0 or level + 1 < max_depth:
-                cpath = os.path.join(path, child)
-                for rchild_rlevel_rstat in self.do_tree(cpath, max_depth, level + 1, full_path, include_stat):
-                    yield rchild_rlevel_rstat
-
-    def fast_tree(self, path, exclude_recurse=None):
+    def fast_tree(self, path, exclude_recurse=None, max_inflight=DEFAULT_MAX_INFLIGHT):
         """ a fast async version of tree() """
-        for cpath in Tree(self, path).get(exclude_recurse):
+        for cpath in Tree(self.reader(path), path, max_inflight).get(exclude_recurse):
             yield cpath
 
-    def stat_map(self, path):
+    def stat_map(self, path, max_inflight=DEFAULT_MAX_INFLIGHT):
         """ a generator for <child, Stat> """
-        return StatMap(self, path).get()
+        return StatMap(self.reader(path), path, max_inflight=max_inflight).get()
 
-    def diff(self, path_a, path_b):
+    def diff(self, path_a, path_b, max_inflight=DEFAULT_MAX_INFLIGHT):
         """ Performs a deep comparison of path_a/ and path_b/
 
             For each child, it yields (rv, child) where rv:
              -1 if doesn't exist in path_b (destination)
               0 if they are different
               1 if it doesn't exist in path_a (source)
-        """
-        path_a = path_a.rstrip("/")
-        path_b = path_b.rstrip("/")
-
-        if not self.exists(path_a) or not self.exists(path_b):
-            return
-
-        if not self.equal(path_a, path_b):
-            yield 0, "/"
 
-        seen = set()
-
-        len_a = len(path_a)
-        len_b = len(path_b)
-
-        # first, check what's missing & changed in dst
-        for child_a, level in self.tree(path_a, 0, True):
-            child_sub = child_a[len_a + 1:]
-            child_b = os.path.join(path_b, child_sub)
-
-            if not self.exists(child_b):
-                yield -1, child_sub
-            else:
-                if not self.equal(child_a, child_b):
-                    yield 0, child_sub
-
-            seen.add(child_sub)
-
-        # now, check what's new in dst
-        for child_b, level in self.tree(path_b, 0, True):
-            child_sub = child_b[len_b + 1:]
-            if child_sub not in seen:
-                yield 1, child_sub
+            Both subtrees are walked at once, see Diff for details.
+        """
+        return Diff(self, path_a, path_b, max_inflight).get()
 
     def equal(self, path_a, path_b):
         """